@@ -0,0 +1,320 @@
+"""Share the data of identical requests to the data centres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import time
+import logging
+import threading
+
+from mseed import BufferPool
+
+
+class Detached(Exception):
+    """The reader was detached from the flight because it was too slow."""
+    pass
+
+
+class Flight(object):
+    """Upstream request in progress whose data is shared by several readers.
+
+    A thread reads the data from the data centre and keeps it in memory until
+    all readers received it. If the slowest reader is ``maxChunks`` chunks
+    behind, the reading from the data centre waits. The request is bound to
+    the latest deadline of the readers attached and it is cancelled when the
+    last reader leaves. A reader which does not
+    advance for ``stallTimeout`` seconds while the flight waits for it is
+    detached, so that it never holds the other readers. New readers can only
+    join while the first chunk is still in memory, and only one reader per
+    owner (e.g. a ``ResultFile``) can be attached.
+    """
+
+    # Size of the chunks read from the data centre
+    chunkSize = 4096 * 25
+
+    def __init__(self, registry, key, source, maxChunks, stallTimeout=10):
+        self.log = logging.getLogger('SingleFlight')
+        self.registry = registry
+        self.key = key
+        self.source = source
+        self.maxChunks = maxChunks
+        self.stallTimeout = stallTimeout
+        self.cond = threading.Condition()
+        self.chunks = list()
+        # Position in the stream of the first chunk in memory
+        self.base = 0
+        # Position, owner, deadline and time of the last read of every reader
+        self.readers = dict()
+        self.owners = dict()
+        self.deadlines = dict()
+        self.lastRead = dict()
+        self.detached = set()
+        self.lastID = 0
+        self.done = False
+        self.error = None
+
+    def start(self):
+        pump = threading.Thread(target=self.__pump)
+        pump.daemon = True
+        pump.start()
+
+    def __pump(self):
+        """Read the data from the data centre and share it with the readers."""
+        try:
+            with self.source as dsr:
+                pool = BufferPool(2, self.chunkSize)
+                for buf, chunk in dsr.records(pool):
+                    data = chunk.tobytes()
+                    pool.release(buf)
+                    with self.cond:
+                        waiting = time.time()
+                        while len(self.chunks) >= self.maxChunks and len(self.readers):
+                            self.cond.wait(1)
+                            self.__dropStalled(waiting)
+                        if not len(self.readers):
+                            self.log.debug('All readers left %s' % self.key[0])
+                            break
+                        self.chunks.append(data)
+                        self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.registry.remove(self)
+
+    def __dropStalled(self, waiting):
+        """Detach the slowest readers if they did not read since the flight
+        started waiting for them, ``stallTimeout`` seconds ago or more.
+
+        Lock must be held.
+        """
+        if len(self.chunks) < self.maxChunks:
+            return
+        now = time.time()
+        for rid, pos in self.readers.items():
+            if pos == self.base and now - max(self.lastRead[rid], waiting) >= self.stallTimeout:
+                self.log.warning('Reader %d of %s detached after %d seconds without reading' %
+                                 (rid, self.key[0], self.stallTimeout))
+                self.detached.add(rid)
+                self.__remove(rid)
+        self.__trim()
+        self.__setDeadline()
+
+    def __setDeadline(self):
+        """Bind the request to the latest deadline of the readers.
+
+        Lock must be held.
+        """
+        if not len(self.deadlines):
+            return
+        deadlines = self.deadlines.values()
+        deadline = None if None in deadlines else max(deadlines)
+        if hasattr(self.source, 'setDeadline') and deadline != self.source.deadline:
+            self.source.setDeadline(deadline)
+
+    def attach(self, owner=None, deadline=None):
+        """Register a new reader if the stream can still be read from the start.
+
+        :param owner: Object reading the data. Only one of its readers can
+            be attached to the flight.
+        :param deadline: Time (as in ``time.time()``) when the reader gives up
+        :type deadline: float
+        :returns: ID of the reader or None if it cannot join
+        :rtype: int
+        """
+        with self.cond:
+            if self.base or self.done:
+                return None
+            if owner is not None and owner in self.owners.values():
+                return None
+            self.lastID += 1
+            self.readers[self.lastID] = 0
+            self.owners[self.lastID] = owner
+            self.deadlines[self.lastID] = deadline
+            self.lastRead[self.lastID] = time.time()
+            self.__setDeadline()
+            return self.lastID
+
+    def __remove(self, rid):
+        """Forget a reader. Lock must be held."""
+        del self.readers[rid]
+        del self.owners[rid]
+        del self.deadlines[rid]
+        del self.lastRead[rid]
+
+    def detach(self, rid):
+        with self.cond:
+            self.detached.discard(rid)
+            if rid in self.readers:
+                self.__remove(rid)
+                self.__trim()
+                if len(self.readers):
+                    self.__setDeadline()
+                elif not self.done and hasattr(self.source, 'cancel'):
+                    self.log.debug('Cancelling %s. All readers left.' % self.key[0])
+                    self.source.cancel()
+
+    def __trim(self):
+        """Release the chunks already read by everybody. Lock must be held."""
+        if len(self.readers):
+            first = min(self.readers.values())
+        else:
+            first = self.base + len(self.chunks)
+
+        if first > self.base:
+            del self.chunks[:first - self.base]
+            self.base = first
+            self.cond.notify_all()
+
+    def read(self, rid, stop=None):
+        """Return the next chunk for the reader or None at the end of the data.
+
+        :raise: Detached if the reader was detached for being too slow
+        """
+        with self.cond:
+            if rid in self.detached:
+                raise Detached('Reader detached from %s' % self.key[0])
+            pos = self.readers[rid]
+            while pos >= self.base + len(self.chunks):
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return None
+                if stop is not None and stop.is_set():
+                    return None
+                self.cond.wait(1)
+
+            data = self.chunks[pos - self.base]
+            self.readers[rid] = pos + 1
+            self.lastRead[rid] = time.time()
+            self.__trim()
+            return data
+
+
+class SharedSource(object):
+    """Reader of a :class:`Flight` with the same interface as DSRequest.
+
+    ``driver`` is True for the reader which started the flight. If the
+    reader is detached from the flight, the data not read yet is requested
+    again with a new source created by ``fallback``, skipping the records
+    already returned.
+    """
+
+    def __init__(self, flight, rid, driver, fallback=None):
+        self.flight = flight
+        self.rid = rid
+        self.driver = driver
+        self.fallback = fallback
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flight.detach(self.rid)
+
+    def __resume(self, pool, stop, skip):
+        """Read the data from a new source starting at byte ``skip``."""
+        with self.fallback() as dsr:
+            for buf, chunk in dsr.records(pool, stop):
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    pool.release(buf)
+                    continue
+                # Chunks contain complete records, as the data already read
+                yield buf, chunk[skip:]
+                skip = 0
+
+    def records(self, pool, stop=None):
+        delivered = 0
+        while True:
+            try:
+                data = self.flight.read(self.rid, stop)
+            except Detached:
+                if self.fallback is None:
+                    raise
+                for item in self.__resume(pool, stop, delivered):
+                    yield item
+                return
+
+            if data is None:
+                return
+            delivered += len(data)
+
+            # Every reader gets a copy in its own buffers
+            for start in range(0, len(data), pool.size):
+                piece = data[start:start + pool.size]
+                buf = pool.get(stop)
+                if buf is None:
+                    return
+                mv = memoryview(buf)
+                mv[:len(piece)] = piece
+                yield buf, mv[:len(piece)]
+
+
+class SingleFlight(object):
+    """Coalesce identical requests to the data centres in progress.
+
+    Requests are identified by a key (e.g. URL and POST body). The first
+    request with a key starts the download and the following ones with the
+    same key attach to it as long as the data can be read from the start.
+    """
+
+    def __init__(self, maxChunks=100, stallTimeout=10):
+        self.log = logging.getLogger('SingleFlight')
+        self.maxChunks = maxChunks
+        self.stallTimeout = stallTimeout
+        self.lock = threading.Lock()
+        self.flights = dict()
+        self.coalesced = 0
+
+    def source(self, key, source, owner=None, fallback=None):
+        """Return a source with the data of the request identified by ``key``.
+
+        :param key: Identification of the request
+        :type key: tuple
+        :param source: Source to read the data from if no request is in progress
+        :type source: DSRequest
+        :param owner: Object reading the data. Two of its sources are never
+            attached to the same flight, as it reads them one after the other.
+        :param fallback: Function returning a new source for the request, used
+            if the reader is detached from the flight
+        :rtype: SharedSource
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            deadline = getattr(source, 'deadline', None)
+            if flight is not None:
+                rid = flight.attach(owner, deadline)
+                if rid is not None:
+                    self.coalesced += 1
+                    self.log.debug('Attached to request in progress %s' % key[0])
+                    return SharedSource(flight, rid, False, fallback)
+                if owner is not None and owner in flight.owners.values():
+                    # Not shared. The flight in progress is kept for others.
+                    return source
+
+            flight = Flight(self, key, source, self.maxChunks, self.stallTimeout)
+            rid = flight.attach(owner, deadline)
+            self.flights[key] = flight
+
+        flight.start()
+        return SharedSource(flight, rid, True, fallback)
+
+    def remove(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
@@ -0,0 +1,146 @@
+"""Health of the Dataselect services of the data centres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import time
+import logging
+import threading
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALFOPEN = 'half-open'
+
+
+def endpoint(url):
+    """Return the service of a URL without its query."""
+    return url.split('?')[0]
+
+
+class EndpointHealth(object):
+    """Statistics and state of the circuit breaker of one service."""
+
+    # Weight of the last request in the moving averages
+    alpha = 0.1
+
+    def __init__(self):
+        self.state = CLOSED
+        self.requests = 0
+        self.failures = 0
+        self.consecutive = 0
+        self.expired = 0
+        self.latency = None
+        self.errorRate = 0.0
+        self.openedAt = None
+
+    def update(self, failed, latency=None):
+        self.requests += 1
+        self.errorRate += self.alpha * ((1.0 if failed else 0.0) - self.errorRate)
+        if failed:
+            self.failures += 1
+            self.consecutive += 1
+        else:
+            self.consecutive = 0
+
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+
+    def toDict(self):
+        return {'state': self.state,
+                'requests': self.requests,
+                'failures': self.failures,
+                'consecutiveFailures': self.consecutive,
+                'expired': self.expired,
+                'errorRate': round(self.errorRate, 3),
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+                'openedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.openedAt))
+                if self.openedAt is not None else None}
+
+
+class HealthRegistry(object):
+    """Track the health of the Dataselect services and open their circuits.
+
+    After ``threshold`` consecutive failures the circuit of a service is
+    opened and its requests are skipped. Once ``cooldown`` seconds passed,
+    one request is allowed as a probe. If it succeeds the circuit is closed
+    again, otherwise it stays open for another cooldown period.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.log = logging.getLogger('HealthRegistry')
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.services = dict()
+
+    def __get(self, service):
+        """Return the health of a service. Lock must be held."""
+        if service not in self.services:
+            self.services[service] = EndpointHealth()
+        return self.services[service]
+
+    def allow(self, service):
+        """Check whether a request can be sent to the service."""
+        with self.lock:
+            health = self.__get(service)
+            if health.state == CLOSED:
+                return True
+
+            # A new probe is also allowed if the last one never finished
+            if time.time() - health.openedAt >= self.cooldown:
+                self.log.info('Probing %s after %d seconds' % (service, self.cooldown))
+                health.state = HALFOPEN
+                health.openedAt = time.time()
+                return True
+
+            return False
+
+    def success(self, service, latency=None):
+        """Register a successful request to the service."""
+        with self.lock:
+            health = self.__get(service)
+            health.update(False, latency)
+            if health.state != CLOSED:
+                self.log.info('Circuit of %s closed' % service)
+                health.state = CLOSED
+                health.openedAt = None
+
+    def failure(self, service, latency=None):
+        """Register a failed request to the service."""
+        with self.lock:
+            health = self.__get(service)
+            health.update(True, latency)
+            if health.state == HALFOPEN or \
+                    (health.state == CLOSED and health.consecutive >= self.threshold):
+                self.log.warning('Circuit of %s opened after %d consecutive failures' %
+                                 (service, health.consecutive))
+                health.state = OPEN
+                health.openedAt = time.time()
+
+    def expired(self, service):
+        """Register a request abandoned because the deadline of the client expired.
+
+        It is not a failure of the service and does not change its circuit.
+        """
+        with self.lock:
+            self.__get(service).expired += 1
+
+    def status(self):
+        """Return the health of all services."""
+        with self.lock:
+            return dict([(k, v.toDict()) for k, v in self.services.iteritems()])
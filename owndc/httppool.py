@@ -0,0 +1,390 @@
+"""Pool of persistent HTTP connections to the data centres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import time
+import socket
+import logging
+import threading
+import httplib
+import urlparse
+import urllib2 as ul
+from StringIO import StringIO
+
+
+def _timeout(timeout, deadline):
+    """Return the timeout to use considering the time left until the deadline.
+
+    :raise: socket.timeout if the deadline already expired
+    """
+    if deadline is None:
+        return timeout
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout('Deadline of the request expired')
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class PooledResponse(object):
+    """File-like object wrapping the response of a pooled connection.
+
+    When the response is closed the connection is given back to the pool if
+    all the data was read and the server allows to keep it alive.
+    """
+
+    def __init__(self, pool, conn, resp, url, deadline=None):
+        self.pool = pool
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.deadline = deadline
+        self.cancelled = False
+        # Socket used by the response even if the connection was closed
+        self.sock = getattr(resp.fp, '_sock', None)
+        self.__settimeout()
+
+    def __settimeout(self):
+        if self.sock is not None:
+            self.sock.settimeout(_timeout(self.pool.readTimeout, self.deadline))
+
+    def setDeadline(self, deadline):
+        """Change the deadline while the response is being read."""
+        self.deadline = deadline
+        try:
+            self.__settimeout()
+        except socket.timeout:
+            self.cancel()
+
+    def cancel(self):
+        """Abort the reading of the response, e.g. from another thread."""
+        self.cancelled = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def read(self, size=-1):
+        if self.deadline is not None:
+            self.__settimeout()
+
+        if size is None or size < 0:
+            return self.resp.read()
+        return self.resp.read(size)
+
+    def getcode(self):
+        return self.resp.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.resp.msg
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        # The connection can only be reused if the response was consumed
+        reuse = self.resp.isclosed() and not self.resp.will_close and not self.cancelled
+        if not reuse:
+            self.resp.close()
+        self.pool.release(self.conn, reuse)
+        self.conn = None
+
+
+class ConnectionPool(object):
+    """Keep alive connections to the data centres and reuse them.
+
+    Connections are grouped by scheme, host and port. At most ``maxPerHost``
+    connections (idle or in use) should be open for each group. Once the
+    limit was reached, ``acquire`` waits up to ``waitTimeout`` seconds for
+    one to be released and opens a new one afterwards, as the connections in
+    use may be waiting for the consumer of the data. The connections above
+    the limit are closed when they are released. If ``maxPerHost`` is 0,
+    connections are neither limited nor reused. Connections which were not
+    used during the last ``idleTimeout`` seconds are closed. ``refresh``
+    opens new connections to the hosts given to ``connect(url, keep=True)``
+    before their idle ones are evicted.
+
+    ``connectTimeout``, ``firstByteTimeout`` and ``readTimeout`` limit the
+    time (in seconds) to connect, to receive the response after the request
+    was sent and to receive every chunk of data. None means no limit.
+    """
+
+    # Maximum number of redirections to follow
+    maxRedirects = 5
+
+    def __init__(self, maxPerHost=8, idleTimeout=30, connectTimeout=None,
+                 firstByteTimeout=None, readTimeout=None, waitTimeout=2):
+        self.log = logging.getLogger('ConnectionPool')
+        self.maxPerHost = maxPerHost
+        self.waitTimeout = waitTimeout
+        self.idleTimeout = idleTimeout
+        self.connectTimeout = connectTimeout
+        self.firstByteTimeout = firstByteTimeout
+        self.readTimeout = readTimeout
+        self.lock = threading.Lock()
+        # Notified when a connection is released or closed
+        self.released = threading.Condition(self.lock)
+        # Idle connections per (scheme, host, port) as (conn, lastUsed)
+        self.idle = dict()
+        # Number of connections (idle or in use) per (scheme, host, port)
+        self.open = dict()
+        # Groups which should always have an idle connection
+        self.warm = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Connections opened above the limit after waiting for a free one
+        self.overflows = 0
+
+    def __evict(self, now):
+        """Close the connections idle for too long. Lock must be held."""
+        for key in self.idle.keys():
+            alive = list()
+            for conn, lastUsed in self.idle[key]:
+                if now - lastUsed > self.idleTimeout:
+                    conn.close()
+                    self.__closed(key)
+                    self.evictions += 1
+                else:
+                    alive.append((conn, lastUsed))
+
+            if len(alive):
+                self.idle[key] = alive
+            else:
+                del self.idle[key]
+
+    def __closed(self, key):
+        """Count a connection of the group as closed. Lock must be held."""
+        self.open[key] -= 1
+        if not self.open[key]:
+            del self.open[key]
+        self.released.notify_all()
+
+    def acquire(self, scheme, host, port, deadline=None):
+        """Borrow a connection to the given host.
+
+        If ``maxPerHost`` connections to the host are in use, it waits up to
+        ``waitTimeout`` seconds until one of them is released. Otherwise, a
+        new connection is opened anyway.
+
+        :param deadline: Time (as in ``time.time()``) when the wait must be
+            abandoned. A ``socket.timeout`` is raised if it expires.
+        :type deadline: float
+        :returns: A tuple with the connection and whether it was reused
+        :rtype: tuple
+        """
+        key = (scheme, host, port)
+        limit = time.time() + self.waitTimeout
+        with self.lock:
+            while True:
+                self.__evict(time.time())
+                if key in self.idle:
+                    conn, lastUsed = self.idle[key].pop()
+                    if not len(self.idle[key]):
+                        del self.idle[key]
+                    self.hits += 1
+                    return conn, True
+                if not self.maxPerHost or self.open.get(key, 0) < self.maxPerHost:
+                    break
+                now = time.time()
+                if now >= limit:
+                    self.log.debug('No free connection to %s:%s. Opening one more.' %
+                                   (host, port))
+                    self.overflows += 1
+                    break
+                self.released.wait(_timeout(limit - now, deadline))
+
+            self.open[key] = self.open.get(key, 0) + 1
+            self.misses += 1
+
+        return self.__new(key), False
+
+    def __new(self, key):
+        """Return a new connection of the group (not connected yet)."""
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port)
+        else:
+            conn = httplib.HTTPConnection(host, port)
+        conn.poolKey = key
+        return conn
+
+    def release(self, conn, reuse=True):
+        """Give a connection back to the pool.
+
+        :param reuse: If False the connection is closed
+        :type reuse: bool
+        """
+        with self.lock:
+            if reuse and self.open[conn.poolKey] <= self.maxPerHost:
+                self.idle.setdefault(conn.poolKey, list()).append((conn, time.time()))
+                self.released.notify_all()
+                return
+            self.__closed(conn.poolKey)
+
+        conn.close()
+
+    def __connect(self, conn):
+        """Connect a new connection and keep it in the pool."""
+        conn.timeout = self.connectTimeout
+        try:
+            conn.connect()
+        except:
+            self.release(conn, False)
+            raise
+        self.release(conn)
+
+    def connect(self, url, keep=False):
+        """Open a connection to the host of the URL and keep it in the pool.
+
+        It is used to have the connections ready before the first request.
+
+        :param keep: Open the connection again in ``refresh`` after it was
+            evicted
+        :type keep: bool
+        """
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        if keep:
+            with self.lock:
+                self.warm.add(key)
+        conn, reused = self.acquire(*key)
+        if reused:
+            self.release(conn)
+        else:
+            self.__connect(conn)
+
+    def refresh(self, interval=0):
+        """Open a new connection to the hosts kept warm if needed.
+
+        A connection is opened if none of the idle ones of the host would
+        still be alive within ``interval`` seconds (e.g. the time until the
+        next call).
+        """
+        with self.lock:
+            now = time.time()
+            self.__evict(now)
+            keys = [k for k in self.warm if self.open.get(k, 0) < self.maxPerHost and
+                    not any([now + interval - lastUsed <= self.idleTimeout
+                             for conn, lastUsed in self.idle.get(k, list())])]
+            for key in keys:
+                self.open[key] = self.open.get(key, 0) + 1
+
+        for key in keys:
+            try:
+                self.__connect(self.__new(key))
+            except Exception as e:
+                self.log.warning('Cannot connect to %s:%s! %s' % (key[1], key[2], e))
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self.lock:
+            for key in self.idle:
+                for conn, lastUsed in self.idle[key]:
+                    conn.close()
+                    self.__closed(key)
+            self.idle = dict()
+
+    def stats(self):
+        """Return the counters of the pool."""
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'idle': sum([len(v) for v in self.idle.values()]),
+                    'open': sum(self.open.values()),
+                    'overflows': self.overflows}
+
+    def __send(self, conn, method, path, data, headers, deadline):
+        """Send the request and wait for the response within the timeouts."""
+        if conn.sock is None:
+            conn.timeout = _timeout(self.connectTimeout, deadline)
+        conn.request(method, path, data, headers)
+        conn.sock.settimeout(_timeout(self.firstByteTimeout, deadline))
+        return conn.getresponse()
+
+    def urlopen(self, url, data=None, headers=None, deadline=None):
+        """Send a request through a pooled connection.
+
+        It behaves like ``urllib2.urlopen``. Redirections are followed and
+        an ``urllib2.HTTPError`` is raised if the status is 400 or higher.
+
+        :param url: URL of the request
+        :type url: str
+        :param data: Body of the request. If present the method is POST.
+        :type data: str
+        :param deadline: Time (as in ``time.time()``) when the request must
+            be abandoned. A ``socket.timeout`` is raised if it expires.
+        :type deadline: float
+        :returns: A file-like object with the response
+        :rtype: PooledResponse
+        """
+        method = 'GET' if data is None else 'POST'
+        headers = dict() if headers is None else dict(headers)
+
+        for redirect in range(self.maxRedirects + 1):
+            parts = urlparse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+
+            conn, reused = self.acquire(parts.scheme, parts.hostname, port, deadline)
+            try:
+                resp = self.__send(conn, method, path, data, headers, deadline)
+            except socket.timeout:
+                self.release(conn, False)
+                raise
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    self.release(conn, False)
+                    raise
+                # The server probably closed the idle connection. Retry once
+                # with a new one, as the other idle ones could be stale too.
+                self.log.debug('Stale connection to %s:%s' % (parts.hostname, port))
+                conn.close()
+                conn = self.__new(conn.poolKey)
+                try:
+                    resp = self.__send(conn, method, path, data, headers, deadline)
+                except:
+                    self.release(conn, False)
+                    raise
+            except:
+                self.release(conn, False)
+                raise
+
+            if resp.status in (301, 302, 303, 307) and resp.getheader('location'):
+                resp.read()
+                self.release(conn, not resp.will_close)
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                if resp.status == 303:
+                    method, data = 'GET', None
+                continue
+
+            if resp.status >= 400:
+                body = resp.read()
+                self.release(conn, not resp.will_close)
+                raise ul.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                   StringIO(body))
+
+            return PooledResponse(self, conn, resp, url, deadline)
+
+        raise ul.URLError('Too many redirections for %s' % url)
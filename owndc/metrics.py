@@ -0,0 +1,232 @@
+"""Metrics of the Dataselect service in the Prometheus text format
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import bisect
+import threading
+
+from planner import UpstreamRequest
+from health import endpoint
+
+# Buckets for the duration of the requests (in seconds)
+DURATION = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+            30.0, 60.0, 300.0)
+# Buckets for the time needed to resolve a route (in seconds)
+LOOKUP = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+          0.5, 1.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    """Return the labels of a sample as text."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not len(pairs):
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v)) for k, v in pairs])
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base of all the metrics. Values are kept per combination of labels."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('%s expects the labels %s' % (self.name, self.labels))
+        return tuple([str(l) for l in labels])
+
+    def samples(self):
+        """Return the samples as tuples of name suffix, labels and value."""
+        with self.lock:
+            return [('', _labels(self.labels, k), v)
+                    for k, v in sorted(self.values.iteritems())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, *labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                # Count of every bucket (not cumulative), sum and count
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = self.values[key]
+            pos = bisect.bisect_left(self.buckets, value)
+            if pos < len(self.buckets):
+                counts[0][pos] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        result = list()
+        with self.lock:
+            for k, (counts, total, count) in sorted(self.values.iteritems()):
+                cumulative = 0
+                for le, c in zip(self.buckets, counts):
+                    cumulative += c
+                    result.append(('_bucket', _labels(self.labels, k, [('le', _number(le))]),
+                                   cumulative))
+                result.append(('_bucket', _labels(self.labels, k, [('le', '+Inf')]), count))
+                result.append(('_sum', _labels(self.labels, k), total))
+                result.append(('_count', _labels(self.labels, k), count))
+        return result
+
+
+class MetricsRegistry(object):
+    """Set of metrics which can be rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = list()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join([m.render() for m in self.metrics]) + '\n'
+
+
+class ServiceMetrics(MetricsRegistry):
+    """Metrics of the requests of the clients and to the data centres.
+
+    It can be used as the observer of a ``ResultFile`` to follow the
+    requests to the data centres.
+    """
+
+    # The records of the sources are not needed
+    countRecords = False
+
+    def __init__(self):
+        super(ServiceMetrics, self).__init__()
+        self.requests = self.add(Counter(
+            'owndc_requests_total', 'Requests received by method and HTTP status.',
+            ('method', 'status')))
+        self.requestDuration = self.add(Histogram(
+            'owndc_request_duration_seconds',
+            'Time to answer the requests by method and HTTP status.',
+            ('method', 'status')))
+        self.bytesStreamed = self.add(Counter(
+            'owndc_streamed_bytes_total', 'Bytes of data sent to the clients.'))
+        self.activeStreams = self.add(Gauge(
+            'owndc_active_streams', 'Requests whose data is being sent.'))
+
+        self.upstreamRequests = self.add(Counter(
+            'owndc_upstream_requests_total',
+            'Requests sent to the data centres by endpoint and HTTP status (0 if none).',
+            ('endpoint', 'status')))
+        self.upstreamErrors = self.add(Counter(
+            'owndc_upstream_errors_total',
+            'Failed requests to the data centres by endpoint.', ('endpoint',)))
+        self.upstreamTTFB = self.add(Histogram(
+            'owndc_upstream_ttfb_seconds',
+            'Time to the first byte of data from the data centres by endpoint.',
+            ('endpoint',)))
+        self.upstreamBytes = self.add(Counter(
+            'owndc_upstream_bytes_total',
+            'Bytes received from the data centres by endpoint.', ('endpoint',)))
+        self.upstreamSeconds = self.add(Counter(
+            'owndc_upstream_transfer_seconds_total',
+            'Time spent receiving data from the data centres by endpoint. '
+            'The throughput is owndc_upstream_bytes_total divided by this value.',
+            ('endpoint',)))
+        self.upstreamActive = self.add(Gauge(
+            'owndc_upstream_active_requests',
+            'Requests to the data centres in progress by endpoint.', ('endpoint',)))
+
+        self.routeLookup = self.add(Histogram(
+            'owndc_route_lookup_seconds', 'Time needed to resolve the routes of a stream.',
+            buckets=LOOKUP))
+
+    def request(self, method, status, duration):
+        """Register a request answered to a client."""
+        self.requests.inc(1, method, status)
+        self.requestDuration.observe(duration, method, status)
+
+    @staticmethod
+    def endpoint(url):
+        """Return the endpoint of a source of a ``ResultFile``."""
+        if isinstance(url, UpstreamRequest):
+            return url.url
+        if isinstance(url, basestring):
+            return endpoint(url)
+        # Data read from the local cache
+        return 'cache'
+
+    def started(self, url):
+        self.upstreamActive.inc(1, self.endpoint(url))
+
+    def received(self, url, size):
+        pass
+
+    def finished(self, url, status, size, records, ttfb, duration):
+        service = self.endpoint(url)
+        self.upstreamActive.dec(1, service)
+        self.upstreamRequests.inc(1, service, status)
+        if status not in (200, 204):
+            self.upstreamErrors.inc(1, service)
+        if ttfb is not None:
+            self.upstreamTTFB.observe(ttfb, service)
+        self.upstreamBytes.inc(size, service)
+        self.upstreamSeconds.inc(duration, service)
@@ -0,0 +1,290 @@
+"""Read miniSEED data as a stream of complete records
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import struct
+import logging
+import datetime
+import threading
+import Queue
+
+# Size of the fixed section of the data header
+FIXEDHEADER = 48
+
+
+def _byteorder(buf, pos):
+    """Guess the byte order of a record from the year of its start time."""
+    year = struct.unpack_from('>H', buf, pos + 20)[0]
+    if 1900 <= year <= 2100:
+        return '>'
+    return '<'
+
+
+def recordLength(buf, pos=0, size=None):
+    """Return the length of the record starting at ``pos``.
+
+    The length is read from the blockette 1000 of the record.
+
+    :param buf: Buffer with the data
+    :type buf: bytearray
+    :param pos: Position where the record starts
+    :type pos: int
+    :param size: Number of valid bytes in the buffer
+    :type size: int
+    :returns: Length of the record or None if more data is needed to find it
+    :rtype: int
+    :raise: ValueError if the data is not a valid miniSEED record
+    """
+    size = len(buf) if size is None else size
+
+    if size - pos < FIXEDHEADER:
+        return None
+
+    if struct.unpack_from('c', buf, pos + 6)[0] not in 'DRQM':
+        raise ValueError('Invalid data quality indicator at byte %d' % pos)
+
+    bo = _byteorder(buf, pos)
+    offset = struct.unpack_from(bo + 'H', buf, pos + 46)[0]
+
+    # Follow the chain of blockettes until the 1000 is found
+    while offset:
+        if offset < FIXEDHEADER:
+            raise ValueError('Invalid blockette offset at byte %d' % pos)
+
+        if size - pos < offset + 8:
+            return None
+
+        bType, bNext = struct.unpack_from(bo + 'HH', buf, pos + offset)
+        if bType == 1000:
+            return 2 ** struct.unpack_from('B', buf, pos + offset + 6)[0]
+
+        if bNext and bNext <= offset:
+            raise ValueError('Loop in the chain of blockettes at byte %d' % pos)
+        offset = bNext
+
+    raise ValueError('Blockette 1000 not found in record at byte %d' % pos)
+
+
+def _samplingRate(factor, multiplier):
+    """Return the sampling rate in Hz from the fields of the fixed header."""
+    if not factor or not multiplier:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    if factor > 0:
+        return -float(factor) / multiplier
+    if multiplier > 0:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+def recordHeader(buf, pos=0):
+    """Return the stream and time span of the record starting at ``pos``.
+
+    :param buf: Buffer with the data
+    :type buf: bytearray
+    :param pos: Position where the record starts
+    :type pos: int
+    :returns: Network, station, location, channel, start and end time (time
+        of the last sample) of the record
+    :rtype: tuple
+    """
+    bo = _byteorder(buf, pos)
+    sta, loc, cha, net = struct.unpack_from('5s2s3s2s', buf, pos + 8)
+    (year, doy, hour, minute, sec, unused, frac, nsamp, factor, multiplier,
+     act, io, dq, nblk, corr) = struct.unpack_from(bo + 'HHBBBBHHhhBBBBi',
+                                                   buf, pos + 20)
+
+    start = datetime.datetime(year, 1, 1) + \
+        datetime.timedelta(days=doy - 1, hours=hour, minutes=minute,
+                           seconds=sec, microseconds=frac * 100)
+    # Apply the time correction if it was not applied yet
+    if corr and not act & 0x02:
+        start += datetime.timedelta(microseconds=corr * 100)
+
+    rate = _samplingRate(factor, multiplier)
+    end = start
+    if rate and nsamp > 1:
+        end += datetime.timedelta(seconds=(nsamp - 1) / rate)
+
+    return (net.strip(' \x00'), sta.strip(' \x00'), loc.strip(' \x00'),
+            cha.strip(' \x00'), start, end)
+
+
+def filterRecords(buf, chunk, keep):
+    """Remove the records of a chunk for which ``keep(header)`` is False.
+
+    The records kept are moved to the start of ``buf``.
+
+    :param buf: Buffer where the chunk was read
+    :type buf: bytearray
+    :param chunk: Complete records read into ``buf``
+    :type chunk: memoryview
+    :param keep: Function called with the result of :func:`recordHeader`
+    :type keep: function
+    :returns: The records kept
+    :rtype: memoryview
+    """
+    size = 0
+    for pos, reclen in iterOffsets(chunk):
+        if not keep(recordHeader(chunk, pos)):
+            continue
+        # Move the record to fill the space of the discarded ones
+        if pos != size:
+            buf[size:size + reclen] = buf[pos:pos + reclen]
+        size += reclen
+    return memoryview(buf)[:size]
+
+
+def iterOffsets(buf, size=None):
+    """Iterate over the position and length of the records in ``buf``.
+
+    Only complete records are considered.
+    """
+    size = len(buf) if size is None else size
+    pos = 0
+    while pos < size:
+        reclen = recordLength(buf, pos, size)
+        if reclen is None or pos + reclen > size:
+            return
+        yield pos, reclen
+        pos += reclen
+
+
+def alignedLength(buf, size=None):
+    """Return the length of the complete records at the start of ``buf``."""
+    size = len(buf) if size is None else size
+    pos = 0
+    while pos < size:
+        reclen = recordLength(buf, pos, size)
+        if reclen is None or pos + reclen > size:
+            break
+        pos += reclen
+    return pos
+
+
+def readinto(fp, b):
+    """Read from ``fp`` into the writable buffer ``b``.
+
+    File-like objects without ``readinto`` (e.g. the responses of ``httplib``
+    in Python 2) are read with ``read`` and the data copied to ``b``.
+    """
+    if hasattr(fp, 'readinto'):
+        return fp.readinto(b)
+
+    data = fp.read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+
+class BufferPool(object):
+    """Set of reusable buffers shared by a producer and a consumer.
+
+    Buffers are allocated the first time they are needed and at most
+    ``count`` of them are created. A producer requesting a buffer when all
+    are in use waits until the consumer releases one.
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.created = 0
+        self.free = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def get(self, stop=None):
+        """Return a free buffer or None if ``stop`` is set while waiting."""
+        try:
+            return self.free.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.count:
+                self.created += 1
+                return bytearray(self.size)
+
+        while stop is None or not stop.is_set():
+            try:
+                return self.free.get(True, 1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def release(self, buf):
+        """Give a buffer back to the pool."""
+        self.free.put(buf)
+
+
+def iterRecords(fp, pool, stop=None):
+    """Read miniSEED data from ``fp`` in chunks of complete records.
+
+    Each chunk is returned as a tuple with the buffer taken from the pool and
+    a ``memoryview`` of the complete records read into it. The consumer must
+    give the buffer back with ``pool.release`` once the data was used. If the
+    data cannot be parsed as miniSEED it is returned as it is read.
+
+    :param fp: File-like object with the data
+    :type fp: file
+    :param pool: Pool of buffers where the data is read
+    :type pool: BufferPool
+    :param stop: Event to abandon the reading while waiting for a buffer
+    :type stop: threading.Event
+    """
+    log = logging.getLogger('mseed')
+    leftover = ''
+    aligned = True
+
+    while True:
+        buf = pool.get(stop)
+        if buf is None:
+            return
+
+        mv = memoryview(buf)
+        size = len(leftover)
+        mv[:size] = leftover
+
+        eof = False
+        while size < len(buf):
+            n = readinto(fp, mv[size:])
+            if not n:
+                eof = True
+                break
+            size += n
+
+        end = size
+        if aligned and not eof:
+            try:
+                end = alignedLength(buf, size)
+            except ValueError as e:
+                log.warning('Data cannot be aligned to records: %s' % e)
+                aligned = False
+
+            if not end:
+                log.warning('Record larger than the buffer. Data will not be aligned.')
+                aligned = False
+                end = size
+
+        # Keep the incomplete record before the buffer is given away
+        leftover = str(buf[end:size])
+
+        if end:
+            yield buf, mv[:end]
+        else:
+            pool.release(buf)
+
+        if eof:
+            return
@@ -20,6 +20,8 @@
 """
 
 import os
+import sys
+import subprocess
 import cherrypy
 import json
 import argparse
@@ -27,9 +29,34 @@ import logging
 import logging.config
 import ConfigParser as configparser
 import datetime
+import time
 import urllib2 as ul
+import threading
+import itertools
+import functools
+import Queue
 
 from cherrypy.process import plugins
+from httppool import ConnectionPool
+from planner import RequestPlanner
+from planner import UpstreamRequest
+from planner import splitTW
+from mseed import BufferPool
+from mseed import iterRecords
+from mseed import iterOffsets
+from mseed import filterRecords
+from wfcache import WaveformCache
+from coalesce import SingleFlight
+from health import HealthRegistry
+from health import endpoint
+from metrics import ServiceMetrics
+from routememo import RouteMemo
+from routeindex import RouteIndex
+from owndcupdate import buildRoutes
+from owndcupdate import compiledNames
+from owndcupdate import fragmentName
+from owndcupdate import routesOutdated
+from owndcupdate import synchroDCs
 from routing.routeutils.wsgicomm import WIError
 from routing.routeutils.wsgicomm import WIClientError
 from routing.routeutils.wsgicomm import WIContentError
@@ -37,7 +64,6 @@ from routing.routeutils.utils import Stream
 from routing.routeutils.utils import TW
 from routing.routeutils.utils import RoutingCache
 from routing.routeutils.utils import RoutingException
-from routing.routeutils.routing import applyFormat
 from routing.routeutils.routing import lsNSLC
 from routing.routeutils.utils import str2date
 
@@ -106,6 +132,41 @@ LOG_CONF = {
             'level': 'INFO' ,
             'propagate': False
         },
+        'ConnectionPool': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'mseed': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'WaveformCache': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'SingleFlight': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'HealthRegistry': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'RoutesWatcher': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
+        'RoutesUpdater': {
+            'handlers': ['owndclog'],
+            'level': 'INFO' ,
+            'propagate': False
+        },
         'ResultFile': {
             'handlers': ['owndclog'],
             'level': 'INFO' ,
@@ -135,20 +196,26 @@ LOG_CONF = {
 }
 
 class DSRequest(object):
-    """Define a Dataselect request as a file-like object"""
+    """Define a Dataselect request as a file-like object
+
+    The connection is borrowed from a :class:`ConnectionPool` and given back
+    to it when the request is closed, so that it can be kept alive and reused
+    by the next request to the same data centre.
+    """
 
-    def __init__(self, url):
+    def __init__(self, url, pool=None, data=None, deadline=None):
         self.url = url
+        self.data = data
+        self.deadline = deadline
+        self.pool = pool if pool is not None else ConnectionPool(maxPerHost=0)
         self.log = logging.getLogger('DSRequest')
 
     def __enter__(self):
-        req = ul.Request(self.url)
-
         # totalBytes = 0
         # httpErr = 0
         # Connect to the proper FDSN-WS
         try:
-            self.u = ul.urlopen(req)
+            self.u = self.pool.urlopen(self.url, self.data, deadline=self.deadline)
             self.log.debug('Connected to %s' % (self.url))
         except:
             raise
@@ -157,6 +224,27 @@ class DSRequest(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.u.close()
 
+    def setDeadline(self, deadline):
+        """Change the deadline of the request, also while it is being read."""
+        self.deadline = deadline
+        u = getattr(self, 'u', None)
+        if u is not None:
+            u.setDeadline(deadline)
+
+    def cancel(self):
+        """Abort the request, e.g. from another thread."""
+        self.deadline = time.time()
+        u = getattr(self, 'u', None)
+        if u is not None:
+            u.cancel()
+
+    def records(self, pool, stop=None):
+        """Iterate over the data in chunks of complete miniSEED records.
+
+        See :func:`mseed.iterRecords`.
+        """
+        return iterRecords(self.u, pool, stop)
+
     def read(self, blocks=0):
         # Read the data in blocks of predefined size
         blockSize = int(4096 * blocks)
@@ -179,11 +267,47 @@ class DSRequest(object):
 
 class ResultFile(object):
     """Define a class that is an iterable. We can start returning the file
-    before everything was retrieved from the sources."""
+    before everything was retrieved from the sources.
+
+    Up to ``threads`` sources are downloaded at the same time by a pool of
+    workers. The data of each source is read into its own set of reusable
+    buffers and returned in the same order as in ``urlList``.
+
+    ``urlList`` can be any iterable (e.g. a generator planning the requests).
+    It is consumed while the data is returned and at most ``lookahead``
+    sources ahead of the one being returned are started.
+
+    The chunks returned are ``memoryview`` objects with complete miniSEED
+    records. They are only valid until the next chunk is requested.
 
-    def __init__(self, urlList):
+    If a ``deadline`` (as in ``time.time()``) is given, all the sources still
+    being read are abandoned when it expires and the result ends there.
+
+    An ``observer`` can follow the progress of every source. It is called
+    from the worker threads with ``started(url)``, ``received(url, size)``
+    for every chunk and ``finished(url, status, size, records, ttfb,
+    duration)`` at the end of every attempt, where ``status`` is the HTTP
+    code (0 if the request failed without one). The records are not counted
+    if the observer has a false ``countRecords`` attribute."""
+
+    # Maximum number of buffers kept in memory for each source
+    maxBuffers = 100
+
+    # Number of times that a failed source is requested again
+    retries = 1
+
+    def __init__(self, urlList, threads=1, pool=None, cache=None,
+                 flights=None, health=None, deadline=None, observer=None):
         self.log = logging.getLogger('ResultFile')
         self.urlList = urlList
+        self.threads = max(1, threads)
+        self.lookahead = 2 * self.threads
+        self.pool = pool
+        self.cache = cache
+        self.flights = flights
+        self.health = health
+        self.deadline = deadline
+        self.observer = observer
         self.content_type = 'application/vnd.fdsn.mseed'
         now = datetime.datetime.now()
         nowStr = '%04d%02d%02d-%02d%02d%02d' % (now.year, now.month, now.day,
@@ -192,45 +316,264 @@ class ResultFile(object):
 
         self.filename = 'owndc-%s.mseed' % nowStr
 
+    def __put(self, out, item, stop):
+        """Wait for free space in the queue unless the result was abandoned."""
+        while not stop.is_set():
+            try:
+                out.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __notify(self, event, *args):
+        """Pass an event to the observer. Its errors do not affect the data."""
+        if self.observer is None:
+            return
+        try:
+            getattr(self.observer, event)(*args)
+        except Exception as e:
+            self.log.error('Error notifying %s! %s' % (event, e))
+
+    def __open(self, url):
+        """Return the source of the data, the writer to cache it and the
+        function to select the records to pass on (None to pass all).
+        """
+        writer = None
+        keep = None
+
+        # Shared requests take the latest deadline of all their readers
+        if isinstance(url, UpstreamRequest):
+            dsreq = DSRequest(url.geturl(), self.pool, url.data, self.deadline)
+            if url.trimmed():
+                keep = url.keep
+        elif isinstance(url, basestring):
+            dsreq = DSRequest(url, self.pool, deadline=self.deadline)
+        else:
+            # Local sources (e.g. cached data) behave like a DSRequest
+            dsreq = url
+            # Cached data which cannot be read is requested remotely
+            if hasattr(url, 'open') and getattr(url, 'request', None) is not None and \
+                    not url.open():
+                return self.__open(url.request)
+
+        if self.flights is not None and isinstance(dsreq, DSRequest):
+            # Share the data with identical requests in progress
+            fallback = functools.partial(DSRequest, dsreq.url, self.pool, dsreq.data, self.deadline)
+            dsreq = self.flights.source((dsreq.url, dsreq.data), dsreq, self, fallback)
+
+        # Only the request which actually downloads the data saves it
+        if self.cache is not None and isinstance(url, UpstreamRequest) and \
+                getattr(dsreq, 'driver', True):
+            writer = self.cache.writer(url.params)
+
+        return dsreq, writer, keep
+
+    def __get(self, out):
+        """Wait for the next item of a source unless the deadline expires."""
+        while True:
+            timeout = 1 if self.deadline is None else min(1, self.deadline - time.time())
+            if timeout <= 0:
+                return None
+            try:
+                return out.get(True, timeout)
+            except Queue.Empty:
+                pass
+
+    def __fetch(self, pos, url, out, stop):
+        """Download one source and pass its data to the consumer.
+
+        If the download fails before any data was received, it is retried up
+        to ``retries`` times. Client errors (HTTP 4xx) are never retried.
+        Sources whose service is not healthy are skipped.
+        """
+        blocks = 25
+        totalBytes = 0
+
+        service = None
+        if isinstance(url, UpstreamRequest):
+            service = url.url
+        elif isinstance(url, basestring):
+            service = endpoint(url)
+
+        for attempt in range(self.retries + 1):
+            if self.health is not None and service is not None and \
+                    not self.health.allow(service):
+                self.log.warning('Skipping %s. Service is not available.' % url)
+                self.__notify('started', url)
+                self.__notify('finished', url, 503, 0, 0, None, 0.0)
+                break
+
+            complete = False
+            failed = False
+            expired = False
+            status = 0
+            attemptBytes = 0
+            attemptRecords = 0
+            dsreq, writer, keep = self.__open(url)
+            start = time.time()
+            latency = None
+            self.__notify('started', url)
+
+            self.log.debug('%s - Connecting %s' % (pos, url))
+            try:
+                # Connect to the proper FDSN-WS
+                with dsreq as dsr:
+                    # Read the data in blocks of predefined size
+                    bufPool = BufferPool(self.maxBuffers, 4096 * blocks)
+                    for buf, chunk in dsr.records(bufPool, stop):
+                        if latency is None:
+                            latency = time.time() - start
+                        totalBytes += len(chunk)
+                        attemptBytes += len(chunk)
+                        if self.observer is not None:
+                            if getattr(self.observer, 'countRecords', True):
+                                attemptRecords += len(list(iterOffsets(chunk)))
+                            self.__notify('received', url, len(chunk))
+                        # Save the data before the buffer is given to the consumer
+                        if writer is not None:
+                            writer.write(chunk)
+                        # Records of a split time window which belong to another part
+                        if keep is not None:
+                            chunk = filterRecords(buf, chunk, keep)
+                            if not len(chunk):
+                                bufPool.release(buf)
+                                continue
+                        if not self.__put(out, (bufPool, buf, chunk), stop):
+                            break
+                        self.log.debug('%s - %s bytes from %s' %
+                                       (pos, totalBytes, url))
+                    complete = not stop.is_set()
+                    if complete:
+                        status = 200 if attemptBytes else 204
+            except ul.HTTPError as e:
+                self.log.error('Error reading data from %s! %s' % (url, e))
+                status = e.code
+                failed = e.code >= 500
+                if not failed:
+                    complete = True
+            except Exception as e:
+                self.log.error('Error reading data from %s! %s' % (url, e))
+                # The deadline of the client is not a failure of the service
+                expired = self.deadline is not None and time.time() >= self.deadline
+                failed = not expired
+            finally:
+                if writer is not None:
+                    if complete and not failed:
+                        writer.commit()
+                    else:
+                        writer.discard()
+                self.__notify('finished', url, status, attemptBytes,
+                              attemptRecords, latency, time.time() - start)
+
+            # Only the request which actually downloads the data is counted
+            if self.health is not None and service is not None and \
+                    getattr(dsreq, 'driver', True):
+                if latency is None:
+                    latency = time.time() - start
+                if failed:
+                    self.health.failure(service, latency)
+                elif expired:
+                    self.health.expired(service)
+                elif complete:
+                    self.health.success(service, latency)
+
+            if not failed or totalBytes or stop.is_set():
+                break
+
+        # Signal the end of this source
+        self.__put(out, None, stop)
+
+    def __dispatch(self, jobs, outputs, stop):
+        """Take the sources from ``urlList`` and pass them to the workers.
+
+        The queue of every source is added to ``outputs`` in order. None is
+        added to ``outputs`` and to ``jobs`` when there are no more sources.
+        """
+        try:
+            for pos, url in enumerate(self.urlList):
+                # The size of the queue is limited by the buffers of the source
+                out = Queue.Queue()
+                if not self.__put(outputs, out, stop):
+                    return
+                jobs.put((pos, url, out))
+        except Exception as e:
+            self.log.error('Error planning the requests! %s' % e)
+        finally:
+            for i in range(self.threads):
+                jobs.put(None)
+            self.__put(outputs, None, stop)
+
+    def __worker(self, jobs, stop):
+        """Take sources from the queue of jobs until the last one."""
+        while not stop.is_set():
+            try:
+                job = jobs.get(True, 1)
+            except Queue.Empty:
+                continue
+            if job is None:
+                return
+            pos, url, out = job
+            self.__fetch(pos, url, out, stop)
+
     def __iter__(self):
         """
         Read a maximum of 25 blocks of 4k (or 200 of 512b) each time.
-        This will allow us to use threads and multiplex records from
-        different sources.
+        The sources are fetched by a pool of threads, while the records are
+        returned in the order of the sources.
         """
 
-        blocks = 25
-        status = ''
-
-        for pos, url in enumerate(self.urlList):
-            # Prepare Request
-            self.log.debug('%s/%s - Connecting %s' % (pos, len(self.urlList), url))
-            totalBytes = 0
-            httpErr = 0
-            # Connect to the proper FDSN-WS
-            with DSRequest(url) as dsr:
-                # Read the data in blocks of predefined size
-                try:
-                    buffer = dsr.read(blocks)
-                except:
-                    self.log.error('Error reading data from %s!' % url)
-
-                while len(buffer):
-                    totalBytes += len(buffer)
+        stop = threading.Event()
+        jobs = Queue.Queue()
+        # Queues of the sources started in the order they must be returned
+        outputs = Queue.Queue(self.lookahead)
+
+        dispatcher = threading.Thread(target=self.__dispatch,
+                                      args=(jobs, outputs, stop))
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.__worker, args=(jobs, stop))
+            worker.daemon = True
+            worker.start()
+
+        try:
+            while True:
+                out = self.__get(outputs)
+                if out is None:
+                    break
+
+                item = self.__get(out)
+                while item is not None:
+                    bufPool, buf, chunk = item
                     # Return one block of data
-                    yield buffer
-                    try:
-                        buffer = dsr.read(blocks)
-                    except:
-                        self.log.error('Error reading data from %s!' % url)
-                    self.log.debug('%s/%s - %s bytes from %s' %
-                                   (pos, len(self.urlList), totalBytes, url))
+                    yield chunk
+                    # The buffer can be reused once the chunk was sent
+                    bufPool.release(buf)
+                    item = self.__get(out)
+
+                if self.deadline is not None and time.time() >= self.deadline:
+                    break
+
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.log.warning('Deadline expired. Remaining sources are abandoned.')
+        finally:
+            # Release the workers if the client stopped reading
+            stop.set()
+            if self.pool is not None:
+                self.log.debug('Connection pool: %s' % self.pool.stats())
 
-        raise StopIteration
 
 class DataSelectQuery(object):
+    """Resolve and execute the Dataselect queries.
+
+    If ``background`` is True, the routing table is loaded in a separate
+    thread and the object can be used as soon as :attr:`ready` is set.
+    """
+
     def __init__(self, routesFile=None, masterFile=None,
-                 configFile=None):
+                 configFile=None, background=False):
         self.log = logging.getLogger('DataSelectQuery')
         if routesFile is None:
             routesFile = os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-routes.xml')
@@ -241,65 +584,398 @@ class DataSelectQuery(object):
         if configFile is None:
             configFile = os.path.join(os.path.expanduser('~'), '.owndc', 'owndc.cfg')
 
+        # Files needed to build the routing table again
+        self.routesFile = routesFile
+        self.masterFile = masterFile
+        self.configFile = configFile
+        self.reloadLock = threading.Lock()
+        self.loadedMTimes = None
+        # Set if the routing table could not be loaded in the background
+        self.loadFailed = False
+        # Set once a routing table is available
+        self.ready = threading.Event()
+
         # Dataselect version
         self.version = '1.1.0'
 
-        self.log.debug('Creating Routing Cache.')
-        self.routes = RoutingCache(routesFile, masterFile, configFile)
+        config = configparser.RawConfigParser()
+        config.read(configFile)
+
+        # Number of sources downloaded in parallel
+        self.threads = config.getint('Service', 'threads') if config.has_option('Service', 'threads') else 4
+
+        # Persistent connections to the data centres
+        maxPerHost = config.getint('Service', 'connectionsPerHost') if config.has_option('Service', 'connectionsPerHost') else 8
+        idleTimeout = config.getint('Service', 'idleTimeout') if config.has_option('Service', 'idleTimeout') else 30
+        connectTimeout = config.getfloat('Service', 'connectTimeout') if config.has_option('Service', 'connectTimeout') else 10
+        firstByteTimeout = config.getfloat('Service', 'firstByteTimeout') if config.has_option('Service', 'firstByteTimeout') else 120
+        readTimeout = config.getfloat('Service', 'readTimeout') if config.has_option('Service', 'readTimeout') else 60
+        connectionWait = config.getfloat('Service', 'connectionWait') if config.has_option('Service', 'connectionWait') else 2
+        self.pool = ConnectionPool(maxPerHost, idleTimeout, connectTimeout,
+                                   firstByteTimeout, readTimeout, connectionWait)
+
+        # Maximum time in seconds to answer a request. No limit if 0.
+        self.requestDeadline = config.getfloat('Service', 'requestDeadline') if config.has_option('Service', 'requestDeadline') else 0
+
+        # Maximum number of lines in the POST requests to the data centres
+        self.postLines = config.getint('Service', 'postLines') if config.has_option('Service', 'postLines') else 1000
+        # Seconds to wait for more lines to a data centre before sending them
+        postDelay = config.getfloat('Service', 'postDelay') if config.has_option('Service', 'postDelay') else 1
+        self.postDelay = postDelay if postDelay > 0 else None
+
+        # Long time windows are requested in parts of this size (in seconds)
+        self.splitWindow = config.getint('Service', 'splitWindow') if config.has_option('Service', 'splitWindow') else 0
+
+        # Local cache of waveforms (size in MB). Disabled if size is 0.
+        cacheSize = config.getint('Service', 'cacheSize') if config.has_option('Service', 'cacheSize') else 0
+        # Segments of recent data are requested again after cacheTTL seconds
+        cacheRecentAge = config.getint('Service', 'cacheRecentAge') if config.has_option('Service', 'cacheRecentAge') else 7 * 86400
+        cacheTTL = config.getint('Service', 'cacheTTL') if config.has_option('Service', 'cacheTTL') else 86400
+        self.cache = WaveformCache(maxSize=cacheSize * 1024 * 1024, recentAge=cacheRecentAge,
+                                   ttl=cacheTTL) if cacheSize > 0 else None
+
+        # Share the data of identical requests in progress. Disabled by default
+        # because every shared chunk is copied once per reader.
+        coalesce = config.getboolean('Service', 'coalesce') if config.has_option('Service', 'coalesce') else False
+        self.flights = SingleFlight(ResultFile.maxBuffers) if coalesce else None
+
+        # Circuit breaker for the data centres which are failing
+        threshold = config.getint('Service', 'failureThreshold') if config.has_option('Service', 'failureThreshold') else 5
+        cooldown = config.getint('Service', 'cooldown') if config.has_option('Service', 'cooldown') else 60
+        self.health = HealthRegistry(threshold, cooldown)
+
+        # Metrics of the requests exported in /metrics
+        self.metrics = ServiceMetrics()
+
+        # Use the compiled route index written by owndcupdate if present
+        self.routeIndex = config.getboolean('Service', 'routeIndex') if config.has_option('Service', 'routeIndex') else True
+        # Data centres whose routes are merged in the index
+        synchroList = config.get('Service', 'synchronize') if config.has_option('Service', 'synchronize') else ''
+        self.synchroDCs = [dcid for dcid, url in synchroDCs(synchroList)]
+        # Overlapping routes kept when the index is built again
+        self.allowOverlaps = config.getboolean('Service', 'allowoverlap') if config.has_option('Service', 'allowoverlap') else False
+
+        # Remember the routes resolved (number of results). Disabled if 0.
+        routeMemo = config.getint('Service', 'routeMemo') if config.has_option('Service', 'routeMemo') else 10000
+        routeBucket = config.getint('Service', 'routeBucket') if config.has_option('Service', 'routeBucket') else 86400
+        self.memo = RouteMemo(None, routeMemo, routeBucket) if routeMemo > 0 else None
+
+        # Networks whose data centres are kept connected
+        warmNetworks = config.get('Service', 'warmNetworks') if config.has_option('Service', 'warmNetworks') else ''
+        self.warmNetworks = [n.strip().upper() for n in warmNetworks.split(',') if len(n.strip())]
+
+        self.routes = None
+        if background:
+            self.log.debug('Creating Routing Cache in the background.')
+            loader = threading.Thread(target=self.warmUp)
+            loader.daemon = True
+            loader.start()
+        else:
+            self.log.debug('Creating Routing Cache.')
+            self.__updateIndex()
+            mtimes = self.routesMTimes()
+            self.__setRoutes(self.__loadRoutes(), mtimes)
 
         self.ID = str(datetime.datetime.now())
 
-    def makeQueryPOST(self, lines):
-        self.log.debug('Query with POST method and body:\n%s' % lines)
-        urlList = []
-        for line in lines.split('\n'):
-            # Skip empty lines
-            if not len(line):
-                continue
+    def __indexSources(self):
+        """Return the files from which the route index is built.
+
+        The configuration is not included. Changes unrelated to the routes
+        must not trigger a build of the index while requests are waiting.
+        """
+        return [self.routesFile, self.masterFile] + \
+            [fragmentName(dcid) for dcid in self.synchroDCs]
+
+    def __updateIndex(self):
+        """Build the route index again if it is older than its sources.
+
+        Nothing is done if there is no index, as the routes are then read
+        with a RoutingCache.
+        """
+        routesFile = os.path.abspath(self.routesFile)
+        if not self.routeIndex or not os.path.exists(compiledNames(routesFile)[1]) or \
+                not routesOutdated(routesFile, self.__indexSources()):
+            return
+
+        self.log.warning('Route index of %s is outdated. Building it again.' % routesFile)
+        try:
+            buildRoutes(routesFile, self.synchroDCs, self.allowOverlaps,
+                        masterFile=self.masterFile)
+        except Exception as e:
+            self.log.error('Route index could not be built! %s' % e)
+
+    def __loadRoutes(self):
+        """Return the routing table from the compiled index or a RoutingCache.
 
+        The index is only used if it is newer than all its sources.
+        """
+        routesFile = os.path.abspath(self.routesFile)
+        index = compiledNames(routesFile)[1]
+        if self.routeIndex and os.path.exists(index):
             try:
-                net, sta, loc, cha, start, endt = line.split(' ')
-            except:
-                self.log.error('Cannot parse line: %s' % line)
-                continue
+                if not routesOutdated(routesFile, self.__indexSources()):
+                    routes = RouteIndex(index)
+                    self.log.info('Routes read from index %s' % index)
+                    return routes
+                self.log.warning('Route index %s is outdated' % index)
+            except Exception as e:
+                self.log.warning('Route index %s could not be read! %s' % (index, e))
+
+        return RoutingCache(self.routesFile, self.masterFile, self.configFile)
+
+    def routesFiles(self):
+        """Return the files from which the routing table is built."""
+        return [self.routesFile, '%s.bin' % self.routesFile,
+                '%s.idx' % self.routesFile, self.masterFile]
+
+    def routesMTimes(self):
+        """Return the modification time of the routing files."""
+        result = list()
+        for f in self.routesFiles():
+            try:
+                result.append(os.path.getmtime(f))
+            except OSError:
+                result.append(None)
+        return result
+
+    def reload(self):
+        """Build a new routing table from its files and use it from now on.
 
-            # Empty location
-            if loc == '--':
-                loc = ''
+        Requests already being planned keep using the previous table.
 
+        :returns: True if the routing table was replaced
+        :rtype: bool
+        """
+        with self.reloadLock:
+            self.log.info('Reloading the routing table.')
+            self.__updateIndex()
+            mtimes = self.routesMTimes()
             try:
-                start = str2date(start)
-            except:
-                self.log.error('Cannot convert "starttime" parameter (%s).'
-                               % start)
-                continue
+                routes = self.__loadRoutes()
+            except Exception as e:
+                self.log.error('Routing table could not be reloaded! %s' % e)
+                return False
+
+            self.__setRoutes(routes, mtimes)
+            self.log.info('Routing table reloaded.')
+            return True
+
+    def __setRoutes(self, routes, mtimes):
+        self.routes = routes
+        # Modification time of the routing files used
+        self.loadedMTimes = mtimes
+        if self.memo is not None:
+            self.memo.invalidate(routes)
+        self.ready.set()
+
+    def warmUp(self):
+        """Load the routing table and connect to the most common data centres.
+
+        Connections to the data centres of the networks in ``warmNetworks``
+        are opened in advance and kept open by ``pool.refresh``. The routes
+        are not added to the memo, as its keys depend on the streams and
+        time windows of the requests.
+        """
+        self.loadFailed = not self.reload()
+        if self.loadFailed:
+            return
 
+        urls = set()
+        for net in self.warmNetworks:
             try:
-                endt = str2date(endt)
-            except:
-                self.log.error('Cannot convert "endtime" parameter (%s).'
-                               % endt)
+                fdsnws = self.routes.getRoute(Stream(net, '*', '*', '*'), TW(None, None))
+            except RoutingException:
+                self.log.warning('No route found for network %s' % net)
                 continue
+            urls.update([dc['url'] for dc in fdsnws])
 
+        for url in urls:
             try:
-                st = Stream(net, sta, loc, cha)
-                tw = TW(start, endt)
-                self.log.debug('Retrieve routes for %s %s' % (st, tw))
-                fdsnws = self.routes.getRoute(st, tw, 'dataselect')
-                urlList.extend(applyFormat(fdsnws, 'get').splitlines())
+                self.pool.connect(url, keep=True)
+            except Exception as e:
+                self.log.warning('Cannot connect to %s! %s' % (url, e))
+
+        self.log.info('Warm-up finished: %d networks, %d data centres' %
+                      (len(self.warmNetworks), len(urls)))
 
+    def getRoute(self, st, tw, routes=None):
+        """Return the Dataselect routes of a stream, from the memo if possible.
+
+        :param routes: Routing table to use. The current one if None.
+        :type routes: RoutingCache
+        :raise: RoutingException if no route was found
+        """
+        if routes is None:
+            routes = self.routes
+        start = time.time()
+        try:
+            if self.memo is not None:
+                return self.memo.getRoute(st, tw, 'dataselect', routes)
+            return routes.getRoute(st, tw, 'dataselect')
+        finally:
+            self.metrics.routeLookup.observe(time.time() - start)
+
+    def findRoutes(self, st, start, endt, routes=None):
+        """Return the routes of a stream for every part of its time window.
+
+        Long time windows are split in parts of ``splitWindow`` seconds and
+        the routes of each part are resolved independently. The parameters
+        which start or end at the limit between two parts are marked (see
+        ``UpstreamRequest``), so that the records crossing it are only
+        returned once.
+
+        :param routes: Routing table to use. The current one if None.
+        :type routes: RoutingCache
+        :returns: Number of the part and its routes (see ``getRoute``)
+        :rtype: list of tuples
+        :raise: RoutingException if no route was found for any part
+        """
+        result = list()
+        parts = list(splitTW(start, endt, self.splitWindow))
+        for part, (s, e) in enumerate(parts):
+            try:
+                fdsnws = self.getRoute(st, TW(s, e), routes)
+            except RoutingException:
+                continue
+
+            if len(parts) > 1:
+                # The routes may be shared with the memo. They are copied.
+                lower = s if part > 0 else None
+                upper = e if part < len(parts) - 1 else None
+                fdsnws = [dict(dc, params=[self.__trim(item, lower, upper)
+                                           for item in dc['params']])
+                          for dc in fdsnws]
+            result.append((part, fdsnws))
+
+        if not len(result):
+            raise RoutingException('No route found for %s' % str(st))
+        return result
+
+    @staticmethod
+    def __trim(item, lower, upper):
+        """Return the parameters with the limits of the records of their part."""
+        lower = lower if lower is not None and item['start'] <= lower else None
+        upper = upper if upper is not None and item['end'] >= upper else None
+        if lower is None and upper is None:
+            return item
+        return dict(item, trim=(lower, upper))
+
+    def __plan(self, streams, routes):
+        """Yield the requests for the streams as soon as they are planned.
+
+        :param streams: Streams and time windows requested
+        :type streams: iterable of (Stream, start, end)
+        :param routes: Routing table used for the whole request
+        :type routes: RoutingCache
+        :rtype: generator
+        """
+        planner = RequestPlanner(self.postLines, self.cache, self.postDelay)
+        for st, start, endt in streams:
+            try:
+                self.log.debug('Retrieve routes for %s %s' % (st, TW(start, endt)))
+                for part, fdsnws in self.findRoutes(st, start, endt, routes):
+                    planner.add(fdsnws, part)
             except RoutingException:
-                self.log.warning('No route could be found for %s' % line)
+                self.log.debug('No route could be found for %s %s' % (st, TW(start, endt)))
                 continue
 
-        if not len(urlList):
+            for req in planner.ready():
+                yield req
+
+        for req in planner.requests():
+            yield req
+
+        if self.memo is not None:
+            self.log.debug('Route memo: %s' % self.memo.stats())
+
+    def __resultFile(self, streams, deadline, observer=None):
+        """Return the data of the streams while the requests are planned.
+
+        :raise: WIContentError if no route was found
+        """
+        # A reload of the routing table does not affect this request
+        urlList = self.__plan(streams, self.routes)
+
+        # Check that there is at least one request before answering. The
+        # first group waits at most postDelay seconds for more lines.
+        first = next(urlList, None)
+        if first is None:
             self.log.debug('No routes found!')
             raise WIContentError('No routes have been found!')
 
-        iterObj = ResultFile(urlList)
-        return iterObj
+        return self.makeQueryPlan(itertools.chain([first], urlList), deadline, observer)
+
+    def makeQueryPlan(self, requests, deadline=None, observer=None):
+        """Return the data of requests already planned (see ``RequestPlanner``).
+
+        :param requests: Requests to the data centres and cached segments
+        :type requests: iterable
+        :rtype: ResultFile
+        """
+        return ResultFile(requests, self.threads, self.pool, self.cache,
+                          self.flights, self.health, deadline,
+                          observer if observer is not None else self.metrics)
+
+    def parseLine(self, line):
+        """Return the stream and time window of a line of a POST request.
+
+        :raise: ValueError if the line cannot be parsed
+        """
+        try:
+            net, sta, loc, cha, start, endt = line.strip().split(' ')
+        except:
+            raise ValueError('Cannot parse line: %s' % line)
+
+        # Empty location
+        if loc == '--':
+            loc = ''
+
+        try:
+            start = str2date(start)
+        except:
+            raise ValueError('Cannot convert "starttime" parameter (%s).' % start)
 
-    def makeQueryGET(self, parameters):
+        try:
+            endt = str2date(endt)
+        except:
+            raise ValueError('Cannot convert "endtime" parameter (%s).' % endt)
+
+        return Stream(net, sta, loc, cha), start, endt
+
+    def __parsePOST(self, lines):
+        """Yield the streams and time windows of the body of a POST request.
+
+        ``lines`` can be the whole body or any iterable of lines (e.g. a
+        file), which is read while the streams are routed.
+        """
+        if isinstance(lines, basestring):
+            lines = lines.split('\n')
+
+        for line in lines:
+            # Skip empty lines
+            if not len(line.strip()):
+                continue
+
+            try:
+                yield self.parseLine(line)
+            except ValueError as e:
+                self.log.error(str(e))
+
+    def deadline(self):
+        """Return the deadline for a request starting now or None."""
+        if self.requestDeadline:
+            return time.time() + self.requestDeadline
+        return None
+
+    def makeQueryPOST(self, lines, deadline=None, observer=None):
+        if isinstance(lines, basestring):
+            self.log.debug('Query with POST method and body:\n%s' % lines)
+        else:
+            self.log.debug('Query with POST method and body read from %s' % lines)
+        return self.__resultFile(self.__parsePOST(lines), deadline, observer)
+
+    def makeQueryGET(self, parameters, deadline=None, observer=None):
         # List all the accepted parameters
         allowedParams = ['net', 'network',
                          'sta', 'station',
@@ -386,24 +1062,110 @@ class DataSelectQuery(object):
             self.log.error('Error while converting endtime parameter.')
             raise WIClientError('Error while converting endtime parameter.')
 
-        urlList = []
+        streams = ((Stream(n, s, l, c), start, endt)
+                   for (n, s, l, c) in lsNSLC(net, sta, loc, cha))
+        return self.__resultFile(streams, deadline, observer)
+
+
+class RoutesWatcher(plugins.Monitor):
+    """Reload the routing table when its files change.
+
+    The files are checked every ``frequency`` seconds and the table is
+    reloaded once they did not change between two checks (i.e. they are not
+    being written). The table is also reloaded when the engine receives the
+    ``graceful`` signal (e.g. with SIGUSR1). If the first load in the
+    background failed, it is tried again in every check.
+    """
+
+    def __init__(self, bus, dsq, frequency=60):
+        plugins.Monitor.__init__(self, bus, self.check, frequency, 'RoutesWatcher')
+        self.log = logging.getLogger('RoutesWatcher')
+        self.dsq = dsq
+        self.last = dsq.routesMTimes()
+
+    def check(self):
+        mtimes = self.dsq.routesMTimes()
+        if self.dsq.loadedMTimes is None:
+            # Nothing to do while the first load is still in progress
+            if self.dsq.loadFailed:
+                self.log.info('Loading the routing table again.')
+                self.dsq.warmUp()
+        elif mtimes != self.dsq.loadedMTimes and mtimes == self.last:
+            self.log.info('Routing files changed.')
+            self.dsq.reload()
+        self.last = mtimes
+
+    def graceful(self):
+        """Reload the routing table in the background."""
+        self.log.info('Reload of the routing table requested.')
+        reloader = threading.Thread(target=self.dsq.reload)
+        reloader.daemon = True
+        reloader.start()
+        plugins.Monitor.graceful(self)
+
+
+class RoutesUpdater(plugins.Monitor):
+    """Update the routing table every day at the given times.
+
+    The routes are merged by owndcupdate in a separate process, so that the
+    memory needed is released afterwards. Then, the new routing table is
+    loaded and replaces the current one without interrupting the requests
+    in progress.
+
+    :param times: Times of the day to update the routes (e.g. ['03:00'])
+    :type times: list
+    """
+
+    def __init__(self, bus, dsq, times, frequency=30):
+        plugins.Monitor.__init__(self, bus, self.check, frequency, 'RoutesUpdater')
+        self.log = logging.getLogger('RoutesUpdater')
+        self.dsq = dsq
+        self.times = sorted([datetime.datetime.strptime(t, '%H:%M').strftime('%H:%M')
+                             for t in times])
+        self.running = threading.Lock()
+        # Times already past today are not run until tomorrow
+        now = datetime.datetime.now()
+        self.lastRun = dict([(t, now.date()) for t in self.times
+                             if t <= now.strftime('%H:%M')])
+
+    def check(self):
+        now = datetime.datetime.now()
+        pending = [t for t in self.times if t <= now.strftime('%H:%M') and
+                   self.lastRun.get(t) != now.date()]
+        if not len(pending):
+            return
 
-        for (n, s, l, c) in lsNSLC(net, sta, loc, cha):
-            try:
-                st = Stream(n, s, l, c)
-                tw = TW(start, endt)
-                fdsnws = self.routes.getRoute(st, tw, 'dataselect')
-                urlList.extend(applyFormat(fdsnws, 'get').splitlines())
+        # One update is enough for all the times past
+        for t in pending:
+            self.lastRun[t] = now.date()
+        self.update()
 
-            except RoutingException:
-                pass
+    def update(self):
+        """Start an update of the routes in the background."""
+        if not self.running.acquire(False):
+            self.log.warning('Previous update of the routes still running.')
+            return
 
-        if not len(urlList):
-            self.log.debug('No routes found!')
-            raise WIContentError('No routes have been found!')
+        updater = threading.Thread(target=self.__run)
+        updater.daemon = True
+        updater.start()
+
+    def __run(self):
+        try:
+            self.log.info('Updating the routing table.')
+            start = time.time()
+            here = os.path.dirname(os.path.abspath(__file__))
+            code = subprocess.call([sys.executable, os.path.join(here, 'owndcupdate.py')])
+            if code:
+                self.log.error('Update of the routes failed with code %d' % code)
+                return
 
-        iterObj = ResultFile(urlList)
-        return iterObj
+            self.log.info('Routes updated in %.1f seconds.' % (time.time() - start))
+            self.dsq.reload()
+        except Exception as e:
+            self.log.error('Update of the routes failed! %s' % e)
+        finally:
+            self.running.release()
 
 
 # Wrap parsed values in the GET method with this class to mimic FieldStorage
@@ -460,21 +1222,99 @@ class Application(object):
             cherrypy.response.headers['Content-Length'] = str(len(iterObj.encode('utf-8')))
         return iterObj.encode('utf-8')
 
+    @cherrypy.expose
+    def health(self):
+        """Return the health of the data centres as seen by this service.
+
+        :returns: State of the circuit breaker and statistics per service
+        :rtype: utf-8 encoded string with a JSON document
+        """
+        self.log.debug('Return health of the data centres.')
+        cherrypy.response.headers['Server'] = 'owndc/%s' % version
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        iterObj = json.dumps(dsq.health.status())
+        cherrypy.response.headers['Content-Length'] = str(len(iterObj.encode('utf-8')))
+        return iterObj.encode('utf-8')
+
+    @cherrypy.expose
+    def metrics(self):
+        """Return the metrics of the service in the Prometheus text format.
+
+        :returns: Requests, data sent, requests to the data centres and time
+            needed to resolve the routes
+        :rtype: utf-8 encoded string
+        """
+        cherrypy.response.headers['Server'] = 'owndc/%s' % version
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        iterObj = dsq.metrics.render()
+        cherrypy.response.headers['Content-Length'] = str(len(iterObj.encode('utf-8')))
+        return iterObj.encode('utf-8')
+
+    @cherrypy.expose
+    def ready(self):
+        """Return whether the service can answer queries.
+
+        :returns: 'OK' or 503 HTTP error code if the routing table is still
+            being loaded
+        :rtype: utf-8 encoded string
+        """
+        cherrypy.response.headers['Server'] = 'owndc/%s' % version
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        if not dsq.ready.is_set():
+            self.log.debug('Send 503 HTTP error code. Not ready yet.')
+            cherrypy.response.headers['Retry-After'] = '5'
+            raise cherrypy.HTTPError(503, 'Routing table is being loaded')
+        return 'OK'.encode('utf-8')
+
     @cherrypy.expose
     def query(self, **kwargs):
+        start = time.time()
+        method = cherrypy.request.method.upper()
+
         # Check that the query string is not longer than 2000 chars
         if len(cherrypy.request.query_string) > 2000:
             cherrypy.response.headers['Server'] = 'owndc/%s' % version
             cherrypy.response.status = 414
+            dsq.metrics.request(method, 414, time.time() - start)
             return
 
-        if cherrypy.request.method.upper() == 'GET':
-            return self.queryGET(**kwargs)
-        elif cherrypy.request.method.upper() == 'POST':
-            return self.queryPOST()
+        # No queries can be answered until the routing table is loaded
+        if not dsq.ready.is_set():
+            cherrypy.response.headers['Server'] = 'owndc/%s' % version
+            cherrypy.response.headers['Retry-After'] = '5'
+            dsq.metrics.request(method, 503, time.time() - start)
+            raise cherrypy.HTTPError(503, 'Routing table is being loaded')
+
+        # Every request must be answered before its deadline
+        deadline = dsq.deadline()
+
+        if method == 'GET':
+            return self.__measure(method, self.queryGET(kwargs, deadline), start)
+        elif method == 'POST':
+            return self.__measure(method, self.queryPOST(deadline), start)
         self.log.error('Request method is neither GET nor POST.')
 
-    def queryGET(self, **kwargs):
+    def __measure(self, method, result, start):
+        """Count the data sent and register the request once answered."""
+        status = 200
+        dsq.metrics.activeStreams.inc()
+        try:
+            for data in result:
+                dsq.metrics.bytesStreamed.inc(len(data))
+                yield data
+            status = cherrypy.response.status or 200
+        except cherrypy.HTTPError as e:
+            status = e.status
+            raise
+        except Exception:
+            status = 500
+            raise
+        finally:
+            dsq.metrics.activeStreams.dec()
+            dsq.metrics.request(method, str(status).split()[0],
+                                time.time() - start)
+
+    def queryGET(self, kwargs, deadline=None):
         self.log.debug('Query with GET method')
         cherrypy.response.headers['Server'] = 'owndc/%s' % version
 
@@ -482,7 +1322,7 @@ class Application(object):
             kwargs[k] = FakeStorage(v)
 
         try:
-            iterObj = dsq.makeQueryGET(kwargs)
+            iterObj = dsq.makeQueryGET(kwargs, deadline)
             # WARNING I need to check if data length == 0?
             # Cycle through the iterator in order to retrieve one chunk at a time
             loop = 0
@@ -501,7 +1341,7 @@ class Application(object):
                 loop += 1
                 # and send data
                 self.log.debug('Send chunk')
-                yield data
+                yield data.tobytes()
 
             if loop == 0:
                 self.log.debug('Send 204 HTTP error code')
@@ -523,7 +1363,7 @@ class Application(object):
 
     queryGET._cp_config = {'response.stream': True}
 
-    def queryPOST(self):
+    def queryPOST(self, deadline=None):
         self.log.debug('Query with POST method')
         cherrypy.response.headers['Server'] = 'owndc/%s' % version
 
@@ -535,7 +1375,7 @@ class Application(object):
         self.log.debug('Request body:\n%s' % lines)
 
         try:
-            iterObj = dsq.makeQueryPOST(lines)
+            iterObj = dsq.makeQueryPOST(lines, deadline)
             # WARNING I need to check if data length == 0?
             # Cycle through the iterator in order to retrieve one chunk at a time
             loop = 0
@@ -554,7 +1394,7 @@ class Application(object):
                 loop += 1
                 # and send data
                 self.log.debug('Send chunk')
-                yield data
+                yield data.tobytes()
 
             if loop == 0:
                 self.log.debug('Send 204 HTTP error code')
@@ -598,6 +1438,30 @@ def main():
     verboNum = getattr(logging, verbo.upper(), 30)
     LOG_CONF['loggers']['main']['level'] = verboNum
 
+    verbo = configP.get('Logging', 'DSRequest') if configP.has_option('Logging', 'DSRequest') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['DSRequest']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'ConnectionPool') if configP.has_option('Logging', 'ConnectionPool') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['ConnectionPool']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'mseed') if configP.has_option('Logging', 'mseed') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['mseed']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'WaveformCache') if configP.has_option('Logging', 'WaveformCache') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['WaveformCache']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'SingleFlight') if configP.has_option('Logging', 'SingleFlight') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['SingleFlight']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'HealthRegistry') if configP.has_option('Logging', 'HealthRegistry') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['HealthRegistry']['level'] = verboNum
+
     verbo = configP.get('Logging', 'ResultFile') if configP.has_option('Logging', 'ResultFile') else 'INFO'
     verboNum = getattr(logging, verbo.upper(), 30)
     LOG_CONF['loggers']['ResultFile']['level'] = verboNum
@@ -606,6 +1470,14 @@ def main():
     verboNum = getattr(logging, verbo.upper(), 30)
     LOG_CONF['loggers']['DataSelectQuery']['level'] = verboNum
 
+    verbo = configP.get('Logging', 'RoutesWatcher') if configP.has_option('Logging', 'RoutesWatcher') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['RoutesWatcher']['level'] = verboNum
+
+    verbo = configP.get('Logging', 'RoutesUpdater') if configP.has_option('Logging', 'RoutesUpdater') else 'INFO'
+    verboNum = getattr(logging, verbo.upper(), 30)
+    LOG_CONF['loggers']['RoutesUpdater']['level'] = verboNum
+
     verbo = configP.get('Logging', 'Application') if configP.has_option('Logging', 'Application') else 'INFO'
     verboNum = getattr(logging, verbo.upper(), 30)
     LOG_CONF['loggers']['Application']['level'] = verboNum
@@ -628,12 +1500,13 @@ def main():
         loclog.error('Error while interpreting port %s' % args.port)
         raise Exception('Error while interpreting port %s' % args.port)
 
-    # Create the object that will resolve and execute all the queries
-    loclog.info('Creating a DataSelectQuery object. Wait...')
+    # Create the object that will resolve and execute all the queries.
+    # The routing table is loaded while the server is already listening.
+    loclog.info('Creating a DataSelectQuery object.')
     global dsq
     dsq = DataSelectQuery(os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-routes.xml'),
                           os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'masterTable.xml'),
-                          args.config)
+                          args.config, background=True)
     loclog.info("Virtual Datacentre at: http://%s:%s/fdsnws/dataselect/1/" %
                 (host, port))
 
@@ -652,6 +1525,26 @@ def main():
     # TODO Pass all parameters to Application!
     cherrypy.tree.mount(Application(), '/fdsnws/dataselect/1')
 
+    # Save the index of the cache on shutdown
+    if dsq.cache is not None:
+        cherrypy.engine.subscribe('stop', dsq.cache.flush)
+
+    # Reload the routing table when it is updated (e.g. by owndcupdate)
+    routesCheck = configP.getint('Service', 'routesCheck') if configP.has_option('Service', 'routesCheck') else 60
+    RoutesWatcher(cherrypy.engine, dsq, routesCheck).subscribe()
+
+    # Keep the connections to the data centres of warmNetworks open
+    if len(dsq.warmNetworks) and dsq.pool.idleTimeout > 0:
+        refresh = max(1, dsq.pool.idleTimeout / 2)
+        plugins.Monitor(cherrypy.engine, functools.partial(dsq.pool.refresh, refresh),
+                        refresh, 'ConnectionRefresh').subscribe()
+
+    # Update the routes at the times configured
+    autoUpdate = configP.getboolean('Service', 'autoUpdate') if configP.has_option('Service', 'autoUpdate') else False
+    if autoUpdate:
+        updateTime = configP.get('Service', 'updateTime') if configP.has_option('Service', 'updateTime') else '03:00'
+        RoutesUpdater(cherrypy.engine, dsq, updateTime.split()).subscribe()
+
     plugins.Daemonizer(cherrypy.engine).subscribe()
     if hasattr(cherrypy.engine, 'signal_handler'):
         cherrypy.engine.signal_handler.subscribe()
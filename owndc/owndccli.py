@@ -1,94 +1,1052 @@
 #!/usr/bin/env python2
 
+import os
 import sys
+import csv
+import json
+import time
+import heapq
+import random
+import shutil
+import tempfile
 import argparse
+import datetime
+import threading
+from collections import OrderedDict
+from collections import namedtuple
+from fnmatch import fnmatch
 from urlparse import urlparse
-from urlparse import parse_qs
-from time import sleep
 import logging
 from owndc import DataSelectQuery
-from version import get_git_version
+from owndc import version
+from planner import RequestPlanner
+from planner import UpstreamRequest
+from mseed import FIXEDHEADER
+from mseed import BufferPool
+from mseed import filterRecords
+from mseed import iterOffsets
+from mseed import iterRecords
+from mseed import recordLength
+from mseed import recordHeader
+from routing.routeutils.utils import RoutingException
 
 
-class SummarizedRun(dict):
-    def __init__(self, tws=None):
-        self.mapCode = dict()
-        self.mapCode[0] = 'ERROR'
-        self.mapCode[200] = 'OK'
-        self.mapCode[400] = 'BAD REQUEST'
-        self.mapCode[500] = 'SERVER ERROR'
-        self.mapCode[204] = 'NODATA'
+def dataCentre(url):
+    """Return the name of the data centre serving a source."""
+    if isinstance(url, UpstreamRequest):
+        return urlparse(url.url).netloc
+    if isinstance(url, basestring):
+        return urlparse(url).netloc
+    # Data read from the local cache
+    return 'cache'
 
-        if tws is not None:
-            for line in tws.splitlines():
-                self[line] = list()
 
-    def __code2desc(self, httpCode):
+def size2str(size):
+    """Return a human readable size."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
+
+def secs2str(seconds):
+    """Return a duration as H:MM:SS."""
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class RequestLine(namedtuple('RequestLine', ['id', 'text'])):
+    """Line of the request identified by its position in the input."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return '#%d %s' % self
+
+
+class DownloadReport(object):
+    """Results of the requests for every line and statistics per data centre.
+
+    The results of a line are kept until :meth:`finish` is called. They are
+    then written to the report (``<output>.json`` or ``<output>.csv``) and
+    forgotten, so that only the statistics of the data centres are kept
+    until the end. They are added to the report by :meth:`close` (in
+    ``<output>.nodes.csv`` for CSV reports).
+    """
+
+    mapCode = {0: 'ERROR', 200: 'OK', 204: 'NODATA', 400: 'BAD REQUEST',
+               500: 'SERVER ERROR', 503: 'SERVICE UNAVAILABLE'}
+
+    fields = ['id', 'line', 'attempt', 'dc', 'status', 'bytes', 'records',
+              'ttfb', 'duration', 'throughput']
+    nodeFields = ['dc', 'requests', 'errors', 'nodata', 'bytes', 'records',
+                  'ttfb', 'duration', 'throughput']
+
+    def __init__(self, output=None, fmt='json'):
+        self.output = output
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        # Results of the lines not finished yet
+        self.results = dict()
+        self.attempts = dict()
+        # Statistics of every data centre
+        self.nodes = OrderedDict()
+        self.rows = 0
+
+        self.fh = None
+        if output is not None:
+            self.fh = open('%s.%s' % (output, fmt), 'w')
+            if fmt == 'csv':
+                self.writer = csv.DictWriter(self.fh, self.fields)
+                self.writer.writeheader()
+            else:
+                self.fh.write('{"lines": [\n')
+
+    def code2desc(self, httpCode):
         try:
             return self.mapCode[httpCode]
-        except:
+        except KeyError:
             return str(httpCode)
 
-    def __url2nslc(self, url):
-        params = parse_qs(urlparse(url).query)
-        # Extract NET
-        if 'net' in params:
-            net = params['net'][0]
-        elif 'network' in params:
-            net = params['network'][0]
-        else:
-            net = '*'
+    def start(self, line):
+        """Register a new attempt to download a line."""
+        with self.lock:
+            self.attempts[line] = self.attempts.get(line, 0) + 1
+            self.results.setdefault(line, list())
 
-        # Extract STA
-        if 'sta' in params:
-            sta = params['sta'][0]
-        elif 'station' in params:
-            sta = params['station'][0]
-        else:
-            sta = '*'
+    def add(self, line, dc, status, size, records=0, ttfb=None, duration=0.0,
+            count=True):
+        """Add the result of the requests for a line to a data centre.
 
-        # Extract LOC
-        if 'loc' in params:
-            loc = params['loc'][0]
-        elif 'location' in params:
-            loc = params['location'][0]
-        else:
-            loc = '*'
+        The request is also added to the statistics of the data centre
+        unless ``count`` is False, e.g. because it was shared by several
+        lines and is added with :meth:`request`.
+        """
+        row = OrderedDict([('id', line.id), ('line', line.text),
+                           ('attempt', self.attempts.get(line, 1)),
+                           ('dc', dc), ('status', status), ('bytes', size),
+                           ('records', records), ('ttfb', ttfb),
+                           ('duration', duration),
+                           ('throughput', size / duration if duration else None)])
+        with self.lock:
+            self.results.setdefault(line, list()).append(row)
+        if dc is not None and count:
+            self.request(dc, status, size, records, ttfb, duration)
 
-        # Extract CHA
-        if 'cha' in params:
-            cha = params['cha'][0]
-        elif 'channel' in params:
-            cha = params['channel'][0]
-        else:
-            cha = '*'
+    def request(self, dc, status, size, records=0, ttfb=None, duration=0.0):
+        """Add one request to the statistics of a data centre."""
+        with self.lock:
+            node = self.nodes.setdefault(dc, dict([(f, 0) for f in self.nodeFields[1:]] +
+                                                  [('answered', 0)]))
+            node['requests'] += 1
+            if status == 204:
+                node['nodata'] += 1
+            elif status != 200:
+                node['errors'] += 1
+            node['bytes'] += size
+            node['records'] += records
+            if ttfb is not None:
+                node['ttfb'] += ttfb
+                node['answered'] += 1
+            node['duration'] += duration
+
+    def finish(self, line):
+        """Write the results of a line which will not be requested again.
+
+        :returns: Results of all the requests for the line
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.results.pop(line, list())
+            self.attempts.pop(line, None)
+            if self.fh is not None:
+                for row in rows:
+                    if self.fmt == 'csv':
+                        self.writer.writerow(row)
+                    else:
+                        self.fh.write((',\n' if self.rows else '') + json.dumps(row))
+                    self.rows += 1
+                self.fh.flush()
+        return rows
+
+    def nodeStats(self):
+        """Return the aggregated statistics of every data centre."""
+        result = list()
+        with self.lock:
+            for dc, node in self.nodes.iteritems():
+                stats = OrderedDict([('dc', dc)] + [(f, node[f]) for f in self.nodeFields[1:]])
+                # Average time to the first byte
+                stats['ttfb'] = node['ttfb'] / node['answered'] if node['answered'] else None
+                stats['throughput'] = node['bytes'] / node['duration'] if node['duration'] else None
+                result.append(stats)
+        return result
 
-        # Extract START
-        if 'start' in params:
-            startt = params['start'][0]
-        elif 'starttime' in params:
-            startt = params['starttime'][0]
+    def close(self):
+        if self.fh is None:
+            return
+        nodes = self.nodeStats()
+        if self.fmt == 'csv':
+            with open('%s.nodes.csv' % self.output, 'w') as fout:
+                writer = csv.DictWriter(fout, self.nodeFields)
+                writer.writeheader()
+                for stats in nodes:
+                    writer.writerow(stats)
         else:
-            startt = '*'
+            self.fh.write('\n], "nodes": %s}\n' % json.dumps(nodes))
+        self.fh.close()
 
-        # Extract END
-        if 'end' in params:
-            endt = params['end'][0]
-        elif 'endtime' in params:
-            endt = params['endtime'][0]
+
+class Progress(object):
+    """Progress of the request lines and data centres being downloaded.
+
+    The methods are called from the threads fetching the lines. The status
+    is shown by :meth:`run` in a separate thread.
+    """
+
+    def __init__(self, lines=None, out=sys.stderr):
+        self.lock = threading.Lock()
+        self.out = out
+        self.start = time.time()
+        self.total = lines
+        self.done = 0
+        self.bytes = 0
+        # Bytes and start of the lines in progress
+        self.lines = OrderedDict()
+        # Bytes, start and active sources of every data centre
+        self.dcs = OrderedDict()
+        # Messages to show before the progress
+        self.messages = list()
+        self.shown = 0
+
+    def lineStarted(self, line):
+        with self.lock:
+            self.lines[line] = [0, time.time()]
+
+    def lineFinished(self, line):
+        with self.lock:
+            self.lines.pop(line, None)
+            self.done += 1
+
+    def lineRetried(self, line):
+        with self.lock:
+            if self.total is not None:
+                self.total += 1
+
+    def message(self, text):
+        with self.lock:
+            self.messages.append(text)
+
+    def sourceStarted(self, dc):
+        with self.lock:
+            self.dcs.setdefault(dc, [0, time.time(), 0])[2] += 1
+
+    def sourceFinished(self, dc):
+        with self.lock:
+            self.dcs[dc][2] -= 1
+
+    def received(self, line, dc, size):
+        with self.lock:
+            self.bytes += size
+            if line in self.lines:
+                self.lines[line][0] += size
+            self.dcs.setdefault(dc, [0, time.time(), 0])[0] += size
+
+    def lineReceived(self, line, size):
+        """Add data to a line which was already counted for its data centre."""
+        with self.lock:
+            if line in self.lines:
+                self.lines[line][0] += size
+
+    def eta(self):
+        """Estimate the time needed for the remaining lines."""
+        if not self.done or self.total is None:
+            return None
+        return (time.time() - self.start) / self.done * (self.total - self.done)
+
+    def status(self):
+        """Return the lines describing the current progress."""
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.start, 0.001)
+            result = ['%d/%s lines - %s (%s/s) - elapsed %s - ETA %s' %
+                      (self.done, self.total if self.total is not None else '?',
+                       size2str(self.bytes),
+                       size2str(self.bytes / elapsed), secs2str(elapsed),
+                       secs2str(self.eta()))]
+            for dc, (size, start, active) in self.dcs.iteritems():
+                result.append('  %-35s %10s %12s/s %3d active' %
+                              (dc, size2str(size),
+                               size2str(size / max(now - start, 0.001)), active))
+            for line, (size, start) in self.lines.iteritems():
+                result.append('  %-60s %10s %12s/s' %
+                              (line, size2str(size),
+                               size2str(size / max(now - start, 0.001))))
+        return result
+
+    def show(self, final=False):
+        """Print the progress over the previous one on a terminal."""
+        status = self.status()
+        with self.lock:
+            messages, self.messages = self.messages, list()
+        if self.out.isatty():
+            # Move to the beginning of the previous output and clear it
+            if self.shown:
+                self.out.write('\033[%dA' % self.shown)
+            self.out.write('\033[J' + ''.join([m + '\n' for m in messages]) +
+                           '\n'.join(status) + '\n')
+            self.shown = len(status)
         else:
-            endt = '*'
+            self.out.write(''.join([m + '\n' for m in messages]))
+            # Only the summary when the output is redirected
+            if final or not int(time.time() - self.start) % 10:
+                self.out.write(status[0] + '\n')
+        self.out.flush()
+
+    def run(self, stop, interval=1):
+        """Show the progress until ``stop`` is set."""
+        while not stop.wait(interval):
+            self.show()
+        self.show(final=True)
+
+
+def matches(item, net, sta, loc, cha, start, end):
+    """Check whether a record belongs to the parameters of a route."""
+    if isinstance(item.get('start'), datetime.datetime) and end < item['start']:
+        return False
+    if isinstance(item.get('end'), datetime.datetime) and start > item['end']:
+        return False
+    return fnmatch(net, item['net']) and fnmatch(sta, item['sta']) and \
+        fnmatch(loc, item['loc']) and fnmatch(cha, item['cha'])
+
+
+def owns(item, header):
+    """Check whether a record belongs to a route (and its part, if split)."""
+    net, sta, loc, cha, start, end = header
+    if not matches(item, net, sta, loc, cha, start, end):
+        return False
+    lower, upper = item.get('trim', (None, None))
+    return (lower is None or start >= lower) and (upper is None or start < upper)
+
+
+def overlaps(a, b):
+    """Check whether the parameters of two routes share a stream and time."""
+    if [a['net'], a['sta'], a['loc'], a['cha']] != [b['net'], b['sta'], b['loc'], b['cha']]:
+        return False
+    if isinstance(a.get('start'), datetime.datetime) and \
+            isinstance(b.get('end'), datetime.datetime) and a['start'] > b['end']:
+        return False
+    if isinstance(a.get('end'), datetime.datetime) and \
+            isinstance(b.get('start'), datetime.datetime) and a['end'] < b['start']:
+        return False
+    return True
+
+
+class LineState(object):
+    """Routes, data and results of one request line.
+
+    The state is kept while the line is retried, so that only the routes
+    which failed are requested again and the data of the other routes is
+    saved only once.
+    """
+
+    def __init__(self, line, routes, spool):
+        self.line = line
+        # Number of the part, URL of the service and parameters of the routes
+        # still to be requested
+        self.routes = routes
+        self.spool = spool
+        self.attempt()
+
+    def attempt(self):
+        """Forget the results of the previous attempt."""
+        # Data centre, status, TTFB, duration and routes of every request
+        self.requests = OrderedDict()
+        # Bytes and records received from every data centre
+        self.data = dict()
+
+    def sent(self, url):
+        """Return the position of the routes of the line included in a request."""
+        if isinstance(url, UpstreamRequest):
+            return [i for i, (part, u, item) in enumerate(self.routes)
+                    if u == url.url and any([overlaps(item, p) for p in url.params])]
+        # Cached segment
+        entry = dict(zip(('net', 'sta', 'loc', 'cha'), url.entry['stream']),
+                     start=url.start, end=url.end)
+        return [i for i, (part, u, item) in enumerate(self.routes)
+                if overlaps(item, entry)]
+
+    def finished(self, url, status, ttfb, duration):
+        """Register the last attempt of a request if it includes the line."""
+        routes = self.sent(url)
+        if len(routes):
+            self.requests[url] = (dataCentre(url), status, ttfb, duration, routes)
+
+    def write(self, dc, chunk, records):
+        self.spool.write(chunk)
+        data = self.data.setdefault(dc, [0, 0])
+        data[0] += len(chunk)
+        data[1] += records
+
+    def failed(self):
+        """Return the routes which must be requested again.
+
+        A route is done if all the requests including it succeeded. All the
+        routes of a line without data are requested again.
+        """
+        if not self.spool.size:
+            return list(self.routes)
+
+        done = set()
+        failed = set()
+        for dc, status, ttfb, duration, routes in self.requests.itervalues():
+            (done if status in (200, 204) else failed).update(routes)
+        return [r for i, r in enumerate(self.routes) if i not in done or i in failed]
+
+    def retry(self):
+        """Keep only the routes which must be requested again.
+
+        The records of these routes already received are discarded, as they
+        are requested again from the start.
+        """
+        routes = self.failed()
+        if self.spool.size and len(routes):
+            self.spool.discard(lambda header: any([owns(item, header)
+                                                   for part, url, item in routes]))
+        self.routes = routes
+
+    def status(self):
+        """Return the status of every data centre for the line.
+
+        A data centre failed if any of its requests failed. Otherwise, the
+        status depends on whether data for the line was received from it.
+        """
+        result = OrderedDict()
+        for dc, status, ttfb, duration, routes in self.requests.itervalues():
+            if result.get(dc) in (None, 200, 204):
+                result[dc] = status
+        for dc, status in result.items():
+            if status in (200, 204):
+                result[dc] = 200 if dc in self.data else 204
+        return result
+
+    def report(self, report):
+        """Add the results of every data centre to the report."""
+        status = self.status()
+        for dc in status:
+            times = [(t, d) for c, s, t, d, r in self.requests.itervalues() if c == dc]
+            ttfbs = [t for t, d in times if t is not None]
+            size, records = self.data.get(dc, (0, 0))
+            report.add(self.line, dc, status[dc], size, records,
+                       min(ttfbs) if len(ttfbs) else None,
+                       max([d for t, d in times]), count=False)
+
+    def close(self, output):
+        """Save the data of a line which will not be requested again."""
+        try:
+            if self.spool.size:
+                output.commit(self.line.text, self.spool)
+        finally:
+            self.spool.close()
+
+
+class BlockObserver(object):
+    """Follow the sources of a block of lines (see ``ResultFile``).
+
+    Every request is counted once for its data centre and its result is
+    given to all the lines whose routes were sent in it.
+    """
+
+    def __init__(self, states, progress, report):
+        self.states = states
+        self.progress = progress
+        self.report = report
+
+    def started(self, url):
+        self.progress.sourceStarted(dataCentre(url))
+
+    def received(self, url, size):
+        self.progress.received(None, dataCentre(url), size)
+
+    def finished(self, url, status, size, records, ttfb, duration):
+        self.progress.sourceFinished(dataCentre(url))
+        self.report.request(dataCentre(url), status, size, records, ttfb, duration)
+        for state in self.states:
+            state.finished(url, status, ttfb, duration)
+
+
+class BlockDemux(object):
+    """Assign the records of a block to the lines they were requested for.
+
+    A record belongs to every line with a route matching its stream whose
+    time window overlaps it. Data centres can return the records of
+    overlapping lines once per line, so these records are only written once.
+    """
+
+    def __init__(self, states, progress):
+        self.log = logging.getLogger('owndccli')
+        self.states = states
+        self.progress = progress
+        # Lines and data centres which could contain the data of every stream
+        self.streams = dict()
+        # Headers of the records written to more than one line
+        self.shared = set()
+
+    def __candidates(self, net, sta, loc, cha):
+        key = (net, sta, loc, cha)
+        if key not in self.streams:
+            self.streams[key] = [(state, dataCentre(u), item)
+                                 for state in self.states
+                                 for part, u, item in state.routes
+                                 if matches(item, net, sta, loc, cha, datetime.datetime.min,
+                                            datetime.datetime.max)]
+        return self.streams[key]
+
+    def owners(self, net, sta, loc, cha, start, end):
+        """Return the lines and data centres of a record."""
+        result = list()
+        for state, dc, item in self.__candidates(net, sta, loc, cha):
+            if any([s is state for s, d in result]):
+                continue
+            if matches(item, net, sta, loc, cha, start, end):
+                result.append((state, dc))
+        return tuple(result)
+
+    def write(self, chunk):
+        """Write consecutive records of the same lines together."""
+        first = 0
+        owners = None
+        records = 0
+        for pos, reclen in iterOffsets(chunk):
+            header = recordHeader(chunk, pos)
+            current = self.owners(*header)
+            if len(current) > 1:
+                # Already written to all its lines
+                if header in self.shared:
+                    current = None
+                else:
+                    self.shared.add(header)
+            if current != owners:
+                self.__flush(owners, chunk[first:pos], records)
+                owners, first, records = current, pos, 0
+            records += 1
+        self.__flush(owners, chunk[first:], records)
+
+    def __flush(self, owners, data, records):
+        if not records or owners is None:
+            return
+        if not len(owners):
+            self.log.warning('Discarding %d records not requested by any line' % records)
+            return
+        for state, dc in owners:
+            state.write(dc, data, records)
+            self.progress.lineReceived(state.line, len(data))
+
+
+class Journal(object):
+    """Persistent record of the request lines already saved in the output.
+
+    Every line completed is appended as a JSON object with the number of
+    bytes and records saved, the position of its last record and the size
+    of the output file after it was added.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.log = logging.getLogger('owndccli')
+        self.entries = OrderedDict()
+
+    def load(self):
+        """Read the lines completed in a previous run."""
+        self.entries = OrderedDict()
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname) as fin:
+            for jline in fin:
+                try:
+                    entry = json.loads(jline)
+                    self.entries[entry['line']] = entry
+                except Exception:
+                    # Probably the last entry was not completely written
+                    self.log.warning('Skipping invalid entry in %s: %s' %
+                                     (self.fname, jline.strip()))
+
+    def verify(self, fname):
+        """Check the output file against the journal.
 
-        return '%s %s %s %s %s %s' % (net, sta, loc, cha, startt, endt)
+        Data after the last line completed is removed. The lines whose
+        records are not found where expected are removed from the journal
+        (and the data after them from the file), so that they are requested
+        again.
 
-    def log(self, le, *args, **kwargs):
-        
+        :returns: Size of the verified output
+        :rtype: int
+        """
+        size = os.path.getsize(fname) if os.path.exists(fname) else 0
+        # Lines saved in an SDS archive cannot be checked
+        entries = [e for e in self.entries.values() if e['end'] is not None]
+        removed = False
+        with open(fname, 'ab+') as fh:
+            while len(entries):
+                last = entries[-1]
+                if last['end'] <= size:
+                    fh.seek(last['tail'])
+                    buf = bytearray(fh.read(FIXEDHEADER + 4096))
+                    try:
+                        if recordLength(buf) == last['end'] - last['tail']:
+                            break
+                    except ValueError:
+                        pass
+                self.log.warning('Data of %s not found in %s' % (last['line'], fname))
+                del self.entries[entries.pop()['line']]
+                removed = True
+
+            valid = entries[-1]['end'] if len(entries) else 0
+            if valid < size:
+                self.log.warning('Removing %d bytes at the end of %s' %
+                                 (size - valid, fname))
+            fh.truncate(valid)
+
+        if removed:
+            self.rewrite()
+        return valid
+
+    def rewrite(self):
+        with open(self.fname, 'w') as fout:
+            for entry in self.entries.itervalues():
+                fout.write(json.dumps(entry) + '\n')
+
+    def add(self, line, size, records, tail, end):
+        """Record a line as completed."""
+        entry = {'line': line, 'bytes': size, 'records': records,
+                 'tail': tail, 'end': end}
+        self.entries[line] = entry
+        with open(self.fname, 'a') as fout:
+            fout.write(json.dumps(entry) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def completed(self):
+        """Return the lines already completed."""
+        return set(self.entries)
+
+
+class MSeedWriter(object):
+    """Write the records of the lines downloaded in parallel to one file.
+
+    The data of every line is kept in a temporary file until the line is
+    completed. It is then appended to the output and the line is added to
+    the journal, so that the output only contains complete lines and can be
+    resumed after an interruption.
+    """
+
+    def __init__(self, fname, journal=None, append=False):
+        self.fname = fname
+        self.fh = open(fname, 'ab' if append else 'wb')
+        self.journal = journal
+        self.lock = threading.Lock()
+
+    def spool(self):
+        """Return a temporary file for the data of a line."""
+        return LineSpool(os.path.dirname(os.path.abspath(self.fname)))
+
+    def commit(self, line, spool):
+        """Append the data of a completed line to the output."""
+        with self.lock:
+            self.fh.seek(0, os.SEEK_END)
+            start = self.fh.tell()
+            spool.fh.seek(0)
+            shutil.copyfileobj(spool.fh, self.fh)
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            if self.journal is not None:
+                self.journal.add(line, spool.size, spool.records,
+                                 start + spool.tail, self.fh.tell())
+
+    def close(self):
+        self.fh.close()
+
+
+class LineSpool(object):
+    """Temporary file with the records of one line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = tempfile.TemporaryFile(dir=path, prefix='.owndccli-')
+        self.size = 0
+        self.records = 0
+        # Position of the last record
+        self.tail = 0
+
+    def write(self, chunk):
+        for pos, reclen in iterOffsets(chunk):
+            self.records += 1
+            self.tail = self.size + pos
+        self.fh.write(chunk)
+        self.size += len(chunk)
+
+    def discard(self, drop):
+        """Remove the records for which ``drop(header)`` is True."""
+        old = self.fh
+        old.seek(0)
+        self.fh = tempfile.TemporaryFile(dir=self.path, prefix='.owndccli-')
+        self.size = self.records = self.tail = 0
+        pool = BufferPool(1, 65536)
         try:
-            # Append another log item to the proper request line
-            self[self.__url2nslc(le.line)].append((le.dt, self.__code2desc(le.code), le.bytes))
-        except:
-            self[self.__url2nslc(le.line)] = [(le.dt, self.__code2desc(le.code), le.bytes)]
-        pass
+            for buf, chunk in iterRecords(old, pool):
+                self.write(filterRecords(buf, chunk, lambda header: not drop(header)))
+                pool.release(buf)
+        finally:
+            old.close()
+
+    def close(self):
+        self.fh.close()
+
+
+class SDSWriter(object):
+    """Write the records of the lines downloaded in parallel to an SDS archive.
+
+    The data of every line is kept in a temporary file until the line is
+    completed. Its records are then written to the file of their stream and
+    day (``YEAR/NET/STA/CHAN.D/NET.STA.LOC.CHAN.D.YEAR.DOY``) and the line is
+    added to the journal, so that a line retried or resumed is not saved
+    twice. Only ``maxFiles`` files are kept open at the same time. The least
+    recently used one is closed when another one is needed.
+    """
+
+    def __init__(self, path, journal=None, maxFiles=100, bufferSize=65536):
+        self.path = path
+        self.journal = journal
+        self.maxFiles = maxFiles
+        self.bufferSize = bufferSize
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def fileName(self, net, sta, loc, cha, start):
+        """Return the name of the file of a stream and day."""
+        year = start.year
+        doy = start.timetuple().tm_yday
+        return os.path.join(self.path, '%d' % year, net, sta, '%s.D' % cha,
+                            '%s.%s.%s.%s.D.%d.%03d' % (net, sta, loc, cha, year, doy))
+
+    def __file(self, fname):
+        """Return the open file with the given name."""
+        try:
+            fh = self.files.pop(fname)
+        except KeyError:
+            if len(self.files) >= self.maxFiles:
+                self.__close(self.files.popitem(last=False)[1])
+            dirname = os.path.dirname(fname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fh = open(fname, 'ab', self.bufferSize)
+        # The most recently used file is kept at the end
+        self.files[fname] = fh
+        return fh
+
+    @staticmethod
+    def __close(fh):
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+
+    def spool(self):
+        """Return a temporary file for the data of a line."""
+        return LineSpool(self.path)
+
+    def commit(self, line, spool):
+        """Write the records of a completed line to their files."""
+        pool = BufferPool(1, self.bufferSize)
+        with self.lock:
+            spool.fh.seek(0)
+            written = set()
+            for buf, chunk in iterRecords(spool.fh, pool):
+                for pos, reclen in iterOffsets(chunk):
+                    net, sta, loc, cha, start, end = recordHeader(chunk, pos)
+                    fname = self.fileName(net, sta, loc, cha, start)
+                    self.__file(fname).write(chunk[pos:pos + reclen])
+                    written.add(fname)
+                pool.release(buf)
+
+            for fname in written:
+                if fname in self.files:
+                    self.files[fname].flush()
+                    os.fsync(self.files[fname].fileno())
+            if self.journal is not None:
+                self.journal.add(line, spool.size, spool.records, None, None)
+
+    def close(self):
+        with self.lock:
+            while len(self.files):
+                self.__close(self.files.popitem()[1])
+
+
+class RetryScheduler(object):
+    """Queue of the request lines to download, including their retries.
+
+    A line without data, or with routes which failed, is requested again
+    after an exponential backoff with jitter based on its number of
+    attempts. The backoff of the data centres which failed or returned no
+    data for it is also considered, so
+    that a line is not sent to a data centre which keeps failing before
+    its backoff expires. The other lines are not affected. No retry is
+    scheduled after ``budget`` seconds.
+
+    ``lines`` can be any iterable. It is read only when a line is needed,
+    and the retries which are due are requested before new lines.
+    """
+
+    def __init__(self, lines, retries=0, delay=2, maxDelay=600, budget=3600):
+        self.log = logging.getLogger('owndccli')
+        self.cond = threading.Condition()
+        self.lines = iter(lines)
+        # Retries with the time when they can be requested
+        self.queue = list()
+        self.seq = 0
+        self.attempts = dict()
+        self.retries = retries
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.deadline = time.time() + budget if budget is not None else None
+        # Consecutive failures and end of the backoff of every data centre
+        self.dcFailures = dict()
+        self.dcNext = dict()
+        self.active = 0
+
+    def backoff(self, failures):
+        """Return the time to wait after a number of consecutive failures."""
+        delay = min(self.maxDelay, self.delay * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def __take(self):
+        """Return the next line which can be requested now or None.
+
+        Lock must be held.
+        """
+        line = None
+        if len(self.queue) and self.queue[0][0] <= time.time():
+            line = heapq.heappop(self.queue)[2]
+        elif self.lines is not None:
+            line = next(self.lines, None)
+            if line is None:
+                self.lines = None
+
+        if line is not None:
+            self.attempts[line] = self.attempts.get(line, 0) + 1
+            self.active += 1
+        return line
+
+    def nextBlock(self, size):
+        """Wait for the next lines to request, at most ``size`` of them.
+
+        Only the first line is waited for. An empty list is returned if
+        there are no more lines.
+        """
+        with self.cond:
+            line = self.next()
+            result = list()
+            while line is not None:
+                result.append(line)
+                line = self.__take() if len(result) < size else None
+            return result
+
+    def next(self):
+        """Wait for the next line to request or None if there are no more."""
+        with self.cond:
+            while True:
+                line = self.__take()
+                if line is not None:
+                    return line
+
+                if len(self.queue):
+                    self.cond.wait(min(self.queue[0][0] - time.time(), 1))
+                elif self.active:
+                    # A line in progress could still be retried
+                    self.cond.wait(1)
+                else:
+                    return None
+
+    def done(self, line, status, retry):
+        """Register the result of a line and schedule a retry if needed.
+
+        :param status: HTTP status returned by every data centre
+        :type status: dict
+        :param retry: True if the line should be requested again
+        :type retry: bool
+        :returns: True if a retry was scheduled
+        :rtype: bool
+        """
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+            now = time.time()
+            for dc, code in status.iteritems():
+                if code == 200:
+                    self.dcFailures.pop(dc, None)
+                    self.dcNext.pop(dc, None)
+                else:
+                    self.dcFailures[dc] = self.dcFailures.get(dc, 0) + 1
+                    self.dcNext[dc] = now + self.backoff(self.dcFailures[dc])
+
+            if not retry or self.attempts[line] > self.retries:
+                del self.attempts[line]
+                return False
+
+            when = max([now + self.backoff(self.attempts[line])] +
+                       [self.dcNext.get(dc, 0) for dc in status])
+            if self.deadline is not None and when > self.deadline:
+                self.log.warning('Retry budget exhausted for %s' % (line,))
+                del self.attempts[line]
+                return False
+
+            self.log.info('Retrying %s in %.1f seconds' % (line, when - now))
+            heapq.heappush(self.queue, (when, self.seq, line))
+            self.seq += 1
+            return True
+
+
+def lineRoutes(ds, line):
+    """Return the routes of a request line.
+
+    :returns: Number of the part, URL of the service and parameters of
+        every route
+    :rtype: list of tuples
+    :raise: ValueError if the line cannot be parsed and RoutingException
+        if no route was found
+    """
+    st, start, endt = ds.parseLine(line.text)
+    return [(part, dc['url'], item)
+            for part, fdsnws in ds.findRoutes(st, start, endt)
+            for dc in fdsnws for item in dc['params']]
+
+
+def fetchBlock(ds, lines, output, progress, report, retried=None):
+    """Download the data of a block of request lines.
+
+    The routes of all the lines are grouped in requests to the data
+    centres as in a POST request to the service. The records received are
+    assigned to the lines by their stream and time, and every line is
+    reported separately.
+
+    :param retried: State of the lines which were already requested
+    :type retried: dict
+    :returns: Line, its state (None if it has no routes), status of every
+        data centre and whether the line should be requested again
+    :rtype: list of tuples
+    """
+    log = logging.getLogger('owndccli')
+    retried = retried if retried is not None else dict()
+    states = list()
+    results = list()
+    for line in lines:
+        progress.lineStarted(line)
+        report.start(line)
+        state = retried.pop(line, None)
+        if state is None:
+            try:
+                state = LineState(line, lineRoutes(ds, line), output.spool())
+            except (ValueError, RoutingException) as e:
+                log.warning('No routes found for %s. %s' % (line, e))
+                report.add(line, None, 204, 0)
+                progress.lineFinished(line)
+                results.append((line, None, dict(), False))
+                continue
+        state.attempt()
+        states.append(state)
+
+    if not len(states):
+        return results
+
+    planner = RequestPlanner(ds.postLines, ds.cache)
+    for state in states:
+        for part, url, item in state.routes:
+            planner.add([{'url': url, 'params': [item]}], part)
+
+    observer = BlockObserver(states, progress, report)
+    demux = BlockDemux(states, progress)
+    failed = False
+    try:
+        for chunk in ds.makeQueryPlan(planner.requests(), observer=observer):
+            demux.write(chunk)
+    except Exception as e:
+        log.error('Error downloading %d lines! %s' % (len(states), e))
+        failed = True
+
+    for state in states:
+        state.report(report)
+        if failed:
+            report.add(state.line, None, 0, 0)
+        progress.lineFinished(state.line)
+        results.append((state.line, state, state.status(), len(state.failed()) > 0))
+    return results
+
+
+def readLines(fh):
+    """Iterate over the request lines of a file without reading it completely.
+
+    The lines are numbered as in the file.
+    """
+    for pos, line in enumerate(fh, 1):
+        line = line.strip()
+        if len(line):
+            yield RequestLine(pos, line)
+
+
+def fetchLines(ds, scheduler, output, progress, report, threads, block=100,
+               finished=None):
+    """Download the lines of the scheduler in blocks of at most ``block`` lines
+    with up to ``threads`` blocks at the same time.
+
+    A line is saved when it will not be requested again. Only the routes
+    of a line which failed are retried. ``finished`` is called with every
+    line saved.
+    """
+    log = logging.getLogger('owndccli')
+    # State of the lines waiting for a retry
+    retried = dict()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lines = scheduler.nextBlock(block)
+            if not len(lines):
+                return
+            with lock:
+                pending = dict([(l, retried.pop(l)) for l in lines if l in retried])
+            results = [(line, None, dict(), True) for line in lines]
+            try:
+                results = fetchBlock(ds, lines, output, progress, report, pending)
+            finally:
+                for line, state, status, retry in results:
+                    if scheduler.done(line, status, retry):
+                        progress.lineRetried(line)
+                        if state is not None:
+                            state.retry()
+                            with lock:
+                                retried[line] = state
+                        continue
+
+                    if state is not None:
+                        try:
+                            state.close(output)
+                        except Exception as e:
+                            log.error('Error saving %s! %s' % (line, e))
+                    if finished is not None:
+                        finished(line)
+
+    workers = [threading.Thread(target=worker) for i in range(max(1, threads))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    # Join with a timeout to be able to interrupt the download
+    for w in workers:
+        while w.is_alive():
+            w.join(1)
 
 
 def main():
@@ -107,74 +1065,119 @@ def main():
                         default=0)
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-s", "--seconds", type=int,
-                        help='Number of seconds between retries for the lines without data')
+                        help='Number of seconds before the first retry of the lines without data. It is doubled for every retry')
     group.add_argument("-m", "--minutes", type=int,
-                        help='Number of minutes between retries for the lines without data')
+                        help='Number of minutes before the first retry of the lines without data. It is doubled for every retry')
+    parser.add_argument('--max-delay', type=int, default=600,
+                        help='Maximum number of seconds between retries')
+    parser.add_argument('--retry-budget', type=int, default=3600,
+                        help='Number of seconds after which no more retries are done')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='Number of blocks of lines downloaded at the same time')
+    parser.add_argument('-b', '--block', type=int, default=100,
+                        help='Maximum number of request lines routed and downloaded together')
+    parser.add_argument('--sds', default=None,
+                        help='Directory of an SDS archive where the data is saved instead of the mseed file.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a previous download. Only the lines not completed are requested')
+    parser.add_argument('--report', choices=['json', 'csv'], default='json',
+                        help='Format of the report with the results of every line and data centre.')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not show the progress of the download')
     parser.add_argument('-v', '--verbosity', action="count", default=0,
                         help='Increase the verbosity level')
-    parser.add_argument('--version', action='version', version='owndc-cli %s ' % get_git_version())
+    parser.add_argument('--version', action='version', version='owndc-cli %s ' % version)
     args = parser.parse_args()
-    
+
+    logging.basicConfig(level=max(logging.DEBUG, logging.WARNING - 10 * args.verbosity))
+
     # Read the streams and timewindows to download
     if args.post_file is not None:
         fh = open(args.post_file, 'r')
     else:
         fh = sys.stdin
 
-    lines = fh.read()
-    summary = SummarizedRun()
+    # The lines are read while they are downloaded
+    lines = readLines(fh)
+    completed = set()
 
-    ds = DataSelectQuery(summary,
-                         routesFile='data/owndc-routes.xml',
-                         configFile=args.config)
-
-    outwav = open('%s.mseed' % args.output, 'wb')
+    journal = Journal('%s.journal' % args.output)
+    if args.resume:
+        journal.load()
+        if args.sds is None:
+            size = journal.verify('%s.mseed' % args.output)
+        else:
+            size = sum([e['bytes'] for e in journal.entries.itervalues()])
+        completed = journal.completed()
+        print 'Resuming download. %d lines (%d bytes) already completed.' % \
+            (len(completed), size)
+        lines = (l for l in lines if l.text not in completed)
+    elif os.path.exists(journal.fname):
+        os.remove(journal.fname)
 
-    # Attempt number to download the waveforms
-    attempt = 0
+    # The number of lines is only known in advance if they are in a file
+    total = None
+    if args.post_file is not None:
+        with open(args.post_file, 'r') as fin:
+            total = sum([1 for l in readLines(fin) if l.text not in completed])
 
-    while ((attempt <= args.retries) and (len(lines.splitlines()) > 0)):
-        print '\n\nAttempt Nr. %d of %d' % (attempt+1, args.retries+1)
+    report = DownloadReport(args.output, args.report)
 
-        iterObj = ds.makeQueryPOST(lines)
-        
-        for chunk in iterObj:
-            outwav.write(chunk)
-            print '.',
+    ds = DataSelectQuery(configFile=args.config)
 
-        print
+    if args.sds is None:
+        outwav = MSeedWriter('%s.mseed' % args.output, journal, append=args.resume)
+    else:
+        outwav = SDSWriter(args.sds, journal)
 
-        lines = ''
-        for k, v in summary.iteritems():
+    if args.minutes:
+        delay = args.minutes * 60
+    else:
+        delay = 2 if args.seconds is None else args.seconds
+    scheduler = RetryScheduler(lines, args.retries, delay, args.max_delay,
+                               args.retry_budget)
 
-            # Print summary
-            totBytes = sum([l[2] for l in v])
-            status = ','.join([l[1] for l in v])
+    progress = Progress(total)
+    stop = threading.Event()
+    display = threading.Thread(target=progress.run, args=(stop,))
+    display.daemon = True
+    if not args.quiet:
+        display.start()
 
-            print '[%s] %s %d bytes' % ('\033[92mOK\033[0m' if totBytes else \
-                                        '\033[91m' + status + '\033[0m', k, totBytes)
-            # Check the total amount of bytes received
-            if totBytes <= 0:
-                lines = '%s%s\n' % (lines, k)
+    # FIXME I should decide here a nice format for the output
+    # and also if it should be to stdout, a file or a port
+    outlog = open('%s.log' % args.output, 'a' if args.resume else 'w')
+    logLock = threading.Lock()
 
-        attempt += 1
+    def finished(line):
+        """Show and save the summary of a line and forget it."""
+        rows = report.finish(line)
+        totBytes = sum([r['bytes'] for r in rows])
+        status = [report.code2desc(r['status']) for r in rows]
 
-        if args.minutes:
-            print 'Waiting %d minutes to retry again...' % args.minutes
-            sleep(args.minutes * 60)
-        else:
-            seconds = 2 if args.seconds is None else args.seconds
-            
-            print 'Waiting %d seconds to retry again...' % seconds
-            sleep(seconds)
+        text = '[%s] %s %d bytes' % ('\033[92mOK\033[0m' if totBytes else
+                                     '\033[91m' + ','.join(status) + '\033[0m',
+                                     line.text, totBytes)
+        with logLock:
+            if args.quiet:
+                print text
+            else:
+                progress.message(text)
+            outlog.write('%s %s %d bytes\n' % (line.text, status, totBytes))
+            outlog.flush()
 
-    outwav.close()
-    
-    # FIXME I should decide here a nice format for the output
-    # and also if it should be to stdout, a file or a port
-    with open('%s.log' % args.output, 'w') as outlog:
-        for k, v in summary.iteritems():
-            outlog.write('%s %s %d bytes\n' % (k, [le[1] for le in v], sum([le[2] for le in v])))
+    try:
+        fetchLines(ds, scheduler, outwav, progress, report, args.threads,
+                   args.block, finished)
+    finally:
+        stop.set()
+        if not args.quiet:
+            display.join()
+        outwav.close()
+        outlog.close()
+        report.close()
+        if ds.cache is not None:
+            ds.cache.flush()
 
 if __name__ == '__main__':
     main()
@@ -18,8 +18,14 @@ any later version.
 """
 
 import os
+import time
+import json
+import socket
+import hashlib
+import tempfile
 import argparse
 import logging
+import threading
 import urllib2 as ul
 
 try:
@@ -30,21 +36,254 @@ except ImportError:
 import ConfigParser as configparser
 
 try:
-    from routing.routeutils.utils import addRemote
     from routing.routeutils.utils import addRoutes
     from routing.routeutils.utils import addVirtualNets
     from routing.routeutils.utils import cacheStations
     from routing.routeutils.utils import Route
     from routing.routeutils.utils import RoutingCache
+    from routeindex import compileRoutes
+    from routeparser import overlaps
+    from routeparser import parseRoutes
+    from routeparser import peakMemory
 except:
     raise
 
 
-def mergeRoutes(fileRoutes, synchroList, allowOverlaps=False):
+def routingURL(url):
+    """Return the URL of the local routes of a data centre.
+
+The URL can be given in ``synchronize`` as the base URL of the Routing
+Service (``/localconfig`` is added) or as the URL of a routing XML file.
+
+"""
+    if url.endswith('.xml'):
+        return url
+    return '%s/localconfig' % url.rstrip('/')
+
+
+def fetchRemote(url, tmpName, fname, validators, timeout=None):
+    """Download the routes of a data centre only if they changed.
+
+The request is conditional on the validators of the last download (ETag and
+Last-Modified). The routes are saved in ``tmpName`` if they are different
+from the ones in ``fname``.
+
+:param url: URL of the Routing Service (see :func:`routingURL`)
+:type url: str
+:param validators: ETag, Last-Modified and SHA1 of the last download
+:type validators: dict
+:returns: Status ('OK' if the routes changed, 'Not modified' or 'Unchanged')
+    and the validators of this download
+:rtype: tuple
+
+"""
+    headers = dict()
+    if os.path.exists(fname):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('lastModified'):
+            headers['If-Modified-Since'] = validators['lastModified']
+
+    try:
+        u = ul.urlopen(ul.Request(routingURL(url), headers=headers), timeout=timeout)
+    except ul.HTTPError as e:
+        if e.code == 304:
+            return 'Not modified', validators
+        raise
+
+    sha1 = hashlib.sha1()
+    try:
+        with open(tmpName, 'wb') as fout:
+            while True:
+                block = u.read(4096 * 100)
+                if not len(block):
+                    break
+                sha1.update(block)
+                fout.write(block)
+    finally:
+        u.close()
+
+    result = {'etag': u.info().getheader('ETag'),
+              'lastModified': u.info().getheader('Last-Modified'),
+              'sha1': sha1.hexdigest()}
+
+    if os.path.exists(fname) and result['sha1'] == validators.get('sha1'):
+        os.remove(tmpName)
+        return 'Unchanged', result
+
+    return 'OK', result
+
+
+def synchroDCs(synchroList):
+    """Return the data centres of the list to synchronize with.
+
+:param synchroList: Lines with the ID and the URL of a data centre separated
+    by a comma. The list ends with the first empty line.
+:type synchroList: str
+:rtype: list of (dcid, url)
+
+"""
+    logs = logging.getLogger('mergeRoutes')
+    result = list()
+    for line in synchroList.splitlines():
+        if not len(line):
+            break
+        logs.debug(str(line.split(',')))
+        dcid, url = line.split(',')
+        result.append((dcid.strip(), url.strip()))
+    return result
+
+
+def fragmentName(dcid):
+    """Return the file where the routes of a data centre are saved."""
+    return os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-%s.xml' % dcid)
+
+
+def compiledNames(fileRoutes):
+    """Return the pickled routing table and the route index of a routing file."""
+    return [os.path.join(os.path.expanduser('~'), '.owndc', 'data', '%s%s' % (fileRoutes, ext))
+            for ext in ('.bin', '.idx')]
+
+
+def routesOutdated(fileRoutes, sources):
+    """Check whether the routing table and index must be built again.
+
+:param fileRoutes: File containing the local routing table
+:type fileRoutes: str
+:param sources: Files from which the routing table is built
+:type sources: list
+:returns: True if the ``.bin`` or the ``.idx`` file are missing or older
+    than any of the sources
+:rtype: bool
+
+"""
+    compiled = compiledNames(fileRoutes)
+    if not all([os.path.exists(f) for f in compiled]):
+        return True
+    return min([os.path.getmtime(f) for f in compiled]) < \
+        max([os.path.getmtime(f) for f in sources if os.path.exists(f)] + [0])
+
+
+def downloadRoutes(synchroList, timeout=300):
+    """Download the routing tables of the data centres in parallel.
+
+The routes of every data centre are saved in ``~/.owndc/data/owndc-DCID.xml``.
+Only the routes which changed since the last update are downloaded. The
+validators used to check it are kept in ``~/.owndc/data/owndc-sync.json``.
+A file is only replaced if its download finished within ``timeout`` seconds.
+Otherwise, the version from the previous update is kept.
+
+:param synchroList: List of data centres where routes should be imported from
+:type synchroList: str
+:param timeout: Maximum time in seconds to download all routing tables
+:type timeout: float
+:returns: Status and seconds needed for every data centre in the order of
+    ``synchroList``. The status is 'OK' only if the routes changed.
+:rtype: list of (dcid, status, seconds)
+
+"""
+
+    logs = logging.getLogger('mergeRoutes')
+    lock = threading.Lock()
+    # Status, time and validators of the downloads finished (or abandoned)
+    results = dict()
+
+    syncName = os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-sync.json')
+    try:
+        with open(syncName) as fin:
+            state = json.load(fin)
+    except:
+        state = dict()
+
+    def fetch(dcid, url, fname):
+        start = time.time()
+        tmpName = '%s.download' % fname
+        validators = state.get(dcid, dict())
+        if validators.get('url') != url:
+            validators = dict()
+        try:
+            status, validators = fetchRemote(url, tmpName, fname, validators, timeout)
+        except Exception as e:
+            status = 'Error: %s' % e
+
+        with lock:
+            if dcid in results:
+                # The download was abandoned
+                status = None
+            elif status == 'OK':
+                os.rename(tmpName, fname)
+            if status is not None:
+                results[dcid] = (status, time.time() - start, validators)
+
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+    dcs = list()
+    for dcid, url in synchroDCs(synchroList):
+        thread = threading.Thread(target=fetch, args=(dcid, url, fragmentName(dcid)))
+        thread.daemon = True
+        thread.start()
+        dcs.append((dcid, url, thread))
+
+    deadline = time.time() + timeout
+    for dcid, url, thread in dcs:
+        thread.join(max(0, deadline - time.time()))
+
+    report = list()
+    with lock:
+        for dcid, url, thread in dcs:
+            if dcid not in results:
+                results[dcid] = ('Timeout', timeout, None)
+            status, seconds, validators = results[dcid]
+            if status in ('OK', 'Not modified', 'Unchanged'):
+                validators['url'] = url
+                state[dcid] = validators
+            else:
+                logs.error('Failure updating routing information from %s (%s): %s' %
+                           (dcid, url, status))
+            report.append((dcid, status, seconds))
+
+    with open(syncName, 'w') as fout:
+        json.dump(state, fout, indent=2)
+
+    logs.info('Time to download the routing tables:')
+    for dcid, status, seconds in sorted(report, key=lambda r: -r[2]):
+        logs.info('%-10s %8.2f s  %s' % (dcid, seconds, status))
+
+    return report
+
+
+def loadFragment(fname, allowOverlaps=False):
+    """Return the routes and virtual networks of a routing file.
+
+The parsed routes are cached under the same filename plus ``.bin`` and reused
+while the file does not change.
+
+:rtype: tuple of (routes, virtual networks)
+
+"""
+    binName = '%s.bin' % fname
+    if os.path.exists(binName) and os.path.getmtime(binName) >= os.path.getmtime(fname):
+        try:
+            with open(binName, 'rb') as fin:
+                return pickle.load(fin)
+        except:
+            pass
+
+    fragment = (addRoutes(fname, allowOverlaps=allowOverlaps), addVirtualNets(fname))
+    with open(binName, 'wb') as fout:
+        pickle.dump(fragment, fout)
+    return fragment
+
+
+def mergeRoutes(fileRoutes, synchroList, allowOverlaps=False, masterFile=None,
+                timeout=300, configFile=None, streaming=False):
     """Retrieve routes from different sources and merge them with the local
 ones in the routing tables. The configuration file is checked to see whether
 overlapping routes are allowed or not. A pickled version of the the routing
 table is saved under the same filename plus ``.bin`` (e.g. owndc-tmp.xml.bin).
+A compiled index of the routing table, which can be mapped in memory, is
+saved under the same filename plus ``.idx``.
 
 :param fileRoutes: File containing the local routing table
 :type fileRoutes: str
@@ -52,53 +291,123 @@ table is saved under the same filename plus ``.bin`` (e.g. owndc-tmp.xml.bin).
 :type synchroList: str
 :param allowOverlaps: Specify if overlapping streams should be allowed or not
 :type allowOverlaps: boolean
+:param masterFile: File containing the master table to include in the index
+:type masterFile: str
+:param timeout: Maximum time in seconds to download the remote routes
+:type timeout: float
+:param configFile: Configuration file with the list of data centres
+:type configFile: str
+:param streaming: Parse the routing files incrementally and add the routes
+    directly to the routing table to reduce the memory needed. The parsed
+    routes of each data centre are not cached in this mode.
+:type streaming: boolean
+
+Only the remote routes which changed are parsed again. If none of the routing
+files (nor the configuration) changed, the routing table is not built again.
 
 """
 
     logs = logging.getLogger('mergeRoutes')
     logs.info('Synchronizing with: %s' % synchroList)
 
-    ptRT = addRoutes(fileRoutes, allowOverlaps=allowOverlaps)
-    ptVN = addVirtualNets(fileRoutes)
+    # All remote routes are downloaded before merging them
+    report = downloadRoutes(synchroList, timeout)
 
-    for line in synchroList.splitlines():
-        if not len(line):
-            break
-        logs.debug(str(line.split(',')))
-        dcid, url = line.split(',')
-        try:
-            addRemote(os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-%s.xml' % dcid.strip()),
-                      url.strip())
-        except:
-            msg = 'Failure updating routing information from %s (%s)' % \
-                (dcid, url)
-            logs.error(msg)
+    sources = [fileRoutes] + [f for f in (masterFile, configFile) if f is not None]
+    if 'OK' not in [status for dcid, status, seconds in report] and \
+            not routesOutdated(fileRoutes, sources):
+        logs.info('No routes changed. The routing table is up to date.')
+        return
+
+    buildRoutes(fileRoutes, [dcid for dcid, status, seconds in report],
+                allowOverlaps, masterFile, streaming)
 
-        if os.path.exists(os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-%s.xml' % dcid.strip())):
+
+def buildRoutes(fileRoutes, dcids, allowOverlaps=False, masterFile=None,
+                streaming=False):
+    """Merge the local routes with the ones already downloaded from the data
+centres and save the routing table (``.bin``) and its index (``.idx``).
+
+:param fileRoutes: File containing the local routing table
+:type fileRoutes: str
+:param dcids: Data centres whose routes (``~/.owndc/data/owndc-DCID.xml``)
+    should be merged
+:type dcids: list
+:param allowOverlaps: Specify if overlapping streams should be allowed or not
+:type allowOverlaps: boolean
+:param masterFile: File containing the master table to include in the index
+:type masterFile: str
+:param streaming: Parse the routing files incrementally
+:type streaming: boolean
+
+"""
+
+    logs = logging.getLogger('mergeRoutes')
+
+    # Peak memory of the process after reading every source
+    memory = list()
+    before = peakMemory()
+    if streaming:
+        ptRT, ptVN = parseRoutes(fileRoutes, allowOverlaps=allowOverlaps)
+    else:
+        ptRT = addRoutes(fileRoutes, allowOverlaps=allowOverlaps)
+        ptVN = addVirtualNets(fileRoutes)
+    memory.append((os.path.basename(fileRoutes), peakMemory(), peakMemory() - before))
+
+    for dcid in dcids:
+        fname = fragmentName(dcid)
+        if os.path.exists(fname):
             # FIXME addRoutes should return no Exception ever and skip a
             # problematic file returning a coherent version of the routes
             print 'Adding REMOTE %s' % dcid
-            ptRT = addRoutes(os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-%s.xml' % dcid.strip()),
-                             routingTable=ptRT, allowOverlaps=allowOverlaps)
-            ptVN = addVirtualNets(os.path.join(os.path.expanduser('~'), '.owndc', 'data', 'owndc-%s.xml' % dcid.strip()),
-                                  vnTable=ptVN)
-
-    try:
-        os.remove(os.path.join(os.path.expanduser('~'), '.owndc', 'data', '%s.bin' % fileRoutes))
-    except:
-        pass
+            before = peakMemory()
+            if streaming:
+                parseRoutes(fname, ptRT, ptVN, allowOverlaps)
+                memory.append((dcid, peakMemory(), peakMemory() - before))
+                continue
+
+            remoteRT, remoteVN = loadFragment(fname, allowOverlaps)
+            for st, routes in remoteRT.iteritems():
+                # Only the routes overlapping the ones already defined are skipped
+                existing = list(ptRT.get(st, list()))
+                skipped = 0
+                for route in routes:
+                    if not allowOverlaps and overlaps(existing, route):
+                        skipped += 1
+                        continue
+                    ptRT.setdefault(st, list()).append(route)
+                if skipped:
+                    logs.warning('%d routes for %s from %s skipped. Already defined.' %
+                                 (skipped, str(st), dcid))
+            for vn, streams in remoteVN.iteritems():
+                ptVN.setdefault(vn, list()).extend(streams)
+            memory.append((dcid, peakMemory(), peakMemory() - before))
+
+    logs.info('Peak memory after reading every source:')
+    for source, peak, increase in memory:
+        logs.info('%-20s %10d kB (+%d kB)' % (source, peak, increase))
 
     stationTable = dict()
     cacheStations(ptRT, stationTable)
 
-    fname = os.path.join(os.path.expanduser('~'), '.owndc', 'data', '%s.bin' % fileRoutes)
-    with open(fname, 'wb') as finalRoutes:
+    # The routing table is replaced atomically, as it can be read at any time
+    binName, idxName = compiledNames(fileRoutes)
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(binName))
+    with os.fdopen(fd, 'wb') as finalRoutes:
         pickle.dump((ptRT, stationTable, ptVN), finalRoutes)
-        logs.info('Routes in main Routing Table: %s\n' % len(ptRT))
-        logs.info('Stations cached: %s\n' %
-                  sum([len(stationTable[dc][st]) for dc in stationTable
-                       for st in stationTable[dc]]))
-        logs.info('Virtual Networks defined: %s\n' % len(ptVN))
+    os.rename(tmpName, binName)
+    logs.info('Routes in main Routing Table: %s\n' % len(ptRT))
+    logs.info('Stations cached: %s\n' %
+              sum([len(stationTable[dc][st]) for dc in stationTable
+                   for st in stationTable[dc]]))
+    logs.info('Virtual Networks defined: %s\n' % len(ptVN))
+
+    ptMT = None
+    if masterFile is not None and os.path.exists(masterFile):
+        ptMT = addRoutes(masterFile, allowOverlaps=True)
+
+    compileRoutes(idxName, ptRT, ptVN, ptMT)
+    logs.info('Route index saved in %s' % idxName)
 
 
 def main():
@@ -120,6 +429,8 @@ def main():
     #                     default=cfgname)
     parser.add_argument('--reset', action="store_true",
                         help='Remove all configuration files and routes.')
+    parser.add_argument('--streaming', action="store_true",
+                        help='Parse the routing files incrementally to save memory.')
     args = parser.parse_args()
 
     if args.reset:
@@ -189,10 +500,12 @@ def main():
             logging.debug('Creating a standard routing table from Github.')
             fout.write(rou.read())
 
-    try:
-        os.remove(routes + '.bin')
-    except:
-        pass
+    if args.reset:
+        for ext in ('.bin', '.idx'):
+            try:
+                os.remove(routes + ext)
+            except:
+                pass
 
     try:
         synchroList = config.get('Service', 'synchronize')
@@ -200,8 +513,22 @@ def main():
         # Otherwise, default value
         synchroList = ''
 
-    logs.warning('This process can take up 5 minutes to finalize!')
-    mergeRoutes(routes, synchroList)
+    try:
+        timeout = config.getfloat('Service', 'synchronizeTimeout')
+    except:
+        timeout = 300
+
+    try:
+        allowOverlaps = config.getboolean('Service', 'allowoverlap')
+    except:
+        allowOverlaps = False
+
+    # No connection to a data centre can block the update
+    socket.setdefaulttimeout(timeout)
+
+    logs.warning('This process can take up to %d seconds to finalize!' % timeout)
+    mergeRoutes(routes, synchroList, allowOverlaps, masterFile=master,
+                timeout=timeout, configFile=cfgname, streaming=args.streaming)
 
 
 if __name__ == '__main__':
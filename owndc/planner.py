@@ -0,0 +1,270 @@
+"""Plan the requests to be sent to the data centres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import datetime
+import time
+import urllib
+from fnmatch import fnmatch
+from collections import OrderedDict
+
+
+def splitTW(start, end, seconds):
+    """Split a time window in parts of at most ``seconds`` seconds.
+
+    The limits of the parts are aligned to multiples of ``seconds`` (e.g. to
+    midnight if the parts are one day long), so that the parts of different
+    requests are the same. Open time windows are not split.
+
+    :returns: Start and end time of each part
+    :rtype: generator
+    """
+    if start is None or end is None or not seconds or end <= start:
+        yield start, end
+        return
+
+    epoch = datetime.datetime(1970, 1, 1)
+    step = datetime.timedelta(seconds=seconds)
+    offset = (start - epoch).total_seconds() % seconds
+    limit = start - datetime.timedelta(seconds=offset) + step
+
+    while limit < end:
+        yield start, limit
+        start = limit
+        limit += step
+    yield start, end
+
+
+def _time2str(t):
+    if isinstance(t, datetime.datetime):
+        return t.isoformat()
+    return str(t)
+
+
+class UpstreamRequest(object):
+    """Request to a Dataselect service of a data centre.
+
+    A request with only one set of parameters is sent with the GET method.
+    Otherwise, all parameters are sent in the body of a POST request.
+
+    :param url: URL of the Dataselect service
+    :type url: str
+    :param params: Parameters as returned by the routing (net, sta, loc, cha,
+        start, end). The parameters of a part of a split time window also
+        have the limits (start, end or None) of the start time of the records
+        which belong to the part under the key ``trim``.
+    :type params: list
+    """
+
+    def __init__(self, url, params):
+        self.url = url
+        self.params = params
+
+    def trimmed(self):
+        """Check whether some of the records received must be discarded."""
+        return any(['trim' in item for item in self.params])
+
+    def keep(self, header):
+        """Check whether a record belongs to the parameters of the request.
+
+        Data centres return all the records overlapping the time window, so
+        the records crossing the limit between two parts would be sent
+        twice. A record is kept if it starts within the part of at least one
+        of the parameters matching it.
+
+        :param header: Record header as returned by ``mseed.recordHeader``
+        :type header: tuple
+        """
+        net, sta, loc, cha, start, end = header
+        matched = False
+        for item in self.params:
+            if item.get('start') not in (None, '') and end < item['start']:
+                continue
+            if item.get('end') not in (None, '') and start > item['end']:
+                continue
+            if not (fnmatch(net, item['net']) and fnmatch(sta, item['sta']) and
+                    fnmatch(loc, item['loc']) and fnmatch(cha, item['cha'])):
+                continue
+            lower, upper = item.get('trim', (None, None))
+            if (lower is None or start >= lower) and (upper is None or start < upper):
+                return True
+            matched = True
+        return not matched
+
+    def __str__(self):
+        if self.data is None:
+            return self.geturl()
+        return '%s (POST %d lines)' % (self.url, len(self.params))
+
+    def geturl(self):
+        """Return the URL of the request including the query for GET."""
+        if self.data is not None:
+            return self.url
+
+        item = self.params[0]
+        query = list()
+        for k in ('net', 'sta', 'loc', 'cha', 'start', 'end'):
+            v = item.get(k)
+            if k == 'loc' and v == '':
+                v = '--'
+            if v in (None, '', '*'):
+                continue
+            query.append((k, _time2str(v)))
+
+        return '%s?%s' % (self.url, urllib.urlencode(query, doseq=False))
+
+    @property
+    def data(self):
+        """Body of the POST request or None if GET must be used."""
+        if len(self.params) == 1:
+            return None
+
+        lines = list()
+        for item in self.params:
+            lines.append(' '.join([item['net'], item['sta'],
+                                   item['loc'] if len(item['loc']) else '--',
+                                   item['cha'], _time2str(item['start']),
+                                   _time2str(item['end'])]))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestPlanner(object):
+    """Group the routes by Dataselect service.
+
+    Routes to the same service are sent together in one POST request with at
+    most ``maxLines`` lines. Routes without a start and end time cannot be
+    expressed in a POST request and are sent individually with GET.
+
+    If a ``cache`` is given, the data already cached is planned as a local
+    source and only the missing time windows are requested remotely.
+
+    Routes can be added for different parts of a time window (see
+    :func:`splitTW`). Each part is sent in different requests and the
+    requests are returned ordered by part. Within a part, they are returned
+    in the order in which their first route was added.
+
+    The requests already complete can be taken with :meth:`ready` while
+    routes are still being added, so that they can be sent without waiting
+    for the whole plan. A request is only taken once all the requests which
+    go before it are complete. A group is complete when it has ``maxLines``
+    routes or, if ``maxDelay`` is given, when its first route was added
+    ``maxDelay`` seconds ago. The routes to the same URL added later go to
+    a new group.
+    """
+
+    def __init__(self, maxLines=1000, cache=None, maxDelay=None):
+        self.maxLines = max(1, maxLines)
+        self.cache = cache
+        self.maxDelay = maxDelay
+        # Routes pending to be sent per part and URL as (position, routes,
+        # time when the first one was added)
+        self.groups = OrderedDict()
+        # Requests already planned as (part, position, request)
+        self.planned = list()
+        # Position of the next route added
+        self.seq = 0
+
+    def add(self, fdsnws, part=0):
+        """Add the routes returned by ``RoutingCache.getRoute``.
+
+        :param fdsnws: Routes to the Dataselect services
+        :type fdsnws: RequestMerge
+        :param part: Number of the part of the time window requested
+        :type part: int
+        """
+        for dc in fdsnws:
+            for item in dc['params']:
+                if item.get('start') in (None, '') or item.get('end') in (None, ''):
+                    self.__plan(part, UpstreamRequest(dc['url'], [item]))
+                    continue
+
+                if self.cache is None or not self.cache.cacheable(item):
+                    self.__group(part, dc['url'], item)
+                    continue
+
+                # Segments and missing windows are planned in time order
+                segments, missing = self.cache.lookup(item)
+                sources = [(seg.start, seg) for seg in segments] + \
+                    [(start, (start, end)) for start, end in missing]
+                sources.sort(key=lambda s: s[0])
+                lower, upper = item.get('trim', (None, None))
+                for i, (start, source) in enumerate(sources):
+                    sub = dict(item)
+                    # Every record is returned only by the source where it
+                    # starts, as adjacent sources share the records crossing
+                    # their limit
+                    if i:
+                        sub['trim'] = (start if lower is None else max(lower, start), upper)
+                    if i < len(sources) - 1:
+                        limit = sources[i + 1][0]
+                        sub['trim'] = (sub.get('trim', (lower, upper))[0],
+                                       limit if upper is None else min(upper, limit))
+                    if not isinstance(source, tuple):
+                        # Requested remotely if the cached file cannot be read
+                        sub['start'], sub['end'] = source.start, source.end
+                        source.request = UpstreamRequest(dc['url'], [sub])
+                        source.trim = sub.get('trim', (None, None))
+                        self.__plan(part, source)
+                        continue
+                    sub['start'], sub['end'] = source
+                    self.__group(part, dc['url'], sub)
+
+    def __plan(self, part, request):
+        """Add a complete request at the current position."""
+        self.planned.append((part, self.seq, request))
+        self.seq += 1
+
+    def __group(self, part, url, item):
+        """Add the parameters to the POST request being prepared for the URL."""
+        if (part, url) not in self.groups:
+            self.groups[(part, url)] = (self.seq, list(), time.time())
+            self.seq += 1
+        pos, group, created = self.groups[(part, url)]
+        group.append(item)
+        if len(group) >= self.maxLines:
+            self.planned.append((part, pos, UpstreamRequest(url, group)))
+            del self.groups[(part, url)]
+
+    def ready(self):
+        """Return the requests planned since the last call which can be sent.
+
+        Groups still accepting parameters are not included, nor any request
+        which goes after them.
+        """
+        if self.maxDelay is not None:
+            limit = time.time() - self.maxDelay
+            for (part, url), (pos, group, created) in self.groups.items():
+                if created <= limit:
+                    self.planned.append((part, pos, UpstreamRequest(url, group)))
+                    del self.groups[(part, url)]
+
+        self.planned.sort(key=lambda p: p[:2])
+        pending = [(part, pos) for (part, url), (pos, group, created) in self.groups.iteritems()]
+        count = len(self.planned)
+        if len(pending):
+            limit = min(pending)
+            count = len([p for p in self.planned if p[:2] < limit])
+        result = [req for part, pos, req in self.planned[:count]]
+        self.planned = self.planned[count:]
+        return result
+
+    def requests(self):
+        """Return the requests not taken yet including the pending groups."""
+        for (part, url), (pos, group, created) in self.groups.iteritems():
+            self.planned.append((part, pos, UpstreamRequest(url, group)))
+        self.groups = OrderedDict()
+
+        return self.ready()
@@ -0,0 +1,378 @@
+"""Compiled index of the routing table which can be memory-mapped
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+
+The index is a binary file with the following sections (little-endian):
+
+* Header: magic string, version and number of items in every section.
+* Strings: offsets and UTF-8 text of all the strings used (codes, services
+  and addresses), sorted and stored only once. Strings are referred to by
+  their position in this section.
+* Routes and master routes: one fixed-size record per route with the
+  stream, service, address, priority and time window.
+* Networks: first route and number of routes for every network code.
+* Virtual networks: one record per stream of a virtual network.
+
+Times are stored as seconds since the epoch. Open time windows are stored
+as infinite values.
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import calendar
+import datetime
+import tempfile
+from fnmatch import fnmatch
+
+from routing.routeutils.utils import RequestMerge
+from routing.routeutils.utils import RoutingException
+from routing.routeutils.utils import Stream
+from routing.routeutils.utils import TW
+
+MAGIC = 'OWNDCIDX'
+VERSION = 1
+
+HEADER = struct.Struct('<8s6I')
+OFFSET = struct.Struct('<I')
+# net, sta, loc, cha, service, address, priority, start, end
+ROUTE = struct.Struct('<7I2d')
+# net, first route, number of routes
+NETWORK = struct.Struct('<3I')
+# code, net, sta, loc, cha, start, end
+VIRTUAL = struct.Struct('<5I2d')
+
+INF = float('inf')
+
+
+def _wildcard(code):
+    return '*' in code or '?' in code
+
+
+def _time2float(t, default):
+    if t is None:
+        return default
+    return calendar.timegm(t.utctimetuple()) + t.microsecond / 1000000.0
+
+
+def _float2time(t):
+    if t in (INF, -INF):
+        return None
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=t)
+
+
+def _intersect(a, b):
+    """Return the most specific of two codes or None if they do not match."""
+    if fnmatch(a, b):
+        return a
+    if fnmatch(b, a):
+        return b
+    return None
+
+
+def compileRoutes(fname, ptRT, ptVN=None, ptMT=None):
+    """Write the routing table to a compiled index.
+
+    The file is replaced atomically, so that processes with the previous
+    version mapped in memory are not affected.
+
+    :param fname: Name of the index file
+    :type fname: str
+    :param ptRT: Routing table as returned by ``addRoutes``
+    :type ptRT: dict
+    :param ptVN: Virtual networks as returned by ``addVirtualNets``
+    :type ptVN: dict
+    :param ptMT: Routes of the master table, which have precedence over the
+        ones in ``ptRT``
+    :type ptMT: dict
+    """
+    ptVN = ptVN if ptVN is not None else dict()
+    ptMT = ptMT if ptMT is not None else dict()
+
+    strings = set()
+    for table in (ptRT, ptMT):
+        for st, routes in table.iteritems():
+            strings.update(st)
+            for service, address, tw, priority in routes:
+                strings.update((service, address))
+    for code, members in ptVN.iteritems():
+        strings.add(code)
+        for st, tw in members:
+            strings.update(st)
+
+    strings = sorted(strings)
+    ids = dict([(s, i) for i, s in enumerate(strings)])
+
+    def routeRecords(table):
+        records = list()
+        for st, routes in table.iteritems():
+            for service, address, tw, priority in routes:
+                records.append((ids[st[0]], ids[st[1]], ids[st[2]], ids[st[3]],
+                                ids[service], ids[address],
+                                priority if priority is not None else 0,
+                                _time2float(tw[0], -INF), _time2float(tw[1], INF)))
+        records.sort()
+        return records
+
+    routes = routeRecords(ptRT)
+    master = routeRecords(ptMT)
+
+    networks = list()
+    for pos, r in enumerate(routes):
+        if len(networks) and networks[-1][0] == r[0]:
+            networks[-1][2] += 1
+        else:
+            networks.append([r[0], pos, 1])
+
+    virtual = list()
+    for code, members in ptVN.iteritems():
+        for st, tw in members:
+            virtual.append((ids[code], ids[st[0]], ids[st[1]], ids[st[2]],
+                            ids[st[3]], _time2float(tw[0], -INF),
+                            _time2float(tw[1], INF)))
+    virtual.sort()
+
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(HEADER.pack(MAGIC, VERSION, len(strings), len(routes),
+                                   len(master), len(networks), len(virtual)))
+            encoded = [s.encode('utf-8') for s in strings]
+            offset = 0
+            for s in encoded:
+                fout.write(OFFSET.pack(offset))
+                offset += len(s)
+            fout.write(OFFSET.pack(offset))
+            fout.write(''.join(encoded))
+            for r in routes + master:
+                fout.write(ROUTE.pack(*r))
+            for n in networks:
+                fout.write(NETWORK.pack(*n))
+            for v in virtual:
+                fout.write(VIRTUAL.pack(*v))
+        os.rename(tmpName, fname)
+    except:
+        os.remove(tmpName)
+        raise
+
+
+class RouteIndex(object):
+    """Routing table read from a compiled index mapped in memory.
+
+    It can be used instead of a ``RoutingCache`` to resolve the routes. The
+    index is never loaded completely. The pages of the file are read when
+    needed and shared by all processes using the same index.
+
+    :param fname: Name of the index file
+    :type fname: str
+    :raise: ValueError if the file is not a valid index
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mm) < HEADER.size:
+            raise ValueError('%s is not a route index' % fname)
+        magic, version, self.nStrings, self.nRoutes, self.nMaster, \
+            self.nNetworks, self.nVirtual = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a route index' % fname)
+        if version != VERSION:
+            raise ValueError('Version %d of route index not supported' % version)
+
+        self.offsets = HEADER.size
+        self.strings = self.offsets + (self.nStrings + 1) * OFFSET.size
+        self.routes = self.strings + OFFSET.unpack_from(self.mm, self.offsets +
+                                                        self.nStrings * OFFSET.size)[0]
+        self.master = self.routes + self.nRoutes * ROUTE.size
+        self.networks = self.master + self.nMaster * ROUTE.size
+        self.virtual = self.networks + self.nNetworks * NETWORK.size
+        if len(self.mm) < self.virtual + self.nVirtual * VIRTUAL.size:
+            raise ValueError('Route index %s is truncated' % fname)
+
+        self.cache = dict()
+        # Networks with wildcards must be checked for every stream
+        self.wildNetworks = [n for n in range(self.nNetworks)
+                             if _wildcard(self.string(self.__network(n)[0]))]
+
+    def close(self):
+        self.mm.close()
+
+    def string(self, pos):
+        """Return the string with the given position."""
+        try:
+            return self.cache[pos]
+        except KeyError:
+            pass
+
+        start, end = struct.unpack_from('<2I', self.mm, self.offsets + pos * OFFSET.size)
+        s = intern(self.mm[self.strings + start:self.strings + end])
+        self.cache[pos] = s
+        return s
+
+    def find(self, s):
+        """Return the position of a string or None if it is not in the index."""
+        lo, hi = 0, self.nStrings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(mid) < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nStrings and self.string(lo) == s:
+            return lo
+        return None
+
+    def __network(self, pos):
+        return NETWORK.unpack_from(self.mm, self.networks + pos * NETWORK.size)
+
+    def __candidates(self, net):
+        """Return the range of routes which could match the network code."""
+        if _wildcard(net):
+            return [(0, self.nRoutes)]
+
+        result = list()
+        netID = self.find(net)
+        if netID is not None:
+            ids = _LazySequence(self.nNetworks, lambda n: self.__network(n)[0])
+            pos = bisect.bisect_left(ids, netID)
+            if pos < self.nNetworks:
+                code, first, count = self.__network(pos)
+                if code == netID:
+                    result.append((first, first + count))
+
+        for n in self.wildNetworks:
+            code, first, count = self.__network(n)
+            result.append((first, first + count))
+        return result
+
+    def __codes(self, st, r):
+        """Return the codes of the stream restricted to the route or None."""
+        codes = list()
+        for code, routeCode in zip(st, r[:4]):
+            code = _intersect(code, self.string(routeCode))
+            if code is None:
+                return None
+            codes.append(code)
+        return codes
+
+    def __match(self, base, ranges, st, start, end, service):
+        """Return the routes matching the stream, time window and service.
+
+        Only the routes with the best priority are returned for every stream
+        of the routing table.
+        """
+        best = dict()
+        for first, last in ranges:
+            for pos in xrange(first, last):
+                r = ROUTE.unpack_from(self.mm, base + pos * ROUTE.size)
+                if r[4] != service or max(start, r[7]) >= min(end, r[8]):
+                    continue
+
+                codes = self.__codes(st, r)
+                if codes is None:
+                    continue
+
+                key = r[:4]
+                if key not in best or r[6] < best[key][0]:
+                    best[key] = (r[6], list())
+                if r[6] == best[key][0]:
+                    best[key][1].append((self.string(r[5]), r[6], codes,
+                                         max(start, r[7]), min(end, r[8])))
+
+        result = list()
+        for priority, routes in best.itervalues():
+            result.extend(routes)
+        result.sort(key=lambda x: (x[2], x[3]))
+        return result
+
+    def __resolve(self, st, start, end, service):
+        """Return the routes of the stream. The master table has precedence."""
+        master = self.__match(self.master, [(0, self.nMaster)], st, start, end, service)
+        result = self.__match(self.routes, self.__candidates(st[0]), st, start,
+                              end, service)
+
+        # Skip the streams already covered by the master table
+        result = [r for r in result if not any(
+            [all([fnmatch(c, m) for c, m in zip(r[2], mr[2])]) for mr in master])]
+        return master + result
+
+    def __virtual(self, code):
+        """Return the streams and time windows of a virtual network."""
+        result = list()
+        codeID = self.find(code)
+        if codeID is None:
+            return result
+
+        codes = _LazySequence(self.nVirtual, lambda v: VIRTUAL.unpack_from(
+            self.mm, self.virtual + v * VIRTUAL.size)[0])
+        pos = bisect.bisect_left(codes, codeID)
+        while pos < self.nVirtual:
+            v = VIRTUAL.unpack_from(self.mm, self.virtual + pos * VIRTUAL.size)
+            if v[0] != codeID:
+                break
+            result.append(([self.string(c) for c in v[1:5]], v[5], v[6]))
+            pos += 1
+        return result
+
+    def getRoute(self, st, tw, service='dataselect'):
+        """Return the routes for a stream and time window.
+
+        It has the same interface as ``RoutingCache.getRoute``.
+
+        :raise: RoutingException if no route was found
+        """
+        serviceID = self.find(service)
+        start, end = _time2float(tw.start, -INF), _time2float(tw.end, INF)
+        st = list(st)
+
+        found = list()
+        if serviceID is not None:
+            members = self.__virtual(st[0])
+            if not len(members):
+                found = self.__resolve(st, start, end, serviceID)
+
+            for codes, vstart, vend in members:
+                sub = [codes[0]] + [_intersect(c, v) for c, v in zip(st[1:], codes[1:])]
+                if None in sub or max(start, vstart) >= min(end, vend):
+                    continue
+                found.extend(self.__resolve(sub, max(start, vstart),
+                                            min(end, vend), serviceID))
+
+        if not len(found):
+            raise RoutingException('No routes have been found for %s' % str(st))
+
+        result = RequestMerge()
+        for address, priority, codes, rstart, rend in found:
+            result.append(service, address, priority, Stream(*codes),
+                          TW(_float2time(rstart), _float2time(rend)))
+        return result
+
+
+class _LazySequence(object):
+    """Sequence whose items are computed when accessed (e.g. for bisect)."""
+
+    def __init__(self, length, getter):
+        self.length = length
+        self.getter = getter
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, pos):
+        return self.getter(pos)
@@ -0,0 +1,153 @@
+"""Remember the routes resolved by the routing cache
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import copy
+import datetime
+import threading
+from collections import OrderedDict
+
+from routing.routeutils.utils import RoutingException
+
+
+class RouteMemo(object):
+    """Bounded LRU of the routes returned by ``RoutingCache.getRoute``.
+
+    Time windows are extended to buckets of ``bucket`` seconds (e.g. whole
+    days), so that requests for different time windows within the same
+    bucket share the result. The result is clipped to the time window
+    actually requested before it is returned. Streams without routes are
+    also remembered.
+
+    :param routes: Object resolving the routes (e.g. a RoutingCache)
+    :type routes: RoutingCache
+    :param maxSize: Maximum number of results kept
+    :type maxSize: int
+    :param bucket: Size of the time buckets in seconds
+    :type bucket: int
+    """
+
+    def __init__(self, routes, maxSize=10000, bucket=86400):
+        self.routes = routes
+        self.maxSize = maxSize
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __floor(self, t):
+        if t is None:
+            return None
+        epoch = datetime.datetime(1970, 1, 1)
+        offset = (t - epoch).total_seconds() % self.bucket
+        return t - datetime.timedelta(seconds=offset)
+
+    def __ceil(self, t):
+        if t is None:
+            return None
+        start = self.__floor(t)
+        if start == t:
+            return t
+        return start + datetime.timedelta(seconds=self.bucket)
+
+    def invalidate(self, routes=None):
+        """Forget all results, e.g. because the routing table was reloaded.
+
+        :param routes: New object resolving the routes
+        :type routes: RoutingCache
+        """
+        with self.lock:
+            if routes is not None:
+                self.routes = routes
+            self.results = OrderedDict()
+
+    def getRoute(self, st, tw, service='dataselect', routes=None):
+        """Return the routes for a stream and time window.
+
+        :param routes: Routing table expected. If it is not the current one
+            (e.g. it was replaced meanwhile), the memo is not used.
+        :type routes: RoutingCache
+        :raise: RoutingException if no route was found
+        """
+        if routes is not None and routes is not self.routes:
+            return routes.getRoute(st, tw, service)
+
+        start, end = self.__floor(tw.start), self.__ceil(tw.end)
+        key = (st, start, end, service)
+
+        with self.lock:
+            routes = self.routes
+            result = self.results.pop(key, None)
+            if result is not None:
+                self.results[key] = result
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if result is None:
+            try:
+                result = routes.getRoute(st, type(tw)(start, end), service)
+            except RoutingException as e:
+                result = e
+
+            with self.lock:
+                # Results from a previous routing table are not saved
+                if routes is self.routes:
+                    self.results[key] = result
+                    while len(self.results) > self.maxSize:
+                        self.results.popitem(last=False)
+
+        if isinstance(result, RoutingException):
+            raise result
+
+        return self.__clip(result, tw)
+
+    def __clip(self, result, tw):
+        """Return a copy of the result restricted to the time window."""
+        result = copy.deepcopy(result)
+        for dc in list(result):
+            params = list()
+            for item in dc['params']:
+                if tw.start is not None and \
+                        (item['start'] in (None, '') or item['start'] < tw.start):
+                    item['start'] = tw.start
+                if tw.end is not None and \
+                        (item['end'] in (None, '') or item['end'] > tw.end):
+                    item['end'] = tw.end
+                if item['start'] not in (None, '') and item['end'] not in (None, '') \
+                        and item['start'] >= item['end']:
+                    continue
+                params.append(item)
+
+            if len(params):
+                dc['params'] = params
+            else:
+                result.remove(dc)
+
+        if not len(result):
+            raise RoutingException('No routes in the time window requested')
+
+        return result
+
+    def stats(self):
+        """Return the counters of the memo."""
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self.results),
+                    'hitRate': float(self.hits) / total if total else 0.0}
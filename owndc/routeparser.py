@@ -0,0 +1,133 @@
+"""Parse routing files incrementally with a low memory footprint
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import logging
+import resource
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from routing.routeutils.utils import Route
+from routing.routeutils.utils import Stream
+from routing.routeutils.utils import TW
+from routing.routeutils.utils import str2date
+
+
+def _localName(tag):
+    """Return the name of a tag without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _date(value):
+    if value is None or not len(value.strip()):
+        return None
+    return str2date(value.strip())
+
+
+def _stream(elem):
+    return Stream(elem.get('networkCode', '*').strip(),
+                  elem.get('stationCode', '*').strip(),
+                  elem.get('locationCode', '*').strip(),
+                  elem.get('streamCode', '*').strip())
+
+
+def peakMemory():
+    """Return the peak resident memory of the process in kB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def overlaps(routes, route):
+    """Check whether a route overlaps with one of a list of routes.
+
+    Routes overlap if they are for the same service with the same priority
+    and their time windows intersect.
+    """
+    for r in routes:
+        if r.service != route.service or r.priority != route.priority:
+            continue
+        if (r.tw.end is None or route.tw.start is None or route.tw.start < r.tw.end) and \
+                (route.tw.end is None or r.tw.start is None or r.tw.start < route.tw.end):
+            return True
+    return False
+
+
+def parseRoutes(fname, ptRT=None, ptVN=None, allowOverlaps=False):
+    """Add the routes and virtual networks of a routing file to the tables.
+
+    The file is read incrementally and every ``route`` and ``vnetwork``
+    element is released as soon as it was added, so that the document is
+    never completely in memory.
+
+    :param fname: Routing file
+    :type fname: str
+    :param ptRT: Routing table where the routes are added
+    :type ptRT: dict
+    :param ptVN: Table where the virtual networks are added
+    :type ptVN: dict
+    :param allowOverlaps: If False, the routes overlapping the ones already
+        in the routing table for the same stream are skipped (see
+        :func:`overlaps`)
+    :type allowOverlaps: bool
+    :returns: Routing table and virtual networks
+    :rtype: tuple
+    """
+    log = logging.getLogger('parseRoutes')
+    ptRT = ptRT if ptRT is not None else dict()
+    ptVN = ptVN if ptVN is not None else dict()
+
+    root = None
+    routes = 0
+    skipped = 0
+    for event, elem in ET.iterparse(fname, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+
+        tag = _localName(elem.tag)
+        if tag == 'route':
+            st = _stream(elem)
+            # The services of the same element can overlap
+            existing = list(ptRT.get(st, list()))
+            for service in elem:
+                tw = TW(_date(service.get('start')), _date(service.get('end')))
+                route = Route(_localName(service.tag), service.get('address'), tw,
+                              int(service.get('priority', 1)))
+                if not allowOverlaps and overlaps(existing, route):
+                    skipped += 1
+                    continue
+                ptRT.setdefault(st, list()).append(route)
+                routes += 1
+
+        elif tag == 'vnetwork':
+            code = elem.get('networkCode').strip()
+            for member in elem:
+                tw = TW(_date(member.get('start')), _date(member.get('end')))
+                ptVN.setdefault(code, list()).append((_stream(member), tw))
+
+        else:
+            continue
+
+        # Release the elements already processed
+        elem.clear()
+        if root is not None:
+            root.clear()
+
+    log.debug('%d routes read from %s (%d overlapping routes skipped)' % (routes, fname, skipped))
+    return ptRT, ptVN
@@ -0,0 +1,461 @@
+"""Local cache of the waveforms retrieved from the data centres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2017 Javier Quinteros, GEOFON, GFZ Potsdam <geofon@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+from fnmatch import fnmatch
+
+from mseed import filterRecords
+from mseed import iterOffsets
+from mseed import iterRecords
+from mseed import recordHeader
+
+# Format used to save the dates in the index
+DATEFMT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CachedSegment(object):
+    """Part of a cached segment to be used as a source of a ResultFile.
+
+    It has the same interface as :class:`DSRequest`. Only the records
+    overlapping the time window requested are returned. As in the
+    parameters of an :class:`UpstreamRequest`, ``trim`` holds the limits
+    (start, end or None) of the start time of the records to return, so
+    that the records crossing the start of the segment are not returned
+    again after the previous source.
+
+    The segment is pinned in the cache until it is read (or discarded), so
+    that it cannot be evicted in the meantime. ``request`` is the request
+    to the data centre to use if the file cannot be read anyway.
+    """
+
+    def __init__(self, cache, entry, start, end, request=None):
+        self.cache = cache
+        self.entry = entry
+        self.start = start
+        self.end = end
+        self.request = request
+        self.trim = (None, None)
+        self.u = None
+        self.pinned = True
+
+    def __str__(self):
+        return 'cache:%s %s %s' % ('.'.join(self.entry['stream']),
+                                   self.start.isoformat(),
+                                   self.end.isoformat())
+
+    def __del__(self):
+        self.release()
+
+    def release(self):
+        """Unpin the segment in the cache."""
+        if self.pinned:
+            self.pinned = False
+            self.cache.unpin(self.entry)
+
+    def open(self):
+        """Open the cached file.
+
+        :returns: False if the file cannot be read. It is then removed from
+            the cache.
+        :rtype: bool
+        """
+        if self.u is not None:
+            return True
+        try:
+            self.u = open(os.path.join(self.cache.path, self.entry['file']), 'rb')
+            return True
+        except IOError as e:
+            self.cache.log.warning('Cached segment %s cannot be read. %s' % (self, e))
+            self.cache.forget(self.entry)
+            self.release()
+            return False
+
+    def __enter__(self):
+        if not self.open():
+            raise IOError('Cached segment %s cannot be read' % self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.u.close()
+        self.u = None
+        self.release()
+
+    def keep(self, header):
+        """Check whether a record overlaps the time window of the segment."""
+        start, end = header[4], header[5]
+        lower, upper = self.trim
+        return start <= self.end and end >= self.start and \
+            (lower is None or start >= lower) and (upper is None or start < upper)
+
+    def records(self, pool, stop=None):
+        for buf, chunk in iterRecords(self.u, pool, stop):
+            chunk = filterRecords(buf, chunk, self.keep)
+            if len(chunk):
+                yield buf, chunk
+            else:
+                pool.release(buf)
+
+
+class CacheWriter(object):
+    """Split the records of an upstream request and store them in the cache.
+
+    Every record is saved in a temporary file for each of the parameters of
+    the request it belongs to. The files are added to the cache only when
+    :meth:`commit` is called after the whole response was read.
+
+    Data centres return the records crossing the limit of two adjacent time
+    windows of the same request for both of them. They are saved only once
+    in every file.
+    """
+
+    def __init__(self, cache, params):
+        self.log = logging.getLogger('WaveformCache')
+        self.cache = cache
+        self.params = [item for item in params if cache.cacheable(item)]
+        self.files = [None] * len(self.params)
+        # Headers of the records crossing the limits of every parameter
+        self.crossing = [set() for item in self.params]
+        # Only the file of the last parameter is kept open
+        self.current = None
+        self.fh = None
+
+    def __open(self, i):
+        if self.current == i:
+            return self.fh
+
+        if self.fh is not None:
+            self.fh.close()
+
+        if self.files[i] is None:
+            fd, self.files[i] = tempfile.mkstemp(suffix='.tmp', dir=self.cache.path)
+            self.fh = os.fdopen(fd, 'wb')
+        else:
+            self.fh = open(self.files[i], 'ab')
+        self.current = i
+        return self.fh
+
+    def write(self, chunk):
+        try:
+            for pos, reclen in iterOffsets(chunk):
+                net, sta, loc, cha, start, end = recordHeader(chunk, pos)
+                for i, item in enumerate(self.params):
+                    if start > item['end'] or end < item['start']:
+                        continue
+                    if not (fnmatch(net, item['net']) and fnmatch(sta, item['sta']) and
+                            fnmatch(loc, item['loc']) and fnmatch(cha, item['cha'])):
+                        continue
+                    if start < item['start'] or end > item['end']:
+                        header = (net, sta, loc, cha, start, end)
+                        if header in self.crossing[i]:
+                            continue
+                        self.crossing[i].add(header)
+                    self.__open(i).write(chunk[pos:pos + reclen])
+        except ValueError as e:
+            # Data which is not miniSEED is never cached
+            self.log.warning('Response cannot be cached: %s' % e)
+            self.discard()
+            self.params = list()
+            self.files = list()
+            self.crossing = list()
+
+    def commit(self):
+        """Add the data received to the cache."""
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+        for item, fname in zip(self.params, self.files):
+            if fname is not None:
+                self.cache.add(item, fname)
+        self.files = [None] * len(self.params)
+
+    def discard(self):
+        """Remove the data received, e.g. because the response is incomplete."""
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+        for fname in self.files:
+            if fname is not None:
+                os.remove(fname)
+        self.files = [None] * len(self.params)
+        self.crossing = [set() for item in self.params]
+
+
+class WaveformCache(object):
+    """Keep the waveforms retrieved from the data centres in a local directory.
+
+    Data is saved per stream (N, S, L, C as requested from the data centre)
+    and time window. When the total size exceeds ``maxSize`` bytes the least
+    recently used segments are removed, except the ones planned to be read.
+    Time windows ending less than ``minAge`` seconds ago are not cached,
+    because data could still arrive. Segments whose time window ended less
+    than ``recentAge`` seconds before they were cached could still be
+    completed by the data centre. They expire ``ttl`` seconds after they
+    were cached and are then requested again.
+
+    The index is saved to disk after ``saveEvery`` new segments, after
+    ``saveInterval`` seconds with unsaved changes or by :meth:`flush`.
+    Files not found in the index when the cache is opened are removed.
+    """
+
+    # Limits of the unsaved changes of the index
+    saveEvery = 100
+    saveInterval = 60
+
+    def __init__(self, path=None, maxSize=1024 * 1024 * 1024, minAge=86400,
+                 recentAge=7 * 86400, ttl=86400):
+        self.log = logging.getLogger('WaveformCache')
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.owndc', 'cache')
+        self.path = path
+        self.maxSize = maxSize
+        self.minAge = minAge
+        self.recentAge = recentAge
+        self.ttl = ttl
+        # Segments can be unpinned when they are garbage collected
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Segments per file and per stream
+        self.entries = dict()
+        self.streams = dict()
+        self.size = 0
+        try:
+            with open(os.path.join(path, 'index.json')) as fin:
+                index = json.load(fin)
+            for entry in index:
+                entry['start'] = datetime.datetime.strptime(entry['start'], DATEFMT)
+                entry['end'] = datetime.datetime.strptime(entry['end'], DATEFMT)
+                self.__insert(entry)
+        except IOError:
+            pass
+        except Exception as e:
+            self.log.error('Cache index could not be read. Starting empty. %s' % e)
+            self.entries = dict()
+            self.streams = dict()
+            self.size = 0
+
+        # Files of the segments added after the last save of the index
+        for fname in os.listdir(path):
+            if fname.endswith(('.mseed', '.tmp')) and fname not in self.entries:
+                self.log.debug('Removing %s not found in the index' % fname)
+                os.remove(os.path.join(path, fname))
+
+        self.unsaved = 0
+        self.lastSave = time.time()
+
+    def __insert(self, entry):
+        """Add a segment to the index. Lock must be held."""
+        entry['pins'] = 0
+        self.entries[entry['file']] = entry
+        self.streams.setdefault(tuple(entry['stream']), list()).append(entry)
+        self.size += entry['size']
+
+    def __remove(self, entry):
+        """Remove a segment from the index. Lock must be held."""
+        del self.entries[entry['file']]
+        segments = self.streams[tuple(entry['stream'])]
+        segments.remove(entry)
+        if not len(segments):
+            del self.streams[tuple(entry['stream'])]
+        self.size -= entry['size']
+        self.unsaved += 1
+
+    def __delete(self, entry):
+        """Remove a segment and its file. Lock must be held."""
+        self.__remove(entry)
+        try:
+            os.remove(os.path.join(self.path, entry['file']))
+        except OSError:
+            pass
+
+    def __save(self):
+        """Save the index of the cache. Lock must be held."""
+        index = list()
+        for entry in self.entries.itervalues():
+            entry = dict(entry)
+            del entry['pins']
+            entry['start'] = entry['start'].strftime(DATEFMT)
+            entry['end'] = entry['end'].strftime(DATEFMT)
+            index.append(entry)
+
+        fname = os.path.join(self.path, 'index.json')
+        with open(fname + '.tmp', 'w') as fout:
+            json.dump(index, fout)
+        os.rename(fname + '.tmp', fname)
+        self.unsaved = 0
+        self.lastSave = time.time()
+
+    def flush(self):
+        """Save the index if it has unsaved changes, e.g. on shutdown."""
+        with self.lock:
+            if self.unsaved:
+                self.__save()
+
+    def __evict(self):
+        """Remove the oldest segments until the size is within the limits.
+
+        Segments pinned are not removed. Lock must be held.
+        """
+        if self.size <= self.maxSize:
+            return
+        for entry in sorted(self.entries.itervalues(), key=lambda e: e['atime']):
+            if self.size <= self.maxSize:
+                break
+            if entry['pins']:
+                continue
+            self.__delete(entry)
+            self.log.debug('Segment %s removed from the cache' % entry['file'])
+
+    def __expired(self, entry, now):
+        """Check whether a segment of recent data must be requested again."""
+        # Segments cached by previous versions have no creation time
+        ctime = entry.get('ctime', 0)
+        cached = datetime.datetime.utcfromtimestamp(ctime)
+        return cached - entry['end'] < datetime.timedelta(seconds=self.recentAge) and \
+            now - ctime >= self.ttl
+
+    def unpin(self, entry):
+        """Allow a segment to be evicted again."""
+        with self.lock:
+            entry['pins'] -= 1
+            if not entry['pins'] and entry['file'] in self.entries:
+                self.__evict()
+
+    def forget(self, entry):
+        """Remove a segment whose file cannot be read from the index."""
+        with self.lock:
+            if self.entries.get(entry['file']) is entry:
+                self.__remove(entry)
+
+    def cacheable(self, item):
+        """Check whether the data requested with these parameters can be cached."""
+        if not isinstance(item.get('start'), datetime.datetime) or \
+                not isinstance(item.get('end'), datetime.datetime):
+            return False
+        limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.minAge)
+        return item['end'] < limit
+
+    def lookup(self, item):
+        """Find the cached data for the stream and time window requested.
+
+        :param item: Parameters as returned by the routing (net, sta, loc,
+            cha, start, end)
+        :type item: dict
+        :returns: A list of sources with the cached data and a list of the
+            time windows (start, end) which must be requested remotely. The
+            sources are pinned until they are read.
+        :rtype: tuple
+        """
+        stream = (item['net'], item['sta'], item['loc'], item['cha'])
+        start, end = item['start'], item['end']
+
+        with self.lock:
+            now = time.time()
+            entries = list()
+            for e in list(self.streams.get(stream, list())):
+                if e['start'] >= end or e['end'] <= start:
+                    continue
+                if self.__expired(e, now):
+                    # Segments being read are replaced when they are added again
+                    if not e['pins']:
+                        self.__delete(e)
+                        self.log.debug('Segment %s expired' % e['file'])
+                    continue
+                entries.append(e)
+            entries.sort(key=lambda e: e['start'])
+
+            segments = list()
+            missing = list()
+            cursor = start
+            for entry in entries:
+                if entry['end'] <= cursor:
+                    continue
+                if entry['start'] > cursor:
+                    missing.append((cursor, entry['start']))
+                segments.append(CachedSegment(self, entry, max(cursor, entry['start']),
+                                              min(end, entry['end'])))
+                entry['pins'] += 1
+                entry['atime'] = now
+                cursor = entry['end']
+                if cursor >= end:
+                    break
+
+            if cursor < end:
+                missing.append((cursor, end))
+
+            if len(segments):
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return segments, missing
+
+    def writer(self, params):
+        """Return a :class:`CacheWriter` for the parameters of a request."""
+        return CacheWriter(self, params)
+
+    def add(self, item, fname):
+        """Add a file with the data of a stream and time window to the cache."""
+        stream = [item['net'], item['sta'], item['loc'], item['cha']]
+        key = '%s %s %s' % ('.'.join(stream), item['start'].isoformat(),
+                            item['end'].isoformat())
+        entry = {'stream': stream,
+                 'start': item['start'],
+                 'end': item['end'],
+                 'file': '%s.mseed' % hashlib.sha1(key).hexdigest(),
+                 'size': os.path.getsize(fname),
+                 'atime': time.time(),
+                 'ctime': time.time()}
+
+        with self.lock:
+            # Replace a previous version of the same segment
+            old = self.entries.get(entry['file'])
+            if old is not None:
+                if old['pins']:
+                    # It is being read. The new version is discarded.
+                    os.remove(fname)
+                    return
+                self.__remove(old)
+
+            os.rename(fname, os.path.join(self.path, entry['file']))
+            self.__insert(entry)
+            self.unsaved += 1
+            self.__evict()
+            if self.unsaved >= self.saveEvery or \
+                    time.time() - self.lastSave >= self.saveInterval:
+                self.__save()
+
+    def stats(self):
+        """Return the counters of the cache."""
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'segments': len(self.entries),
+                    'size': self.size}
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from testMSeed import record
+from owndc.mseed import BufferPool
+from owndc.wfcache import WaveformCache
+from owndc.planner import RequestPlanner
+from owndc.planner import UpstreamRequest
+
+
+def item(sta, start, end):
+    return {'net': 'GE', 'sta': sta, 'loc': '', 'cha': 'BHZ',
+            'start': start, 'end': end, 'priority': 1}
+
+
+class CacheTests(unittest.TestCase):
+    """Test the functionality of wfcache.py
+
+    """
+
+    t0 = datetime.datetime(2015, 3, 7, 14, 0, 0)
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = WaveformCache(self.path, maxSize=10 * 512)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def minute(self, m):
+        return self.t0 + datetime.timedelta(minutes=m)
+
+    def store(self, params, stations, minutes):
+        """Simulate the response of a data centre for the given params."""
+        writer = self.cache.writer(params)
+        for sta in stations:
+            for m in minutes:
+                writer.write(memoryview(bytearray(record(sta, 512, start=self.minute(m),
+                                                         nsamp=1200))))
+        writer.commit()
+
+    def read(self, segment):
+        pool = BufferPool(1, 4096)
+        data = ''
+        with segment as seg:
+            for buf, chunk in seg.records(pool):
+                data += chunk.tobytes()
+                pool.release(buf)
+        return data
+
+    def testMissing(self):
+        "missing time windows"
+
+        self.store([item('APE', self.minute(0), self.minute(3))], ['APE'], range(3))
+        segments, missing = self.cache.lookup(item('APE', self.minute(2), self.minute(6)))
+
+        self.assertEqual(len(segments), 1, 'One cached segment was expected!')
+        self.assertEqual(missing, [(self.minute(3), self.minute(6))],
+                         'Wrong time window to request remotely!')
+        self.assertEqual(len(self.read(segments[0])), 512,
+                         'Only one record overlaps the time window requested!')
+
+    def testPlanOrder(self):
+        "cached segments planned after earlier missing windows"
+
+        self.store([item('APE', self.minute(3), self.minute(5))], ['APE'], range(3, 5))
+        planner = RequestPlanner(cache=self.cache)
+        planner.add([{'url': 'http://localhost/query',
+                      'params': [item('APE', self.minute(0), self.minute(6))]}])
+        self.assertEqual(planner.ready(), [], 'The missing windows are still pending!')
+
+        reqs = planner.requests()
+        self.assertEqual([isinstance(r, UpstreamRequest) for r in reqs], [True, False],
+                         'The earlier missing window must be sent first!')
+        self.assertEqual(reqs[0].params[0]['end'], self.minute(3), 'Wrong missing window!')
+
+    def testSplitByParams(self):
+        "records stored per parameter of the request"
+
+        self.store([item('APE', self.minute(0), self.minute(2)),
+                    item('MORC', self.minute(0), self.minute(2))],
+                   ['APE', 'MORC'], range(2))
+
+        for sta in ('APE', 'MORC'):
+            segments, missing = self.cache.lookup(item(sta, self.minute(0), self.minute(2)))
+            self.assertEqual(missing, [], 'Time window fully cached for %s!' % sta)
+            self.assertEqual(len(self.read(segments[0])), 1024,
+                             'Wrong size of the cached data for %s!' % sta)
+
+    def testAdjacentSegments(self):
+        "record crossing the limit of two cached segments returned once"
+
+        params = [item('APE', self.minute(0), self.minute(3)),
+                  item('APE', self.minute(3), self.minute(6))]
+        crossing = record('APE', 512, seq=9, start=self.minute(2.5), nsamp=1200)
+        writer = self.cache.writer(params)
+        for m in range(6):
+            writer.write(memoryview(bytearray(record('APE', 512, start=self.minute(m),
+                                                     nsamp=1200))))
+            # Sent once for every line of the request
+            if m in (2, 3):
+                writer.write(memoryview(bytearray(crossing)))
+        writer.commit()
+
+        # The first segment also has the record starting at its end
+        self.assertEqual(self.cache.stats()['size'], 9 * 512,
+                         'The crossing record should be saved once per segment!')
+
+        planner = RequestPlanner(cache=self.cache)
+        planner.add([{'url': 'http://localhost/query',
+                      'params': [item('APE', self.minute(0), self.minute(6))]}])
+        data = ''.join([self.read(seg) for seg in planner.requests()])
+        self.assertEqual(len(data), 7 * 512, 'Records at the limit returned twice!')
+        self.assertEqual(data.count(crossing), 1, 'Crossing record expected once!')
+
+    def testExpiredSegment(self):
+        "segment of recent data requested again"
+
+        self.store([item('APE', self.minute(0), self.minute(3))], ['APE'], range(3))
+        segments, missing = self.cache.lookup(item('APE', self.minute(0), self.minute(3)))
+        self.assertEqual(missing, [], 'Old data should not expire!')
+        for seg in segments:
+            seg.release()
+
+        # Data of 2015 is recent for this cache and expires immediately
+        self.cache.flush()
+        cache = WaveformCache(self.path, maxSize=10 * 512, recentAge=100 * 365 * 86400, ttl=0)
+        segments, missing = cache.lookup(item('APE', self.minute(0), self.minute(3)))
+        self.assertEqual(segments, [], 'Expired segment should not be used!')
+        self.assertEqual(missing, [(self.minute(0), self.minute(3))],
+                         'Expired segment should be requested again!')
+        self.assertEqual(cache.stats()['segments'], 0, 'Expired segment should be removed!')
+
+    def testEviction(self):
+        "eviction of the least recently used segments"
+
+        self.store([item('APE', self.minute(0), self.minute(6))], ['APE'], range(6))
+        self.store([item('MORC', self.minute(0), self.minute(6))], ['MORC'], range(6))
+
+        self.assertLessEqual(self.cache.stats()['size'], 10 * 512, 'Cache too large!')
+        segments, missing = self.cache.lookup(item('APE', self.minute(0), self.minute(6)))
+        self.assertEqual(len(segments), 0, 'Oldest segment should be removed!')
+
+    def testPersistence(self):
+        "index saved to disk"
+
+        self.store([item('APE', self.minute(0), self.minute(3))], ['APE'], range(3))
+        self.store([item('MORC', self.minute(0), self.minute(3))], ['MORC'], range(3))
+        self.cache.flush()
+        # Segment added after the last save of the index
+        self.store([item('KBS', self.minute(0), self.minute(3))], ['KBS'], range(3))
+
+        cache = WaveformCache(self.path, maxSize=10 * 512)
+        segments, missing = cache.lookup(item('APE', self.minute(0), self.minute(3)))
+        self.assertEqual(missing, [], 'Data should be available after a restart!')
+        self.assertEqual(cache.stats()['segments'], 2, 'Only the saved segments expected!')
+        self.assertEqual(len(os.listdir(self.path)), 3, 'File not in the index should be removed!')
+
+    def testPinned(self):
+        "segments planned are not evicted"
+
+        self.store([item('APE', self.minute(0), self.minute(6))], ['APE'], range(6))
+        segments, missing = self.cache.lookup(item('APE', self.minute(0), self.minute(6)))
+        self.store([item('MORC', self.minute(0), self.minute(6))], ['MORC'], range(6))
+        self.assertEqual(len(self.read(segments[0])), 6 * 512, 'Pinned segment removed!')
+        self.assertLessEqual(self.cache.stats()['size'], 10 * 512, 'Cache too large!')
+
+    def testUnreadable(self):
+        "segment whose file cannot be read"
+
+        self.store([item('APE', self.minute(0), self.minute(3))], ['APE'], range(3))
+        segments, missing = self.cache.lookup(item('APE', self.minute(0), self.minute(3)))
+        os.remove(os.path.join(self.path, segments[0].entry['file']))
+        self.assertFalse(segments[0].open(), 'File should not be available!')
+        self.assertEqual(self.cache.stats()['segments'], 0, 'Segment should be forgotten!')
+
+    def testRecentData(self):
+        "recent data is not cached"
+
+        now = datetime.datetime.utcnow()
+        self.assertFalse(self.cache.cacheable(item('APE', now - datetime.timedelta(hours=1), now)),
+                         'Data from the last day should not be cached!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testCache [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CacheTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
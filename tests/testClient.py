@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import shutil
+import datetime
+import unittest
+
+from unittestTools import WITestRunner
+from testMSeed import record
+from owndc.owndccli import Journal
+from owndc.owndccli import MSeedWriter
+from owndc.owndccli import SDSWriter
+from owndc.owndccli import RetryScheduler
+from owndc.owndccli import DownloadReport
+from owndc.owndccli import RequestLine
+from owndc.owndccli import LineState
+from owndc.owndccli import BlockDemux
+from owndc.planner import UpstreamRequest
+
+
+class ClientTests(unittest.TestCase):
+    """Test the functionality of owndccli.py
+
+    """
+
+    output = 'tests/test-owndccli'
+
+    def setUp(self):
+        "Saving three lines"
+        self.mseed = self.output + '.mseed'
+        self.journal = Journal(self.output + '.journal')
+        writer = MSeedWriter(self.mseed, self.journal)
+        for i, line in enumerate(['A', 'B', 'C']):
+            spool = writer.spool()
+            spool.write(memoryview(bytearray(record('STA%d' % i, 512) * (i + 1))))
+            writer.commit(line, spool)
+            spool.close()
+        writer.close()
+
+    def tearDown(self):
+        "Removing output and journal"
+        for fname in (self.mseed, self.journal.fname):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def testJournal(self):
+        "lines completed in the journal"
+
+        journal = Journal(self.journal.fname)
+        journal.load()
+        self.assertEqual(sorted(journal.completed()), ['A', 'B', 'C'],
+                         'Wrong lines completed!')
+        self.assertEqual([e['records'] for e in journal.entries.values()], [1, 2, 3],
+                         'Wrong number of records!')
+        self.assertEqual(journal.verify(self.mseed), 6 * 512, 'Wrong size verified!')
+
+    def testPartialLine(self):
+        "data of a line not completed at the end of the file"
+
+        with open(self.mseed, 'ab') as fout:
+            fout.write(record('STA9', 512)[:100])
+
+        journal = Journal(self.journal.fname)
+        journal.load()
+        self.assertEqual(journal.verify(self.mseed), 6 * 512, 'Wrong size verified!')
+        self.assertEqual(os.path.getsize(self.mseed), 6 * 512,
+                         'Incomplete data should be removed!')
+
+    def testTruncated(self):
+        "output shorter than the journal"
+
+        with open(self.mseed, 'r+b') as fout:
+            fout.truncate(4 * 512)
+
+        journal = Journal(self.journal.fname)
+        journal.load()
+        self.assertEqual(journal.verify(self.mseed), 3 * 512, 'Wrong size verified!')
+        self.assertEqual(sorted(journal.completed()), ['A', 'B'],
+                         'Line without data should be requested again!')
+
+        journal.load()
+        self.assertEqual(sorted(journal.completed()), ['A', 'B'],
+                         'Journal should be rewritten!')
+
+    def testSDS(self):
+        "records of two stations and days in an SDS archive"
+
+        path = 'tests/test-sds'
+        d1 = datetime.datetime(2015, 3, 7, 23, 59, 0)
+        d2 = datetime.datetime(2015, 3, 8, 0, 1, 0)
+        data = record('APE', 512, start=d1) + record('MORC', 512, start=d1) + \
+            record('APE', 512, start=d2) + record('APE', 512, start=d2)
+
+        writer = SDSWriter(path, self.journal, maxFiles=1)
+        try:
+            line = writer.spool()
+            line.write(memoryview(bytearray(data)))
+            self.assertEqual(os.listdir(path), [],
+                             'Records saved before the line is completed!')
+            writer.commit('GE * -- BHZ 2015-03-07T23:00:00 2015-03-08T01:00:00', line)
+            line.close()
+            writer.close()
+
+            sizes = dict()
+            for dirpath, dirnames, filenames in os.walk(path):
+                for fname in filenames:
+                    sizes[os.path.relpath(os.path.join(dirpath, fname), path)] = \
+                        os.path.getsize(os.path.join(dirpath, fname))
+            self.assertEqual(sizes, {'2015/GE/APE/BHZ.D/GE.APE..BHZ.D.2015.066': 512,
+                                     '2015/GE/MORC/BHZ.D/GE.MORC..BHZ.D.2015.066': 512,
+                                     '2015/GE/APE/BHZ.D/GE.APE..BHZ.D.2015.067': 1024},
+                             'Wrong files in the SDS archive!')
+            self.assertEqual(line.records, 4, 'Wrong number of records!')
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def testSDSRetry(self):
+        "records of a line retried saved once in an SDS archive"
+
+        path = 'tests/test-sds'
+        start = datetime.datetime(2015, 3, 7)
+        end = start + datetime.timedelta(hours=1)
+        routes = list()
+        for i, sta in enumerate(['STA0', 'STA1']):
+            item = {'net': 'GE', 'sta': sta, 'loc': '', 'cha': 'BHZ', 'start': start, 'end': end}
+            routes.append((0, 'http://dc%d/query' % i, item))
+
+        writer = SDSWriter(path, self.journal)
+        try:
+            state = LineState(RequestLine(4, 'D'), list(routes), writer.spool())
+            state.write('dc0', memoryview(bytearray(record('STA0', 512, start=start))), 1)
+            state.finished(UpstreamRequest(routes[0][1], [routes[0][2]]), 200, 0.1, 1.0)
+            state.write('dc1', memoryview(bytearray(record('STA1', 512, start=start))), 1)
+            state.retry()
+
+            state.attempt()
+            state.write('dc1', memoryview(bytearray(record('STA1', 512, start=start))), 1)
+            state.finished(UpstreamRequest(routes[1][1], [routes[1][2]]), 200, 0.1, 1.0)
+            state.close(writer)
+            writer.close()
+
+            for sta in ('STA0', 'STA1'):
+                fname = writer.fileName('GE', sta, '', 'BHZ', start)
+                self.assertEqual(os.path.getsize(fname), 512, 'Records saved twice!')
+            self.assertEqual(self.journal.entries['D']['records'], 2,
+                             'Wrong number of records!')
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def testRetry(self):
+        "retries of a line without data"
+
+        scheduler = RetryScheduler(['A', 'B'], retries=1, delay=0.1)
+        self.assertEqual(scheduler.next(), 'A', 'Lines must be requested in order!')
+        self.assertEqual(scheduler.next(), 'B', 'Lines must be requested in order!')
+        self.assertTrue(scheduler.done('A', {'dc1': 503}, True), 'Retry expected!')
+        self.assertFalse(scheduler.done('B', {'dc2': 200}, False), 'Unexpected retry!')
+
+        self.assertEqual(scheduler.next(), 'A', 'Line should be requested again!')
+        self.assertFalse(scheduler.done('A', {'dc1': 503}, True),
+                         'Maximum number of retries exceeded!')
+        self.assertIsNone(scheduler.next(), 'No more lines expected!')
+
+    def testRetryBudget(self):
+        "retries after the budget"
+
+        scheduler = RetryScheduler(['A'], retries=5, delay=0.1, budget=0)
+        scheduler.next()
+        self.assertFalse(scheduler.done('A', {}, True), 'Budget exhausted!')
+
+    def testNextBlock(self):
+        "lines taken in blocks"
+
+        scheduler = RetryScheduler(['A', 'B', 'C'], retries=1, delay=0)
+        self.assertEqual(scheduler.nextBlock(2), ['A', 'B'], 'Wrong first block!')
+        scheduler.done('A', {'dc1': 503}, True)
+        self.assertEqual(scheduler.nextBlock(2), ['A', 'C'], 'Retries go first!')
+        scheduler.done('B', {}, False)
+        scheduler.done('A', {}, False)
+        scheduler.done('C', {}, False)
+        self.assertEqual(scheduler.nextBlock(2), [], 'No more lines expected!')
+
+    def testDemux(self):
+        "records of a block assigned to their lines"
+
+        class Progress(object):
+            def lineReceived(self, line, size):
+                pass
+
+        start = datetime.datetime(2015, 3, 7)
+        hour = datetime.timedelta(hours=1)
+        writer = MSeedWriter(self.mseed, append=True)
+        states = list()
+        for i, (sta, s, e) in enumerate([('STA0', start, start + hour),
+                                         ('STA*', start, start + hour),
+                                         ('STA0', start + hour, start + 2 * hour)]):
+            item = {'net': 'GE', 'sta': sta, 'loc': '', 'cha': 'BHZ', 'start': s, 'end': e}
+            states.append(LineState(RequestLine(i + 1, str(i)),
+                                    [(0, 'http://dc%d/query' % i, item)], writer.spool()))
+
+        demux = BlockDemux(states, Progress())
+        # The record of the two overlapping lines is sent once for each of them
+        data = record('STA0', 512, start=start) + record('STA1', 512, start=start) + \
+            record('STA0', 512, start=start + hour * 3 / 2) + record('STA2', 512, start=start) + \
+            record('XXX', 512, start=start) + record('STA0', 512, start=start)
+        demux.write(memoryview(bytearray(data)))
+        writer.close()
+
+        self.assertEqual([s.spool.records for s in states], [1, 3, 1],
+                         'Records assigned to the wrong lines!')
+        self.assertEqual(states[1].data, {'dc1': [1536, 3]}, 'Wrong data per data centre!')
+        for s in states:
+            s.spool.close()
+
+    def testFailedRoutes(self):
+        "only the failed routes of a line are retried"
+
+        start = datetime.datetime(2015, 3, 7)
+        end = start + datetime.timedelta(hours=1)
+        routes = list()
+        for i, sta in enumerate(['STA0', 'STA1']):
+            item = {'net': 'GE', 'sta': sta, 'loc': '', 'cha': 'BHZ', 'start': start, 'end': end}
+            routes.append((0, 'http://dc%d/query' % i, item))
+
+        writer = MSeedWriter(self.mseed, append=True)
+        state = LineState(RequestLine(1, 'GE STA* -- BHZ'), list(routes), writer.spool())
+        self.assertEqual(state.failed(), routes, 'All routes of a line without data!')
+
+        state.write('dc0', memoryview(bytearray(record('STA0', 512, start=start))), 1)
+        state.finished(UpstreamRequest(routes[0][1], [routes[0][2]]), 200, 0.1, 1.0)
+        state.finished(UpstreamRequest(routes[1][1], [routes[1][2]]), 503, None, 1.0)
+        self.assertEqual(state.status(), {'dc0': 200, 'dc1': 503}, 'Wrong status!')
+        state.retry()
+        self.assertEqual(state.routes, routes[1:], 'Only the failed route expected!')
+
+        state.attempt()
+        state.finished(UpstreamRequest(routes[1][1], [routes[1][2]]), 204, 0.1, 1.0)
+        self.assertEqual(state.failed(), [], 'No route should be retried!')
+        state.close(writer)
+        writer.close()
+
+    def testCutTransfer(self):
+        "records of a transfer cut in the middle not repeated in the retry"
+
+        start = datetime.datetime(2015, 3, 7)
+        end = start + datetime.timedelta(hours=1)
+        routes = list()
+        for i, sta in enumerate(['STA0', 'STA1']):
+            item = {'net': 'GE', 'sta': sta, 'loc': '', 'cha': 'BHZ', 'start': start, 'end': end}
+            routes.append((0, 'http://dc%d/query' % i, item))
+
+        writer = MSeedWriter(self.mseed, self.journal, append=True)
+        state = LineState(RequestLine(4, 'D'), list(routes), writer.spool())
+        state.write('dc0', memoryview(bytearray(record('STA0', 512, start=start))), 1)
+        state.finished(UpstreamRequest(routes[0][1], [routes[0][2]]), 200, 0.1, 1.0)
+        # The connection to dc1 is lost after the first record
+        state.write('dc1', memoryview(bytearray(record('STA1', 512, start=start))), 1)
+        state.retry()
+        self.assertEqual(state.routes, routes[1:], 'Only the failed route expected!')
+        self.assertEqual(state.spool.records, 1, 'Records of the failed route should be discarded!')
+
+        state.attempt()
+        state.write('dc1', memoryview(bytearray(record('STA1', 512, start=start) +
+                                                record('STA1', 512, seq=2, start=start))), 2)
+        state.finished(UpstreamRequest(routes[1][1], [routes[1][2]]), 200, 0.1, 1.0)
+        self.assertEqual(state.failed(), [], 'No route should be retried!')
+        state.close(writer)
+        writer.close()
+
+        self.assertEqual(self.journal.entries['D']['records'], 3, 'Wrong number of records!')
+        self.assertEqual(os.path.getsize(self.mseed), 9 * 512, 'Records saved twice!')
+
+    def testReport(self):
+        "report of two lines and two data centres"
+
+        l1 = RequestLine(1, 'GE APE -- BHZ 2015-03-07T14:00:00 2015-03-07T15:00:00')
+        l2 = RequestLine(3, 'RO ARR -- BHZ 2015-03-07T14:00:00 2015-03-07T15:00:00')
+        report = DownloadReport(self.output, 'json')
+        report.start(l1)
+        report.add(l1, 'geofon.gfz-potsdam.de', 200, 2048, 4, 0.5, 2.0)
+        report.start(l2)
+        report.add(l2, 'eida-sc3.infp.ro', 503, 0, 0, None, 1.0)
+        report.start(l2)
+        report.add(l2, 'eida-sc3.infp.ro', 200, 1024, 2, 0.5, 1.0)
+
+        rows = report.finish(l2)
+        self.assertEqual([(r['attempt'], r['status']) for r in rows], [(1, 503), (2, 200)],
+                         'Wrong results for the line!')
+        report.finish(l1)
+        report.close()
+
+        try:
+            with open(self.output + '.json') as fin:
+                result = json.load(fin)
+        finally:
+            os.remove(self.output + '.json')
+
+        self.assertEqual([r['id'] for r in result['lines']], [3, 3, 1],
+                         'Lines must be reported when finished!')
+        self.assertEqual(result['lines'][2]['throughput'], 1024.0, 'Wrong throughput!')
+        nodes = dict([(n['dc'], n) for n in result['nodes']])
+        self.assertEqual(nodes['eida-sc3.infp.ro']['requests'], 2, 'Wrong number of requests!')
+        self.assertEqual(nodes['eida-sc3.infp.ro']['errors'], 1, 'Wrong number of errors!')
+        self.assertEqual(nodes['eida-sc3.infp.ro']['ttfb'], 0.5, 'Wrong time to first byte!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testClient [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ClientTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+import unittest
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from owndc.mseed import BufferPool
+from owndc.coalesce import SingleFlight
+
+
+class FakeRequest(object):
+    """Source returning a fixed number of chunks slowly."""
+
+    opened = 0
+
+    def __init__(self, chunks, delay=0.05):
+        self.chunks = chunks
+        self.delay = delay
+
+    def __enter__(self):
+        FakeRequest.opened += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def records(self, pool, stop=None):
+        for i in range(self.chunks):
+            time.sleep(self.delay)
+            buf = pool.get(stop)
+            mv = memoryview(buf)
+            mv[:512] = chr(65 + i) * 512
+            yield buf, mv[:512]
+
+
+class DeadlineRequest(FakeRequest):
+    """Source whose deadline can be changed and which can be cancelled."""
+
+    def __init__(self, chunks, delay=0.05, deadline=None):
+        super(DeadlineRequest, self).__init__(chunks, delay)
+        self.deadline = deadline
+        self.cancelled = False
+
+    def setDeadline(self, deadline):
+        self.deadline = deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+    def records(self, pool, stop=None):
+        for item in super(DeadlineRequest, self).records(pool, stop):
+            if self.cancelled:
+                raise Exception('Request cancelled')
+            yield item
+
+
+def readAll(source, result):
+    pool = BufferPool(2, 4096)
+    data = ''
+    with source as src:
+        for buf, chunk in src.records(pool):
+            data += chunk.tobytes()
+            pool.release(buf)
+    result.append(data)
+
+
+class CoalesceTests(unittest.TestCase):
+    """Test the functionality of coalesce.py
+
+    """
+
+    def setUp(self):
+        FakeRequest.opened = 0
+
+    def testSharedData(self):
+        "identical requests downloaded once"
+
+        flights = SingleFlight(maxChunks=2)
+        key = ('http://localhost/query', None)
+        sources = [flights.source(key, FakeRequest(5)) for i in range(3)]
+
+        results = list()
+        threads = [threading.Thread(target=readAll, args=(s, results)) for s in sources]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        expected = ''.join([chr(65 + i) * 512 for i in range(5)])
+        self.assertEqual(FakeRequest.opened, 1, 'Data should be downloaded only once!')
+        self.assertEqual(results, [expected] * 3, 'All readers should get all the data!')
+        self.assertEqual(flights.coalesced, 2, 'Two requests should be coalesced!')
+        self.assertEqual([s.driver for s in sources], [True, False, False],
+                         'Only the first request drives the download!')
+
+    def testLateReader(self):
+        "no sharing once the first chunk was released"
+
+        flights = SingleFlight(maxChunks=1)
+        key = ('http://localhost/query', None)
+        first = flights.source(key, FakeRequest(5, 0))
+        results = list()
+        readAll(first, results)
+
+        second = flights.source(key, FakeRequest(5, 0))
+        readAll(second, results)
+        self.assertEqual(FakeRequest.opened, 2, 'A new download was expected!')
+        self.assertEqual(results[0], results[1], 'Both readers should get all the data!')
+
+    def testStalledReader(self):
+        "requests in opposite order do not block each other"
+
+        flights = SingleFlight(maxChunks=2, stallTimeout=0.5)
+        keys = [('http://localhost/A', None), ('http://localhost/B', None)]
+
+        def fallback():
+            return FakeRequest(6, 0)
+
+        def readInOrder(owner, order, results):
+            # Both sources are opened before reading them, like a ResultFile
+            sources = [flights.source(keys[k], FakeRequest(6, 0), owner, fallback)
+                       for k in order]
+            for s in sources:
+                readAll(s, results)
+
+        first = list()
+        second = list()
+        threads = [threading.Thread(target=readInOrder, args=('first', (0, 1), first)),
+                   threading.Thread(target=readInOrder, args=('second', (1, 0), second))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        self.assertFalse(any([t.is_alive() for t in threads]), 'Readers are blocked!')
+        expected = ''.join([chr(65 + i) * 512 for i in range(6)])
+        self.assertEqual(first, [expected] * 2, 'All the data should be read!')
+        self.assertEqual(second, [expected] * 2, 'All the data should be read!')
+
+    def testSameOwner(self):
+        "sources of the same owner are not shared"
+
+        flights = SingleFlight(maxChunks=2)
+        key = ('http://localhost/query', None)
+        first = flights.source(key, FakeRequest(3, 0), 'owner')
+        second = flights.source(key, FakeRequest(3, 0), 'owner')
+        self.assertIsInstance(second, FakeRequest, 'The source should not be shared!')
+
+        results = list()
+        readAll(first, results)
+        readAll(second, results)
+        self.assertEqual(results[0], results[1], 'Both readers should get all the data!')
+
+    def testDeadline(self):
+        "latest deadline of the readers and cancel when all left"
+
+        flights = SingleFlight(maxChunks=2)
+        key = ('http://localhost/query', None)
+        upstream = DeadlineRequest(100, deadline=100.0)
+        first = flights.source(key, upstream, 'first')
+        second = flights.source(key, DeadlineRequest(100, deadline=200.0), 'second')
+        self.assertEqual(upstream.deadline, 200.0, 'The latest deadline should be used!')
+
+        with second:
+            pass
+        self.assertEqual(upstream.deadline, 100.0, 'Deadline of the reader left!')
+        self.assertFalse(upstream.cancelled, 'One reader is still attached!')
+
+        with first:
+            pass
+        self.assertTrue(upstream.cancelled, 'The request should be cancelled!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testCoalesce [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CoalesceTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
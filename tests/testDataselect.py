@@ -7,6 +7,7 @@ import os
 # sys.path.append(os.path.join(here, '..'))
 
 import unittest
+from StringIO import StringIO
 from unittestTools import WITestRunner
 from owndc.owndc import FakeStorage
 from owndc.owndc import DataSelectQuery
@@ -80,6 +81,44 @@ RO VOIR -- BHZ 2015-07-07T14:48:47.0000 2015-07-07T15:18:47.0000"""
         msg = 'Error in number of records! Expected records within the range: %s, but obtained %s'
         self.assertIn(int(lenData / 512.0), range(*numRecords), msg % (numRecords, int(lenData/512)))
 
+    def testDS_RO_POST_lines(self):
+        "Dataselect via POST method with the lines read from a file"
+
+        postReq = """RO ARR -- BHZ 2015-03-07T14:39:36.0000 2015-03-07T15:09:36.0000
+RO VOIR -- BHZ 2015-07-07T14:48:47.0000 2015-07-07T15:18:47.0000"""
+
+        lenBody = sum([len(chunk) for chunk in self.ds.makeQueryPOST(postReq)])
+        lenLines = sum([len(chunk) for chunk in self.ds.makeQueryPOST(StringIO(postReq))])
+
+        msg = 'Different data for the body and the lines! %d != %d'
+        self.assertEqual(lenBody, lenLines, msg % (lenBody, lenLines))
+
+    def testDS_observer(self):
+        "Progress of the sources of RO.ARR.--.BHZ"
+
+        class Observer(object):
+            def __init__(self):
+                self.size = 0
+                self.status = list()
+
+            def started(self, url):
+                pass
+
+            def received(self, url, size):
+                self.size += size
+
+            def finished(self, url, status, size, records, ttfb, duration):
+                self.status.append(status)
+
+        postReq = 'RO ARR -- BHZ 2015-03-07T14:39:36.0000 2015-03-07T15:09:36.0000'
+        observer = Observer()
+        lenData = 0
+        for chunk in self.ds.makeQueryPOST(postReq, observer=observer):
+            lenData += len(chunk)
+
+        self.assertEqual(observer.size, lenData, 'Wrong number of bytes observed!')
+        self.assertEqual(observer.status, [200], 'Wrong status of the source!')
+
     def testDS_XX(self):
         "Unknown network XX"
 
@@ -120,6 +159,18 @@ RO VOIR -- BHZ 2015-07-07T14:48:47.0000 2015-07-07T15:18:47.0000"""
 
         self.assertRaises(WIClientError, self.ds.makeQueryGET, params)
 
+    def testReload(self):
+        "Reload of the routing table"
+
+        oldRoutes = self.ds.routes
+        self.assertTrue(self.ds.reload(), 'Routing table could not be reloaded!')
+        self.assertIsNot(self.ds.routes, oldRoutes, 'Routing table was not replaced!')
+        if self.ds.memo is not None:
+            self.assertIs(self.ds.memo.routes, self.ds.routes,
+                          'Memo still uses the previous routing table!')
+            self.assertEqual(self.ds.memo.stats()['size'], 0,
+                             'Memo was not invalidated!')
+
 # ----------------------------------------------------------------------
 def usage():
     print 'testDataselect [-h] [-p]'
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import unittest
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from owndc.health import HealthRegistry
+
+
+class HealthTests(unittest.TestCase):
+    """Test the functionality of health.py
+
+    """
+
+    url = 'http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query'
+
+    def testOpenCircuit(self):
+        "circuit opened after consecutive failures"
+
+        health = HealthRegistry(threshold=3, cooldown=60)
+        for i in range(2):
+            health.failure(self.url, 1.0)
+        self.assertTrue(health.allow(self.url), 'Circuit should still be closed!')
+
+        health.failure(self.url, 1.0)
+        self.assertFalse(health.allow(self.url), 'Circuit should be open!')
+        self.assertEqual(health.status()[self.url]['state'], 'open',
+                         'Wrong state of the circuit!')
+
+    def testSuccessResets(self):
+        "success resets the consecutive failures"
+
+        health = HealthRegistry(threshold=2, cooldown=60)
+        health.failure(self.url)
+        health.success(self.url, 0.5)
+        health.failure(self.url)
+        self.assertTrue(health.allow(self.url), 'Circuit should still be closed!')
+        self.assertEqual(health.status()[self.url]['latency'], 0.5,
+                         'Wrong latency of the service!')
+
+    def testProbe(self):
+        "probe after the cooldown period"
+
+        health = HealthRegistry(threshold=1, cooldown=0.2)
+        health.failure(self.url)
+        self.assertFalse(health.allow(self.url), 'Circuit should be open!')
+
+        time.sleep(0.3)
+        self.assertTrue(health.allow(self.url), 'One probe should be allowed!')
+        self.assertFalse(health.allow(self.url), 'Only one probe should be allowed!')
+
+        health.success(self.url)
+        self.assertTrue(health.allow(self.url), 'Circuit should be closed after the probe!')
+
+    def testFailedProbe(self):
+        "failed probe opens the circuit again"
+
+        health = HealthRegistry(threshold=1, cooldown=0.2)
+        health.failure(self.url)
+        time.sleep(0.3)
+        self.assertTrue(health.allow(self.url), 'One probe should be allowed!')
+        health.failure(self.url)
+        self.assertFalse(health.allow(self.url), 'Circuit should be open again!')
+
+    def testExpired(self):
+        "expired deadlines are not failures"
+
+        health = HealthRegistry(threshold=1, cooldown=60)
+        health.expired(self.url)
+        self.assertTrue(health.allow(self.url), 'Circuit should still be closed!')
+        status = health.status()[self.url]
+        self.assertEqual(status['expired'], 1, 'Expired request not counted!')
+        self.assertEqual(status['failures'], 0, 'Expired request counted as a failure!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testHealth [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(HealthTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
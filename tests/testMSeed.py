@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import sys
+import struct
+import datetime
+import unittest
+from StringIO import StringIO
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from owndc.mseed import BufferPool
+from owndc.mseed import iterRecords
+from owndc.mseed import recordLength
+from owndc.mseed import recordHeader
+
+
+def record(sta, reclen, seq=1, blockettes=(), start=None, nsamp=0):
+    """Create a miniSEED record with a blockette 1000 and empty data."""
+    if start is None:
+        start = datetime.datetime(2015, 3, 7, 14, 39, 36)
+    doy = start.timetuple().tm_yday
+    header = struct.pack('>6scc5s2s3s2sHHBBBBHHhhBBBBiHH', '%06d' % seq, 'D', ' ',
+                         sta.ljust(5), '', 'BHZ', 'GE', start.year, doy,
+                         start.hour, start.minute, start.second, 0,
+                         start.microsecond / 100, nsamp, 20, 1, 0, 0, 0, 0, 0,
+                         reclen, 48)
+    offset = 48
+    extra = ''
+    for bType in blockettes:
+        extra += struct.pack('>HH4s', bType, offset + len(extra) + 8, '')
+    b1000 = struct.pack('>HHBBBB', 1000, 0, 11, 1, reclen.bit_length() - 1, 0)
+    rec = header + extra + b1000
+    return rec + '\x00' * (reclen - len(rec))
+
+
+class MSeedTests(unittest.TestCase):
+    """Test the functionality of mseed.py
+
+    """
+
+    def testRecordLength(self):
+        "record length from blockette 1000"
+
+        self.assertEqual(recordLength(bytearray(record('APE', 512))), 512,
+                         'Wrong length of a 512 bytes record!')
+        self.assertEqual(recordLength(bytearray(record('APE', 4096))), 4096,
+                         'Wrong length of a 4096 bytes record!')
+        self.assertEqual(recordLength(bytearray(record('APE', 512, blockettes=(100,)))),
+                         512, 'Blockette 1000 not found after other blockette!')
+
+    def testRecordHeader(self):
+        "stream and time span of a record"
+
+        start = datetime.datetime(2015, 3, 7, 14, 39, 36, 500000)
+        header = recordHeader(bytearray(record('APE', 512, start=start, nsamp=201)))
+        self.assertEqual(header, ('GE', 'APE', '', 'BHZ', start,
+                                  start + datetime.timedelta(seconds=10)),
+                         'Wrong values in the header!')
+
+    def testIncomplete(self):
+        "incomplete header"
+
+        self.assertIsNone(recordLength(bytearray(record('APE', 512)[:40])),
+                          'No length expected for an incomplete header!')
+
+    def testInvalid(self):
+        "invalid record"
+
+        self.assertRaises(ValueError, recordLength, bytearray('x' * 512))
+
+    def testAlignment(self):
+        "chunks aligned to records"
+
+        data = ''.join([record('APE', 512, i) for i in range(10)] +
+                       [record('MORC', 4096, i) for i in range(3)])
+        pool = BufferPool(2, 5000)
+        total = ''
+        for buf, chunk in iterRecords(StringIO(data), pool):
+            self.assertIsInstance(chunk, memoryview, 'A memoryview was expected!')
+            self.assertEqual(len(chunk) % 512, 0, 'Chunk not aligned to records!')
+            total += chunk.tobytes()
+            pool.release(buf)
+
+        self.assertEqual(total, data, 'Data modified while reading!')
+        self.assertLessEqual(pool.created, 2, 'Too many buffers created!')
+
+    def testNotMSeed(self):
+        "data which is not miniSEED"
+
+        data = 'Error 500\n' * 100
+        pool = BufferPool(1, 512)
+        total = ''
+        for buf, chunk in iterRecords(StringIO(data), pool):
+            total += chunk.tobytes()
+            pool.release(buf)
+
+        self.assertEqual(total, data, 'Data modified while reading!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testMSeed [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(MSeedTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
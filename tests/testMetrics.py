@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import sys
+import unittest
+
+from unittestTools import WITestRunner
+from owndc.metrics import Counter
+from owndc.metrics import Histogram
+from owndc.metrics import ServiceMetrics
+from owndc.planner import UpstreamRequest
+
+
+class MetricsTests(unittest.TestCase):
+    """Test the functionality of metrics.py
+
+    """
+
+    url = 'http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query'
+
+    def testCounter(self):
+        "counter with labels"
+
+        counter = Counter('owndc_test_total', 'Test counter.', ('method', 'status'))
+        counter.inc(1, 'GET', 200)
+        counter.inc(2, 'GET', 200)
+        counter.inc(1, 'POST', 204)
+        self.assertEqual(counter.render(),
+                         '# HELP owndc_test_total Test counter.\n'
+                         '# TYPE owndc_test_total counter\n'
+                         'owndc_test_total{method="GET",status="200"} 3.0\n'
+                         'owndc_test_total{method="POST",status="204"} 1.0',
+                         'Wrong format of the counter!')
+        self.assertRaises(ValueError, counter.inc, 1, 'GET')
+
+    def testHistogram(self):
+        "cumulative buckets of a histogram"
+
+        histogram = Histogram('owndc_test_seconds', 'Test histogram.', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5.0):
+            histogram.observe(value)
+        lines = histogram.render().splitlines()[2:]
+        self.assertEqual(lines, ['owndc_test_seconds_bucket{le="0.1"} 1.0',
+                                 'owndc_test_seconds_bucket{le="1.0"} 3.0',
+                                 'owndc_test_seconds_bucket{le="+Inf"} 4.0',
+                                 'owndc_test_seconds_sum 6.25',
+                                 'owndc_test_seconds_count 4.0'],
+                         'Wrong buckets of the histogram!')
+
+    def testUpstream(self):
+        "requests to a data centre"
+
+        metrics = ServiceMetrics()
+        req = UpstreamRequest(self.url, [])
+        metrics.started(req)
+        metrics.finished(req, 200, 4096, 0, 0.2, 1.0)
+        metrics.started(req)
+        metrics.finished(req, 500, 0, 0, None, 0.1)
+
+        text = metrics.render()
+        self.assertIn('owndc_upstream_requests_total{endpoint="%s",status="200"} 1.0' % self.url,
+                      text, 'Successful request not found!')
+        self.assertIn('owndc_upstream_errors_total{endpoint="%s"} 1.0' % self.url,
+                      text, 'Failed request not found!')
+        self.assertIn('owndc_upstream_bytes_total{endpoint="%s"} 4096.0' % self.url,
+                      text, 'Wrong number of bytes!')
+        self.assertIn('owndc_upstream_active_requests{endpoint="%s"} 0.0' % self.url,
+                      text, 'No requests should be active!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testMetrics [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(MetricsTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import datetime
+import unittest
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from testMSeed import record
+from owndc.mseed import filterRecords
+from owndc.mseed import recordHeader
+from owndc.mseed import iterOffsets
+from owndc.planner import RequestPlanner
+from owndc.planner import UpstreamRequest
+from owndc.planner import splitTW
+
+
+def route(url, *items):
+    params = list()
+    for net, sta, loc, cha, start, end in items:
+        params.append({'net': net, 'sta': sta, 'loc': loc, 'cha': cha,
+                       'start': start, 'end': end, 'priority': 1})
+    return [{'name': 'dataselect', 'url': url, 'params': params}]
+
+
+class PlannerTests(unittest.TestCase):
+    """Test the functionality of planner.py
+
+    """
+
+    urlGE = 'http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query'
+    urlRO = 'http://eida-sc3.infp.ro/fdsnws/dataselect/1/query'
+    d1 = datetime.datetime(2015, 3, 7, 14, 39, 36)
+    d2 = datetime.datetime(2015, 3, 7, 15, 9, 36)
+
+    def testGroupByURL(self):
+        "one POST request per data centre"
+
+        planner = RequestPlanner()
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d1, self.d2)))
+        planner.add(route(self.urlRO, ('RO', 'ARR', '', 'BHZ', self.d1, self.d2)))
+        planner.add(route(self.urlGE, ('GE', 'MORC', '', 'BHZ', self.d1, self.d2)))
+
+        reqs = planner.requests()
+        self.assertEqual(len(reqs), 2, 'Two requests were expected!')
+        self.assertEqual(reqs[0].url, self.urlGE, 'Wrong order of the requests!')
+        self.assertEqual(reqs[0].data,
+                         'GE APE -- BHZ 2015-03-07T14:39:36 2015-03-07T15:09:36\n'
+                         'GE MORC -- BHZ 2015-03-07T14:39:36 2015-03-07T15:09:36\n',
+                         'Wrong body of the POST request!')
+
+    def testSingleGET(self):
+        "GET request for a single route"
+
+        planner = RequestPlanner()
+        planner.add(route(self.urlRO, ('RO', 'ARR', '', 'BHZ', self.d1, self.d2)))
+
+        reqs = planner.requests()
+        self.assertIsNone(reqs[0].data, 'A GET request was expected!')
+        self.assertEqual(reqs[0].geturl(),
+                         self.urlRO + '?net=RO&sta=ARR&loc=--&cha=BHZ&'
+                         'start=2015-03-07T14%3A39%3A36&end=2015-03-07T15%3A09%3A36',
+                         'Wrong URL of the GET request!')
+
+    def testMaxLines(self):
+        "size limit of the POST requests"
+
+        planner = RequestPlanner(maxLines=2)
+        for sta in ('APE', 'MORC', 'RGN', 'STU', 'WLF'):
+            planner.add(route(self.urlGE, ('GE', sta, '', 'BHZ', self.d1, self.d2)))
+
+        reqs = planner.requests()
+        self.assertEqual([len(r.params) for r in reqs], [2, 2, 1],
+                         'Wrong number of lines per request!')
+
+    def testOpenWindow(self):
+        "routes without time window"
+
+        planner = RequestPlanner()
+        planner.add(route(self.urlGE, ('GE', 'APE', '*', '*', None, None),
+                          ('GE', 'MORC', '*', '*', None, None)))
+
+        reqs = planner.requests()
+        self.assertEqual(len(reqs), 2, 'Open time windows require GET requests!')
+        self.assertEqual(reqs[1].geturl(), self.urlGE + '?net=GE&sta=MORC',
+                         'Wrong URL of the GET request!')
+
+    def testSplitTW(self):
+        "split of long time windows"
+
+        start = datetime.datetime(2015, 3, 7, 14, 0, 0)
+        end = datetime.datetime(2015, 3, 9, 2, 0, 0)
+        parts = list(splitTW(start, end, 86400))
+        self.assertEqual(parts, [(start, datetime.datetime(2015, 3, 8)),
+                                 (datetime.datetime(2015, 3, 8), datetime.datetime(2015, 3, 9)),
+                                 (datetime.datetime(2015, 3, 9), end)],
+                         'Parts must be aligned to midnight!')
+        self.assertEqual(list(splitTW(start, None, 86400)), [(start, None)],
+                         'Open time windows cannot be split!')
+
+    def testPartsOrder(self):
+        "requests ordered by part"
+
+        planner = RequestPlanner(maxLines=1)
+        d3 = self.d2 + datetime.timedelta(days=1)
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d1, self.d2)), 0)
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d2, d3)), 1)
+        planner.add(route(self.urlGE, ('GE', 'MORC', '', 'BHZ', self.d1, self.d2)), 0)
+
+        reqs = planner.requests()
+        self.assertEqual([r.params[0]['sta'] for r in reqs], ['APE', 'MORC', 'APE'],
+                         'Requests must be ordered by part!')
+
+    def testReady(self):
+        "full requests available while planning"
+
+        planner = RequestPlanner(maxLines=2)
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d1, self.d2)))
+        self.assertEqual(planner.ready(), [], 'Group is not full yet!')
+
+        planner.add(route(self.urlGE, ('GE', 'MORC', '', 'BHZ', self.d1, self.d2)))
+        planner.add(route(self.urlGE, ('GE', 'KBS', '', 'BHZ', self.d1, self.d2)))
+        reqs = planner.ready()
+        self.assertEqual(len(reqs), 1, 'Full group should be ready!')
+        self.assertEqual(len(reqs[0].params), 2, 'Wrong number of lines!')
+
+        reqs = planner.requests()
+        self.assertEqual([r.params[0]['sta'] for r in reqs], ['KBS'],
+                         'Only the requests not taken should be returned!')
+
+    def testReadyParts(self):
+        "no part ready before the previous ones"
+
+        planner = RequestPlanner(maxLines=2)
+        d3 = self.d2 + datetime.timedelta(days=1)
+        planner.add(route(self.urlRO, ('RO', 'ARR', '', 'BHZ', self.d1, self.d2)), 0)
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d2, d3),
+                          ('GE', 'MORC', '', 'BHZ', self.d2, d3)), 1)
+        self.assertEqual(planner.ready(), [], 'Part 0 is still pending!')
+
+        planner.add(route(self.urlGE, ('GE', 'KBS', '', 'BHZ', self.d1, self.d2)), 0)
+        reqs = planner.ready() + planner.requests()
+        self.assertEqual([(r.url, len(r.params)) for r in reqs],
+                         [(self.urlRO, 1), (self.urlGE, 1), (self.urlGE, 2)],
+                         'Requests must be ordered by part!')
+
+    def testReadyDelay(self):
+        "groups sent while planning after waiting for more lines"
+
+        planner = RequestPlanner(maxLines=10, maxDelay=0.1)
+        planner.add(route(self.urlGE, ('GE', 'APE', '', 'BHZ', self.d1, self.d2)))
+        self.assertEqual(planner.ready(), [], 'Group should wait for more lines!')
+
+        time.sleep(0.2)
+        planner.add(route(self.urlRO, ('RO', 'ARR', '', 'BHZ', self.d1, self.d2)))
+        reqs = planner.ready()
+        self.assertEqual([(r.url, len(r.params)) for r in reqs], [(self.urlGE, 1)],
+                         'The first group should not wait for the whole plan!')
+
+        planner.add(route(self.urlGE, ('GE', 'MORC', '', 'BHZ', self.d1, self.d2)))
+        reqs = planner.requests()
+        self.assertEqual([(r.url, r.params[0]['sta']) for r in reqs],
+                         [(self.urlRO, 'ARR'), (self.urlGE, 'MORC')],
+                         'Later lines must go to a new request!')
+
+    def testBoundaryRecord(self):
+        "record crossing the limit between two parts returned once"
+
+        limit = datetime.datetime(2015, 3, 8)
+        start = limit - datetime.timedelta(hours=1)
+        end = limit + datetime.timedelta(hours=1)
+        # Records of 20 seconds (400 samples at 20 Hz)
+        recs = [record('APE', 512, i, start=limit + datetime.timedelta(seconds=s), nsamp=400)
+                for i, s in enumerate((-30, -10, 10))]
+
+        parts = [UpstreamRequest(self.urlGE, [{'net': 'GE', 'sta': 'APE', 'loc': '', 'cha': 'BHZ',
+                                               'start': s, 'end': e, 'trim': trim}])
+                 for s, e, trim in ((start, limit, (None, limit)), (limit, end, (limit, None)))]
+        # Both parts receive the record crossing the limit
+        received = list()
+        for req, data in zip(parts, (recs[0] + recs[1], recs[1] + recs[2])):
+            self.assertTrue(req.trimmed(), 'The parts of the request must be trimmed!')
+            buf = bytearray(data)
+            chunk = filterRecords(buf, memoryview(buf), req.keep)
+            received.extend([recordHeader(chunk, pos)[4] for pos, reclen in iterOffsets(chunk)])
+
+        self.assertEqual(received, [limit + datetime.timedelta(seconds=s) for s in (-30, -10, 10)],
+                         'Every record must be returned exactly once!')
+
+        other = UpstreamRequest(self.urlGE, [{'net': 'GE', 'sta': 'MORC', 'loc': '', 'cha': 'BHZ',
+                                              'start': limit, 'end': end, 'trim': (limit, None)}])
+        self.assertTrue(other.keep(recordHeader(bytearray(recs[1]))),
+                        'Records of other streams must not be discarded!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testPlanner [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(PlannerTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import socket
+import threading
+import unittest
+import urllib2
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+# here = os.path.dirname(__file__)
+# sys.path.append(os.path.join(here, '..'))
+
+from unittestTools import WITestRunner
+from owndc.httppool import ConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+
+        if self.path.startswith('/slow'):
+            time.sleep(1)
+
+        if self.path.startswith('/moved'):
+            self.send_response(302)
+            self.send_header('Location', '/data')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = 'x' * 1024
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Connections closed by the pool are expected
+        pass
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    """Test the functionality of httppool.py
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = KeepAliveServer(('localhost', 0), KeepAliveHandler)
+        cls.url = 'http://localhost:%d' % cls.server.server_port
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def testReuse(self):
+        "reuse of a keep-alive connection"
+
+        pool = ConnectionPool(maxPerHost=2)
+        for i in range(3):
+            u = pool.urlopen('%s/data' % self.url)
+            self.assertEqual(len(u.read()), 1024, 'Wrong size of the response!')
+            u.close()
+
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 1, 'Only one connection should be opened!')
+        self.assertEqual(stats['hits'], 2, 'The connection should be reused twice!')
+        self.assertEqual(stats['idle'], 1, 'One idle connection was expected!')
+        pool.clear()
+
+    def testConnect(self):
+        "connection opened in advance"
+
+        pool = ConnectionPool()
+        pool.connect('%s/data' % self.url)
+        self.assertEqual(pool.stats()['idle'], 1, 'One idle connection was expected!')
+
+        u = pool.urlopen('%s/data' % self.url)
+        u.read()
+        u.close()
+        self.assertEqual(pool.stats()['hits'], 1, 'The connection should be reused!')
+        pool.clear()
+
+    def testRefresh(self):
+        "connection kept open for a warm host"
+
+        pool = ConnectionPool(idleTimeout=10)
+        pool.connect('%s/data' % self.url, keep=True)
+        pool.refresh()
+        self.assertEqual(pool.stats()['idle'], 1, 'The idle connection is still valid!')
+
+        pool.refresh(20)
+        self.assertEqual(pool.stats()['idle'], 2,
+                         'A new connection should be opened before the eviction!')
+        pool.clear()
+
+    def testLimit(self):
+        "limit of open connections per host"
+
+        pool = ConnectionPool(maxPerHost=1)
+        u = pool.urlopen('%s/data' % self.url)
+        self.assertRaises(socket.timeout, pool.urlopen, '%s/data' % self.url,
+                          deadline=time.time() + 0.2)
+
+        def release():
+            u.read()
+            u.close()
+
+        # The request waits until the connection is released
+        threading.Timer(0.2, release).start()
+        u2 = pool.urlopen('%s/data' % self.url, deadline=time.time() + 5)
+        u2.read()
+        u2.close()
+        stats = pool.stats()
+        self.assertEqual(stats['open'], 1, 'Only one connection should be open!')
+        self.assertEqual(stats['hits'], 1, 'The released connection should be reused!')
+        pool.clear()
+        self.assertEqual(pool.stats()['open'], 0, 'All connections should be closed!')
+
+    def testMoreWorkers(self):
+        "more workers than connections per host"
+
+        pool = ConnectionPool(maxPerHost=1, waitTimeout=0.2)
+        consumed = threading.Event()
+        received = dict()
+
+        def worker(name, hold):
+            u = pool.urlopen('%s/data' % self.url)
+            received[name] = len(u.read())
+            # Like a source which waits for the consumer of the data
+            if hold:
+                consumed.wait(5)
+            else:
+                consumed.set()
+            u.close()
+
+        # The later source keeps the only connection until the earlier one
+        # (which the consumer waits for) was read
+        later = threading.Thread(target=worker, args=('later', True))
+        later.start()
+        time.sleep(0.1)
+        earlier = threading.Thread(target=worker, args=('earlier', False))
+        earlier.start()
+        earlier.join(5)
+        later.join(5)
+
+        self.assertEqual(received.get('earlier'), 1024, 'The earlier source got no data!')
+        self.assertEqual(pool.stats()['overflows'], 1,
+                         'One connection should be opened above the limit!')
+        self.assertEqual(pool.stats()['open'], 1,
+                         'The connection above the limit should be closed!')
+        pool.clear()
+
+    def testStale(self):
+        "retry with a new connection if the idle ones are stale"
+
+        pool = ConnectionPool()
+        responses = [pool.urlopen('%s/data' % self.url) for i in range(2)]
+        for u in responses:
+            u.read()
+            u.close()
+
+        # The server closed both idle connections
+        for conn, lastUsed in pool.idle.values()[0]:
+            conn.sock.close()
+
+        u = pool.urlopen('%s/data' % self.url)
+        self.assertEqual(len(u.read()), 1024, 'Wrong size of the data received!')
+        u.close()
+        stats = pool.stats()
+        self.assertEqual(stats['open'], 2, 'The stale connection should be replaced!')
+        pool.clear()
+
+    def testPartialRead(self):
+        "connection not reused if the response was not consumed"
+
+        pool = ConnectionPool()
+        u = pool.urlopen('%s/data' % self.url)
+        u.read(10)
+        u.close()
+        self.assertEqual(pool.stats()['idle'], 0, 'No idle connection was expected!')
+
+    def testEviction(self):
+        "eviction of idle connections"
+
+        pool = ConnectionPool(idleTimeout=-1)
+        u = pool.urlopen('%s/data' % self.url)
+        u.read()
+        u.close()
+        u = pool.urlopen('%s/data' % self.url)
+        u.read()
+        u.close()
+
+        stats = pool.stats()
+        self.assertEqual(stats['evictions'], 1, 'The idle connection should be evicted!')
+        self.assertEqual(stats['hits'], 0, 'An evicted connection cannot be reused!')
+        pool.clear()
+
+    def testPOST(self):
+        "POST request through the pool"
+
+        pool = ConnectionPool()
+        u = pool.urlopen('%s/query' % self.url, 'GE APE -- BHZ')
+        self.assertEqual(u.read(), 'GE APE -- BHZ', 'Wrong body in the response!')
+        u.close()
+        pool.clear()
+
+    def testRedirect(self):
+        "redirection to another path"
+
+        pool = ConnectionPool()
+        u = pool.urlopen('%s/moved' % self.url)
+        self.assertEqual(len(u.read()), 1024, 'Wrong size of the response!')
+        u.close()
+        pool.clear()
+
+    def testHTTPError(self):
+        "HTTP error 404"
+
+        pool = ConnectionPool()
+        self.assertRaises(urllib2.HTTPError, pool.urlopen, '%s/missing' % self.url)
+        pool.clear()
+
+    def testFirstByteTimeout(self):
+        "timeout waiting for the response"
+
+        pool = ConnectionPool(firstByteTimeout=0.2)
+        self.assertRaises(socket.timeout, pool.urlopen, '%s/slow' % self.url)
+
+    def testDeadline(self):
+        "deadline of the request"
+
+        pool = ConnectionPool()
+        self.assertRaises(socket.timeout, pool.urlopen, '%s/slow' % self.url,
+                          deadline=time.time() + 0.2)
+        self.assertRaises(socket.timeout, pool.urlopen, '%s/data' % self.url,
+                          deadline=time.time() - 1)
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testPool [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ConnectionPoolTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
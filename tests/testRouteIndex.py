@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import datetime
+import unittest
+
+from unittestTools import WITestRunner
+from owndc.routing.routeutils.utils import RoutingException
+from owndc.routing.routeutils.utils import RoutingCache
+from owndc.routing.routeutils.utils import addRoutes
+from owndc.routing.routeutils.utils import addVirtualNets
+from owndc.routing.routeutils.utils import Route
+from owndc.routing.routeutils.utils import Stream
+from owndc.routing.routeutils.utils import TW
+from owndc.routeindex import compileRoutes
+from owndc.routeindex import RouteIndex
+
+
+class RouteIndexTests(unittest.TestCase):
+    """Test the functionality of routeindex.py
+
+    """
+
+    fname = 'tests/test-owndc-routes.xml.idx'
+    urlGE = 'http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query'
+    urlRO = 'http://eida-sc3.infp.ro/fdsnws/dataselect/1/query'
+    urlCH = 'http://eida.ethz.ch/fdsnws/dataselect/1/query'
+    d1 = datetime.datetime(2000, 1, 1)
+
+    @classmethod
+    def setUpClass(cls):
+        "Compiling a small routing table"
+        ptRT = {Stream('GE', '*', '*', '*'): [Route('dataselect', cls.urlGE, TW(None, None), 1),
+                                              Route('dataselect', cls.urlRO, TW(None, None), 2)],
+                Stream('RO', '*', '*', '*'): [Route('dataselect', cls.urlRO, TW(cls.d1, None), 1)]}
+        ptVN = {'_VN': [(Stream('GE', 'APE', '*', '*'), TW(None, None)),
+                        (Stream('RO', 'ARR', '*', '*'), TW(None, None))]}
+        ptMT = {Stream('CH', '*', '*', '*'): [Route('dataselect', cls.urlCH, TW(None, None), 1)]}
+        compileRoutes(cls.fname, ptRT, ptVN, ptMT)
+        cls.ri = RouteIndex(cls.fname)
+
+    @classmethod
+    def tearDownClass(cls):
+        "Removing index"
+        cls.ri.close()
+        os.remove(cls.fname)
+
+    def testBestPriority(self):
+        "route for GE.APE.*.BHZ"
+
+        result = self.ri.getRoute(Stream('GE', 'APE', '*', 'BHZ'), TW(None, None))
+        self.assertEqual(len(result), 1, 'Only the best priority should be used!')
+        self.assertEqual(result[0]['url'], self.urlGE, 'Wrong URL for GE.APE.*.BHZ!')
+        self.assertEqual(result[0]['params'][0]['sta'], 'APE',
+                         'Stream should be restricted to the request!')
+
+    def testTimeWindow(self):
+        "route for RO.*.*.* before and after the start of the route"
+
+        start = datetime.datetime(1999, 12, 31)
+        end = datetime.datetime(2000, 1, 2)
+        result = self.ri.getRoute(Stream('RO', '*', '*', '*'), TW(start, end))
+        self.assertEqual(result[0]['params'][0]['start'], self.d1,
+                         'Time window should be restricted to the route!')
+
+        self.assertRaises(RoutingException, self.ri.getRoute,
+                          Stream('RO', '*', '*', '*'), TW(start, self.d1))
+
+    def testVirtualNet(self):
+        "route for virtual network _VN"
+
+        result = self.ri.getRoute(Stream('_VN', '*', '*', '*'), TW(None, None))
+        self.assertEqual(sorted([dc['url'] for dc in result]),
+                         sorted([self.urlGE, self.urlRO]),
+                         'Wrong data centres for virtual network!')
+
+    def testMaster(self):
+        "route for CH.*.*.* from the master table"
+
+        result = self.ri.getRoute(Stream('CH', 'LIENZ', '*', '*'), TW(None, None))
+        self.assertEqual(result[0]['url'], self.urlCH, 'Wrong URL for CH.LIENZ.*.*!')
+
+    def testUnknown(self):
+        "route for unknown network"
+
+        self.assertRaises(RoutingException, self.ri.getRoute,
+                          Stream('XX', '*', '*', '*'), TW(None, None))
+
+
+class RouteIndexCacheTests(unittest.TestCase):
+    """Compare the routes of routeindex.py with the ones of a RoutingCache
+
+    """
+
+    routesFile = 'tests/test-owndc-routes.xml'
+    masterFile = 'tests/test-masterTable.xml'
+    fname = 'tests/test-owndc-routes-cmp.idx'
+
+    @classmethod
+    def setUpClass(cls):
+        "Compiling the test routing table"
+        cls.rc = RoutingCache(cls.routesFile, cls.masterFile, 'tests/test-owndc.cfg')
+        ptRT = addRoutes(cls.routesFile)
+        ptVN = addVirtualNets(cls.routesFile)
+        ptMT = addRoutes(cls.masterFile, allowOverlaps=True)
+        compileRoutes(cls.fname, ptRT, ptVN, ptMT)
+        cls.ri = RouteIndex(cls.fname)
+
+    @classmethod
+    def tearDownClass(cls):
+        "Removing index and cache"
+        cls.ri.close()
+        os.remove(cls.fname)
+        if os.path.exists('%s.bin' % cls.routesFile):
+            os.remove('%s.bin' % cls.routesFile)
+
+    @staticmethod
+    def routes(table, st, tw):
+        """Return the routes as comparable tuples or None if there are none."""
+        try:
+            result = table.getRoute(st, tw, 'dataselect')
+        except RoutingException:
+            return None
+        return sorted([(dc['url'], p['net'], p['sta'], p['loc'], p['cha'],
+                        p['start'], p['end']) for dc in result for p in dc['params']])
+
+    def compare(self, st, tw=TW(None, None)):
+        self.assertEqual(self.routes(self.ri, st, tw), self.routes(self.rc, st, tw),
+                         'Different routes for %s.%s.%s.%s!' % tuple(st))
+
+    def testNetworks(self):
+        "routes of complete networks"
+
+        for net in ('GE', 'CH', 'RO', 'BW', 'XX'):
+            self.compare(Stream(net, '*', '*', '*'))
+
+    def testStreams(self):
+        "routes of single stations and channels"
+
+        self.compare(Stream('GE', 'APE', '*', 'BHZ'))
+        self.compare(Stream('CH', 'LIENZ', '*', '?HZ'))
+        self.compare(Stream('RO', 'BZS', '*', 'BHZ'))
+        self.compare(Stream('4C', 'KES27', '*', 'HNZ'))
+        self.compare(Stream('4C', 'KES20', '*', 'HN?'))
+
+    def testTimeWindows(self):
+        "routes of temporary networks for some time windows"
+
+        self.compare(Stream('XO', '*', '*', '*'))
+        self.compare(Stream('XO', '*', '*', '*'),
+                     TW(datetime.datetime(1995, 9, 1), datetime.datetime(2008, 1, 1)))
+        self.compare(Stream('XO', '*', '*', '*'),
+                     TW(datetime.datetime(2000, 1, 1), datetime.datetime(2001, 1, 1)))
+        self.compare(Stream('4C', 'KES27', '*', 'HNZ'),
+                     TW(datetime.datetime(2012, 1, 1), None))
+
+    def testWildcards(self):
+        "routes with wildcards in the network and station"
+
+        self.compare(Stream('*', 'APE', '*', 'BHZ'))
+        self.compare(Stream('4?', 'KES*', '*', '*'))
+        self.compare(Stream('X*', '*', '*', '*'),
+                     TW(datetime.datetime(2007, 6, 1), datetime.datetime(2007, 7, 1)))
+
+    def testVirtualNet(self):
+        "routes of virtual network _TEST"
+
+        self.compare(Stream('_TEST', '*', '*', '*'))
+        self.compare(Stream('_TEST', 'APE', '*', 'BHZ'))
+        self.compare(Stream('_TEST', '*', '*', '*'),
+                     TW(datetime.datetime(1985, 1, 1), datetime.datetime(1990, 1, 1)))
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testRouteIndex [-h] [-p]'
+
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(RouteIndexTests),
+                               loader.loadTestsFromTestCase(RouteIndexCacheTests)])
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
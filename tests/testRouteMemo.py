@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import datetime
+import unittest
+
+from unittestTools import WITestRunner
+from owndc.routing.routeutils.utils import RoutingCache
+from owndc.routing.routeutils.utils import RoutingException
+from owndc.routing.routeutils.utils import Stream
+from owndc.routing.routeutils.utils import TW
+from owndc.routememo import RouteMemo
+
+
+class RouteMemoTests(unittest.TestCase):
+    """Test the functionality of routememo.py
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        "Setting up test"
+        cls.rc = RoutingCache('tests/test-owndc-routes.xml',
+                              'tests/test-masterTable.xml',
+                              'tests/test-owndc.cfg')
+
+    @classmethod
+    def tearDownClass(cls):
+        "Removing cache files"
+        if os.path.exists('tests/test-owndc-routes.xml.bin'):
+            os.remove('tests/test-owndc-routes.xml.bin')
+
+    def testHit(self):
+        "same route requested twice"
+
+        memo = RouteMemo(self.rc)
+        st = Stream('GE', 'APE', '*', '*')
+        first = memo.getRoute(st, TW(None, None))
+        second = memo.getRoute(st, TW(None, None))
+        self.assertEqual(first, second, 'Memoised route differs from the original!')
+        self.assertEqual(first, self.rc.getRoute(st, TW(None, None)),
+                         'Memoised route differs from the routing table!')
+
+        stats = memo.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1),
+                         'Wrong hit/miss counters!')
+        self.assertEqual(stats['hitRate'], 0.5, 'Wrong hit rate!')
+
+    def testBucket(self):
+        "time windows within the same day"
+
+        memo = RouteMemo(self.rc, bucket=86400)
+        st = Stream('GE', 'APE', '*', '*')
+        start = datetime.datetime(2015, 1, 1, 10)
+        for hour in range(3):
+            tw = TW(start + datetime.timedelta(hours=hour),
+                    start + datetime.timedelta(hours=hour + 1))
+            result = memo.getRoute(st, tw)
+            for item in result[0]['params']:
+                self.assertEqual((item['start'], item['end']), (tw.start, tw.end),
+                                 'Route not clipped to the time window!')
+
+        self.assertEqual(memo.stats()['misses'], 1,
+                         'All time windows should share one bucket!')
+
+    def testNoRoute(self):
+        "stream without routes"
+
+        memo = RouteMemo(self.rc)
+        st = Stream('XX', 'NONE', '*', '*')
+        for attempt in range(2):
+            self.assertRaises(RoutingException, memo.getRoute, st, TW(None, None))
+        self.assertEqual(memo.stats()['hits'], 1,
+                         'Missing route should also be remembered!')
+
+    def testBounded(self):
+        "size of the memo and invalidation"
+
+        memo = RouteMemo(self.rc, maxSize=2)
+        for sta in ('APE', 'KBS', 'RGN'):
+            memo.getRoute(Stream('GE', sta, '*', '*'), TW(None, None))
+        self.assertEqual(memo.stats()['size'], 2, 'Memo is not bounded!')
+
+        memo.invalidate()
+        self.assertEqual(memo.stats()['size'], 0, 'Memo was not invalidated!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testRouteMemo [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(RouteMemoTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
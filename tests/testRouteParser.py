@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import datetime
+import tempfile
+import unittest
+
+from unittestTools import WITestRunner
+from owndc.routing.routeutils.utils import Stream
+from owndc.routeparser import parseRoutes
+
+
+class RouteParserTests(unittest.TestCase):
+    """Test the functionality of routeparser.py
+
+    """
+
+    fname = 'tests/test-owndc-routes.xml'
+
+    def testRoutes(self):
+        "routes of CH.*.*.*"
+
+        ptRT, ptVN = parseRoutes(self.fname)
+        routes = ptRT[Stream('CH', '*', '*', '*')]
+        services = sorted([r.service for r in routes])
+        self.assertEqual(services, ['dataselect', 'station'], 'Wrong services for CH!')
+
+        ds = [r for r in routes if r.service == 'dataselect'][0]
+        self.assertEqual(ds.address, 'http://eida.ethz.ch/fdsnws/dataselect/1/query',
+                         'Wrong address for CH!')
+        self.assertEqual(ds.priority, 1, 'Wrong priority for CH!')
+        self.assertEqual(ds.tw.start, datetime.datetime(1980, 1, 1), 'Wrong start time!')
+        self.assertIsNone(ds.tw.end, 'Open end time expected!')
+
+    def testTimeWindows(self):
+        "routes of XO.*.*.* in two time windows"
+
+        ptRT, ptVN = parseRoutes(self.fname)
+        ds = [r for r in ptRT[Stream('XO', '*', '*', '*')] if r.service == 'dataselect']
+        self.assertEqual(len(ds), 2, 'Two time windows expected for XO!')
+
+    def testOverlaps(self):
+        "routes already in the table"
+
+        ptRT, ptVN = parseRoutes(self.fname)
+        size = len(ptRT[Stream('CH', '*', '*', '*')])
+        parseRoutes(self.fname, ptRT, ptVN)
+        self.assertEqual(len(ptRT[Stream('CH', '*', '*', '*')]), size,
+                         'Routes already defined should be skipped!')
+
+        parseRoutes(self.fname, ptRT, ptVN, allowOverlaps=True)
+        self.assertEqual(len(ptRT[Stream('CH', '*', '*', '*')]), 2 * size,
+                         'Overlapping routes should be added!')
+
+    def testEpochs(self):
+        "routes of one stream in two disjoint epochs of the same file"
+
+        xml = """<?xml version="1.0" encoding="utf-8"?>
+<ns0:routing xmlns:ns0="http://geofon.gfz-potsdam.de/ns/Routing/1.0/">
+ <ns0:route networkCode="XO" stationCode="*" locationCode="*" streamCode="*">
+  <ns0:dataselect address="http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query" priority="1" start="1995-08-01T00:00:00" end="1995-10-12T00:00:00" />
+ </ns0:route>
+ <ns0:route networkCode="XO" stationCode="*" locationCode="*" streamCode="*">
+  <ns0:dataselect address="http://ws.resif.fr/fdsnws/dataselect/1/query" priority="1" start="2007-04-10T00:00:00" end="2008-10-26T00:00:00" />
+ </ns0:route>
+ <ns0:route networkCode="XO" stationCode="*" locationCode="*" streamCode="*">
+  <ns0:dataselect address="http://eida.ethz.ch/fdsnws/dataselect/1/query" priority="1" start="2008-01-01T00:00:00" end="" />
+ </ns0:route>
+</ns0:routing>
+"""
+        fd, fname = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(xml)
+        try:
+            ptRT, ptVN = parseRoutes(fname)
+        finally:
+            os.remove(fname)
+
+        addresses = [r.address for r in ptRT[Stream('XO', '*', '*', '*')]]
+        self.assertEqual(addresses, ['http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query',
+                                     'http://ws.resif.fr/fdsnws/dataselect/1/query'],
+                         'Only the overlapping epoch should be skipped!')
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testRouteParser [-h] [-p]'
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(RouteParserTests)
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))